@@ -0,0 +1,277 @@
+'''asyncio engine, runs the X-Plane, EFIS and AHRS links on one event loop
+
+Alternative to the thread per socket engine started by main.py. Packets are decoded and
+encoded by the same functions the threaded engine uses (xplane.process_datagram,
+efis.Deframer/process_packet, link.AhrsBroadcaster and the interlink payloads), only the
+socket I/O and the scheduling live here. Nothing on the loop prints, errors go through
+log.get('aio') and its background writer, see log.py.
+
+Run: python main.py --engine asyncio
+'''
+
+import asyncio
+import socket
+import threading
+
+import capture
+import latency
+import efis
+import instrument
+import link
+import log
+import xplane
+
+_log = log.get('aio')
+
+
+class LoopQueue:
+    '''asyncio.Queue that other threads can put to, so it can subscribe to efis.q
+
+    Like the threaded outboxes it is bounded and drops its oldest item when full.
+    '''
+
+    def __init__(self, loop, maxsize=0):
+        self.loop = loop
+        self.thread = threading.get_ident()     # created on the loop thread
+        self.queue = asyncio.Queue(maxsize)
+
+    def put_nowait(self, item):
+        if threading.get_ident() == self.thread:
+            self._put(item)
+        else:
+            self.loop.call_soon_threadsafe(self._put, item)
+
+    def get(self):
+        return self.queue.get()
+
+    def _put(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+
+
+class DatagramSink:
+    '''Stands in for xplane.q, ('send', data) tasks go straight out of the X-Plane transport'''
+
+    def __init__(self, loop, transport, addr):
+        self.loop = loop
+        self.transport = transport
+        self.addr = addr
+
+    def put(self, item):
+        task, data = item
+        if task == 'send':
+            instrument.counters()['xplane_tx'] += 1
+            self.loop.call_soon_threadsafe(xplane.send_to, self.transport, data, self.addr)
+        else:
+            _log.warning('Xplane: Except task SEND, but got %s', task)
+
+
+# X-Plane UDP link
+class XPlaneProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, beacon):
+        self.beacon = beacon
+        self.transport = None
+        self.counts = instrument.counters()     # created on the loop thread, the callbacks run there
+
+    def connection_made(self, transport):
+        self.transport = transport
+        xplane.request_rpos(transport, self.beacon, xplane.get_rpos_hz(None))
+        xplane.load_refs(transport, self.beacon)     #load data to receive, paced out by subscriptions()
+
+    def datagram_received(self, data, addr):
+        self.counts['xplane_datagrams'] += 1
+        self.counts['xplane_bytes'] += len(data)
+        if capture.recorder:
+            capture.recorder.write(capture.XPLANE, capture.RX, data, addr[0])
+        try:
+            xplane.process_datagram(data)
+        except Exception as e:
+            self.counts['xplane_rx_errors'] += 1
+            _log.error('Xplane rx: %s = %s', type(e), e)
+
+    def error_received(self, exc):
+        #If no data is received, you get here, but it's not an error
+        pass
+
+
+async def run_xplane():
+    loop = asyncio.get_running_loop()
+    beacon = await loop.run_in_executor(None, xplane.find_beacon)
+    _log.info('Xplane: Starting asyncio UDP connection with Xplane on port %s', beacon['port'])
+
+    transport, protocol = await loop.create_datagram_endpoint(lambda: XPlaneProtocol(beacon), family=socket.AF_INET)
+    xplane.q = DatagramSink(loop, transport, (beacon['ip'], beacon['port']))
+    loop.create_task(subscriptions())
+    return transport
+
+
+async def subscriptions():
+    while True:
+        await asyncio.sleep(xplane.subscriptions.poll())
+
+
+# EFIS discovery and TCP sessions
+class EfisSession:
+    '''One TCP interlink connection to an EFIS'''
+
+    def __init__(self, ip, sessions):
+        self.loop = asyncio.get_running_loop()
+        self.ip = ip
+        self.sessions = sessions
+        self.outbox = LoopQueue(self.loop, efis.EFIS_QUEUE_SIZE)
+        self.timer = self.loop.call_later(efis.EFIS_UDP_TIMEOUT, self.close)
+        efis.q.subscribe(self.outbox)
+
+    def alive(self):
+        # EFIS pinged again, restart its timeout
+        self.timer.cancel()
+        self.timer = self.loop.call_later(efis.EFIS_UDP_TIMEOUT, self.close)
+
+    def close(self):
+        self.outbox.put_nowait(('close', ''))
+
+    async def run(self):
+        try:
+            reader, writer = await asyncio.open_connection(self.ip, efis.EFIS_PORT)
+        except OSError as e:
+            _log.error('Efis: Can not connect to EFIS @ %s: %s', self.ip, e)
+            self.finish()
+            return
+
+        _log.info('Found EFIS @ %s', self.ip)
+        writer.transport.set_write_buffer_limits(0)     # drain() waits until the frame is in the socket, like sendall
+        rx = self.loop.create_task(self.receive(reader))
+        counts = instrument.counters()
+        try:
+            while True:
+                task, data = await self.outbox.get()
+                if task == 'frame':
+                    frame = data                    # Already framed by the bus
+                elif task == 'send':
+                    frame = efis.encode_frame(data)
+                elif task == 'hello':
+                    frame = efis.HELLO_FRAME
+                elif task == 'close':
+                    break
+                else:
+                    _log.warning('Efis: Except task SEND, but got %s', task)
+                    continue
+                writer.write(frame)
+                counts[f'efis_tx_{frame[5]:02x}'] += 1     # packet type, after the flag and the header
+                if capture.recorder:
+                    capture.recorder.write(capture.EFIS, capture.TX, frame, self.ip)
+                await writer.drain()
+                if latency.enabled and isinstance(data, latency.Frame):
+                    latency.since(data.name, data.stamp)
+
+        except OSError as e:
+            counts['efis_tx_errors'] += 1
+            _log.error('Efis tx loop %s: %s = %s', self.ip, type(e), e)
+
+        rx.cancel()
+        writer.close()
+        self.finish()
+        _log.info('Efis: Closing down TCP %s', self.ip)
+
+    async def receive(self, reader):
+        deframer = efis.Deframer(self.ip)
+        counts = instrument.counters()
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:            # EFIS closed the connection
+                    break
+                counts['efis_chunks'] += 1
+                counts['efis_bytes'] += len(data)
+                if capture.recorder:
+                    capture.recorder.write(capture.EFIS, capture.RX, data, self.ip)
+                for packet in deframer.feed(data):
+                    counts['efis_packets'] += 1
+                    try:
+                        efis.process_packet(packet, self.outbox)
+                    except Exception as e:      # one bad packet, keep the connection
+                        counts['efis_rx_errors'] += 1
+                        _log.error('Efis rx loop %s: %s = %s', self.ip, type(e), e)
+        except OSError as e:
+            counts['efis_rx_errors'] += 1
+            _log.error('Efis rx loop %s: %s = %s', self.ip, type(e), e)
+        self.close()
+
+    def finish(self):
+        self.timer.cancel()
+        efis.q.unsubscribe(self.outbox)
+        if self.sessions.get(self.ip) is self:
+            self.sessions.pop(self.ip)
+
+
+class EfisDiscovery(asyncio.DatagramProtocol):
+    '''Listens for the EFIS UDP hellos and starts a session for every new EFIS'''
+
+    def __init__(self):
+        self.sessions = {}
+        self.transport = None
+        self.own = set()            # (address, port) our hellos leave from
+
+    def connection_made(self, transport):
+        self.transport = transport
+        _log.info('Listening on UDP %s for Efis pings', efis.EFIS_PORT)
+
+    def datagram_received(self, data, addr):
+        if addr in self.own:
+            return              # our own hello, heard back when the EFIS shares our host
+        ip = addr[0]
+        session = self.sessions.get(ip)
+        if session is None:
+            self.own.add(efis.hello_source(ip))
+            efis.send_hello(self.transport, ip)
+            session = EfisSession(ip, self.sessions)
+            self.sessions[ip] = session
+            asyncio.get_running_loop().create_task(session.run())
+        else:
+            session.alive()
+
+
+async def run_efis():
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(EfisDiscovery, local_addr=('0.0.0.0', efis.EFIS_PORT))
+    return transport
+
+
+# AHRS and interlink producers
+async def ahrs(vm_ips, port):
+    # link.AhrsBroadcaster encodes each frame once for all VMs and reconnects a lost VM with backoff,
+    # its sockets don't block so the scheduler runs right on the loop
+    await wait(xplane.ready('ahrs'))     # nothing to send until xplane has sent the attitude
+    sender = link.AhrsBroadcaster(vm_ips, port)
+    link.broadcaster = sender
+    schedule = link.ahrs_scheduler(sender.send)
+    link.schedulers['ahrs'] = schedule
+    while True:
+        await asyncio.sleep(schedule.poll())
+
+
+async def wait(event):
+    # threading.Event set by the receive path, waited for off the loop
+    await asyncio.get_running_loop().run_in_executor(None, event.wait)
+
+
+async def interlink():
+    await wait(xplane.ready('interlink'))
+    await wait(efis.q.connected)
+    schedule = link.interlink_scheduler()
+    link.schedulers['interlink'] = schedule
+    while True:
+        await asyncio.sleep(schedule.poll())
+
+
+async def main(vm_ips, vm_port):
+    await asyncio.gather(run_xplane(), run_efis(), interlink(), ahrs(vm_ips, vm_port))
+
+
+def run(vm_ips, vm_port):
+    asyncio.run(main(vm_ips, vm_port))
@@ -0,0 +1,646 @@
+'''Benchmarks for the bridge hot paths, plus loopback scenarios
+
+Run: python bench.py [name ...]
+     python bench.py --json results.json                      save the results
+     python bench.py --compare baseline.json [--tolerance 0.1]  fail on regressions against a saved run
+
+Names can be given as prefixes, python bench.py rref efis runs every RREF and EFIS benchmark.
+'''
+
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import platform
+import threading
+import multiprocessing
+import os
+import timeit
+import datetime
+
+import crc
+import codec
+import datarefs
+import efis
+import emulators
+import link
+import scheduler
+import serial
+import session
+import xplane
+
+
+BENCHMARKS = {}
+SCENARIOS = {}
+
+def benchmark(name, unit='frames'):
+    # register a setup function, it returns the callable that gets timed
+    def register(setup):
+        BENCHMARKS[name] = (setup, unit)
+        return setup
+    return register
+
+
+def scenario(name):
+    # register a function that runs a whole loopback scenario and returns its own results
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def scaled(func, size):
+    # setup helper for throughput benchmarks, each call handles size bytes
+    func.size = size
+    return func
+
+
+def run(name, min_time=0.5):
+    setup, unit = BENCHMARKS[name]
+    func = setup()
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timer.timeit(number)
+    best = min([elapsed] + timer.repeat(repeat=2, number=number)) / number
+    per_sec = getattr(func, 'size', 1) / best
+    if unit == 'MB':
+        per_sec /= 1e6
+    return {'name': name, 'unit': unit, 'per_sec': per_sec, 'usec': best * 1e6}
+
+
+# Encoders
+@benchmark('ahrs_high')
+def _ahrs_high():
+    encoder = codec.AhrsEncoder()
+    return lambda: encoder.encode_high(-1234, 567, 16000, 10000, -250, 1500)
+
+@benchmark('ahrs_low')
+def _ahrs_low():
+    encoder = codec.AhrsEncoder()
+    return encoder.encode_low
+
+@benchmark('ahrs_high_struct_pack')
+def _ahrs_high_struct_pack():
+    # how ahrs_data built the frame before the codec, for comparison
+    def encode():
+        payload = struct.pack('>2s2shhHHhhhhh', b'\x7f\xff', b'\xfe\x00', -1234, 567, 16000, 10000, -250, 1500, 0, 0, 0)
+        return payload + struct.pack('B', ((sum(payload[2:])) & 0xFF) ^ 0XFF)
+    return encode
+
+@benchmark('gps0')
+def _gps0():
+    encoder = codec.InterlinkEncoder()
+    now = datetime.datetime(2020, 6, 1, 12, 30, 15)
+    return lambda: encoder.gps0(20, codec.gps_datetime(now), 47.5, -122.3, 1805, -1520, 1100, 0)
+
+@benchmark('gps3')
+def _gps3():
+    encoder = codec.InterlinkEncoder()
+    now = datetime.datetime(2020, 6, 1, 12, 30, 15)
+    return lambda: encoder.gps3(20, codec.gps_datetime(now))
+
+@benchmark('gps4')
+def _gps4():
+    encoder = codec.InterlinkEncoder()
+    return lambda: encoder.gps4(1250, 0)
+
+@benchmark('eis')
+def _eis():
+    encoder = codec.InterlinkEncoder()
+    cht = [180] * 4 + [0] * 2
+    egt = [650] * 4 + [0] * 5
+    aux = [245, 55, 0, 0, 0, 0]
+    return lambda: encoder.eis(2400, cht, egt, 0, 0, 13.8, 8.5, 0, -100, 0, 60, 90, 75, aux, 0, 123.4, 20.5, 1, 2, 3, 0, 29.92, 0, 0, 59)
+
+
+# Producers, reading the store and encoding, what every scheduler tick costs
+@benchmark('link_ahrs_data')
+def _link_ahrs_data():
+    encoder = codec.AhrsEncoder()
+    return lambda: link.ahrs_data('high', encoder)
+
+@benchmark('link_ahrs_broadcast_3')
+def _link_ahrs_broadcast_3():
+    # one frame encoded once and written to three connected VMs, sockets that take everything
+    seat = session.Session('bench')
+    sender = link.AhrsBroadcaster(('10.0.0.1', '10.0.0.2', '10.0.0.3'), 0, seat)
+    for target in sender.targets:
+        target.sock = NullSocket()
+        target.state = 'up'
+    for index in seat.store.groups['ahrs']:
+        seat.store.stamp[index] = time.monotonic() + 3600      # fresh for the whole run
+    return lambda: sender.send('high')
+
+@benchmark('link_gps0')
+def _link_gps0():
+    return link.gps0
+
+@benchmark('link_eis')
+def _link_eis():
+    return link.eis
+
+
+# X-Plane decoders
+def rref_packet(count):
+    return b'RREF,' + b''.join(struct.pack('<if', i, i * 1.5) for i in range(count))
+
+def rref_loop(data):
+    # decode_packet before the bulk decoder, for comparison
+    retvalues = {}
+    values = data[5:]
+    for i in range(0, int(len(values) / 8)):
+        (idx, value) = struct.unpack('<if', data[(5 + 8 * i):(5 + 8 * (i + 1))])
+        retvalues[idx] = value
+    return retvalues
+
+RPOS_PACKET = struct.pack('<5sdddffffffffff', b'RPOS4', -122.3, 47.5, 1250.0, 300.0, 2.5, 180.0, -3.0, 10.0, 0.5, -40.0, 0.01, 0.02, 0.03)
+
+def rref_decode(count):
+    packet = rref_packet(count)
+    return lambda: xplane.decode_packet(packet)
+
+for count in (1, 10, 45, 127):      # 127 values fill the 1024 bytes rx_thread reads
+    benchmark(f'rref_decode_{count}', 'packets')(lambda count=count: rref_decode(count))
+
+@benchmark('rref_decode_45_loop', 'packets')
+def _rref_decode_loop():
+    packet = rref_packet(45)
+    return lambda: rref_loop(packet)
+
+@benchmark('rref_iter_45', 'packets')
+def _rref_iter():
+    packet = rref_packet(45)
+    return lambda: sum(1 for _ in xplane.decode_rref(packet))
+
+@benchmark('rref_store_all', 'packets')
+def _rref_store():
+    # decode and scatter into the store arrays by RREF index, like rx_thread, one value for every dataref in the store
+    packet = rref_packet(len(xplane.my_data))
+    values = xplane.my_data.values
+    def scatter():
+        for idx, value in xplane.decode_rref(packet):
+            values[idx] = value
+    return scatter
+
+@benchmark('rpos_decode', 'packets')
+def _rpos_decode():
+    return lambda: xplane.decode_packet(RPOS_PACKET)
+
+@benchmark('rpos_store', 'packets')
+def _rpos_store():
+    # RPOS4 straight into the store, the 13 values it replaces RREF for
+    return lambda: xplane.process_rpos(RPOS_PACKET)
+
+@benchmark('rref_store_13', 'packets')
+def _rref_store_13():
+    # the same 13 values over RREF, what RPOS saves
+    packet = b'RREF,' + b''.join(struct.pack('<if', idx, 1.5) for idx in xplane._rpos_index)
+    return lambda: xplane.process_datagram(packet)
+
+@benchmark('rpos_decode_struct_unpack', 'packets')
+def _rpos_decode_unpack():
+    return lambda: struct.unpack('<5sdddffffffffff', RPOS_PACKET)
+
+
+# EFIS
+@benchmark('efis_fanout_3')
+def _efis_fanout():
+    # frame once, deliver to three displays, each display drains its own queue
+    bus = efis.Bus()
+    outboxes = [bus.subscribe() for _ in range(3)]
+    payload = b'\x0212=29.92\x00'
+    def publish():
+        bus.put(('send', payload))
+        for outbox in outboxes:
+            outbox.get_nowait()
+    return publish
+
+
+# EFIS transmit, header, CRC, byte stuffing and flags
+class NullSocket:
+    def sendall(self, data):
+        pass
+
+    def send(self, data):
+        return len(data)
+
+@benchmark('efis_send_data')
+def _efis_send_data():
+    sock = NullSocket()
+    payload = bytes(range(0x70, 0x80)) * 2      # holds 7D and 7E, so it gets stuffed
+    return lambda: efis.send_data(sock, payload)
+
+@benchmark('efis_encode_frame')
+def _efis_encode_frame():
+    payload = b'\x0212=29.92\x003=3.14\x00'
+    return lambda: efis.encode_frame(payload)
+
+
+# EFIS state variables, a burst of knob changes through process_packet to the DREFs for X-Plane
+class NullQueue:
+    def put(self, item):
+        pass
+
+@benchmark('efis_statevar_burst_20', 'packets')
+def _efis_statevar_burst():
+    seat = session.Session('bench')
+    seat.xplane_q = NullQueue()     # the DREFs would pile up with no X-Plane to send them to, xplane.q is left alone
+    # heading bug, altitude and baro changed over and over in one packet
+    records = ([(3, 1.5708), (4, 5500), (12, 2992)] * 7)[:20]
+    packet = b'\x02' + b''.join(f'{index}={value}'.encode() + b'\x00' for index, value in records)
+    return lambda: efis.process_packet(packet, None, seat)
+
+
+# CRC-16/X.25, per frame cost of each backend on a typical state variable frame
+CRC_FRAME = b'\x5b\x10\xff\x0a\x0212=29.92\x003=3.14\x00'
+
+@benchmark('crc_crcmod')
+def _crc_crcmod():
+    func = crc.BACKENDS['crcmod']
+    return lambda: func(CRC_FRAME)
+
+@benchmark('crc_crcmod_object')
+def _crc_crcmod_object():
+    # a new predefined Crc object per packet, how send_data and read_buffer used to do it
+    import crcmod.predefined
+    def checksum():
+        crc16 = crcmod.predefined.Crc('x-25')
+        crc16.update(CRC_FRAME)
+        return crc16.crcValue
+    return checksum
+
+@benchmark('crc_table')
+def _crc_table():
+    return lambda: crc.crc16_table(CRC_FRAME)
+
+@benchmark('crc_check_frames_100')
+def _crc_check_frames():
+    frames = [bytes(crc.append_crc(bytearray(CRC_FRAME)))] * 100
+    return scaled(lambda: crc.check_frames(frames), 100)
+
+
+# EFIS receive, a burst of back to back frames with escaped bytes fed in recv sized pieces
+def efis_stream(frames=200):
+    payloads = [b'\x0212=29.92\x003=3.14\x00', bytes(range(0x70, 0x80)) * 2, b'\x09\x00' + bytes(20)]
+    return b''.join(efis.encode_frame(payloads[i % len(payloads)]) for i in range(frames))
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+@benchmark('efis_deframer', 'MB')
+def _efis_deframer():
+    stream = efis_stream()
+    pieces = chunks(stream, 1024)
+    def deframe():
+        deframer = efis.Deframer()
+        for piece in pieces:
+            deframer.feed(piece)
+    return scaled(deframe, len(stream))
+
+@benchmark('efis_deframer_fragmented', 'MB')
+def _efis_deframer_fragmented():
+    stream = efis_stream()
+    pieces = chunks(stream, 7)
+    def deframe():
+        deframer = efis.Deframer()
+        for piece in pieces:
+            deframer.feed(piece)
+    return scaled(deframe, len(stream))
+
+@benchmark('efis_read_buffer_fragmented', 'MB')
+def _efis_read_buffer_fragmented():
+    return read_buffer(efis_stream(), 7)
+
+@benchmark('efis_read_buffer', 'MB')
+def _efis_read_buffer():
+    return read_buffer(efis_stream(), 1024)
+
+@benchmark('efis_deframer_burst', 'MB')
+def _efis_deframer_burst():
+    # a backlog of frames arriving in one large read
+    stream = efis_stream(4000)
+    def deframe():
+        efis.Deframer().feed(stream)
+    return scaled(deframe, len(stream))
+
+@benchmark('efis_read_buffer_burst', 'MB')
+def _efis_read_buffer_burst():
+    return read_buffer(efis_stream(4000), 1 << 20)
+
+def read_buffer(stream, size):
+    pieces = chunks(stream, size)
+    def deframe():
+        buffer = bytearray()
+        for piece in pieces:
+            buffer.extend(piece)
+            for packet in efis.read_buffer(buffer):
+                pass
+    return scaled(deframe, len(stream))
+
+
+# Engines, X-Plane datagrams over loopback into the threaded or the asyncio receive path
+def rx_engine(start, count=4000, rate=2000):
+    # value is the sequence number so each datagram's latency can be matched to its send time
+    sent = [0.0] * count
+    latency = []
+    done = threading.Event()
+    process_datagram = xplane.process_datagram
+    roll = xplane.my_data.index('roll')
+
+    def timed(packet, session=None):
+        received = time.perf_counter()
+        (idx, seq) = struct.unpack_from('<if', packet, 5)
+        latency.append(received - sent[int(seq) - 1])
+        process_datagram(packet, session)
+        if len(latency) == count:
+            done.set()
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(('127.0.0.1', 0))
+    xplane.process_datagram = timed
+    try:
+        addr, stop = start({'ip': '127.0.0.1', 'port': sender.getsockname()[1]})
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        for seq in range(count):
+            sent[seq] = time.perf_counter()
+            sender.sendto(b'RREF,' + struct.pack('<if', roll, seq + 1), addr)
+            while time.perf_counter() - wall < (seq + 1) / rate:
+                time.sleep(0.0002)
+        done.wait(5)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        stop()
+    finally:
+        xplane.process_datagram = process_datagram
+        sender.close()
+
+    latency.sort()
+    return {'packets': len(latency), 'cpu_pct': cpu / wall * 100,
+            'p50_usec': latency[len(latency) // 2] * 1e6, 'p99_usec': latency[int(len(latency) * 0.99)] * 1e6}
+
+@scenario('rx_engine_thread')
+def _rx_engine_thread():
+    def start(beacon):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        threading.Thread(target=xplane.rx_thread, args=(sock,), daemon=True).start()
+        return sock.getsockname(), sock.close
+    return rx_engine(start)
+
+@scenario('rx_engine_asyncio')
+def _rx_engine_asyncio():
+    import aio
+
+    def start(beacon):
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        endpoint = loop.create_datagram_endpoint(lambda: aio.XPlaneProtocol(beacon), local_addr=('127.0.0.1', 0))
+        transport, protocol = asyncio.run_coroutine_threadsafe(endpoint, loop).result()
+
+        def stop():
+            loop.call_soon_threadsafe(transport.close)
+            loop.call_soon_threadsafe(loop.stop)
+        return transport.get_extra_info('sockname'), stop
+    return rx_engine(start)
+
+
+# One-shot reads, many concurrent xplane.read_ref against a fake X-Plane that answers every RREF request once
+def fake_xplane(sock):
+    # value sent back is the length of the requested ref, so answers can be checked
+    while True:
+        try:
+            message, addr = sock.recvfrom(1024)
+        except OSError:
+            return
+        if message[0:5] == b'RREF\x00':
+            freq, index, ref = struct.unpack('<5sii400s', message)[1:]
+            if freq:
+                sock.sendto(b'RREF,' + struct.pack('<if', index, len(ref.rstrip(b'\x00'))), addr)
+
+@scenario('one_shot_reads')
+def _one_shot_reads(count=50):
+    fake = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    fake.bind(('127.0.0.1', 0))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    stop = threading.Event()
+    threading.Thread(target=fake_xplane, args=(fake,), daemon=True).start()
+    threading.Thread(target=xplane.rx_thread, args=(sock,), daemon=True).start()
+    threading.Thread(target=xplane.subscriptions.run, args=(stop,), daemon=True).start()
+    try:
+        xplane.load_refs(sock, {'ip': '127.0.0.1', 'port': fake.getsockname()[1]})
+        refs = [f'sim/bench/read_{n}' + 'x' * n for n in range(count)]
+        start = time.perf_counter()
+        futures = [xplane.read_ref(ref) for ref in refs]
+        values = [future.result() for future in futures]
+        wall = time.perf_counter() - start
+    finally:
+        stop.set()
+        sock.close()
+        fake.close()
+
+    wrong = sum(value != len(ref) for ref, value in zip(refs, values))
+    return {'reads': len(values), 'wrong': wrong, 'msec': wall * 1e3}
+
+
+# Seats on 1 to N worker processes, each decoding RREF packets into its own SharedTable and
+# framing an eis payload per packet, see shard.py. Aggregate packets a second for every count.
+def shard_seat(start, seconds, counts):
+    seat = session.Session('bench')
+    table = datarefs.SharedTable.create()
+    seat.store.share(table)
+    packets = (rref_packet(len(seat.store)), b'RREF,' + b''.join(struct.pack('<if', i, i * 2.5) for i in range(len(seat.store))))
+    while time.monotonic() < start:
+        time.sleep(0.001)
+    n = 0
+    end = start + seconds
+    while time.monotonic() < end:
+        xplane.process_datagram(packets[n & 1], seat)
+        efis.encode_frame(link.eis(seat))
+        n += 1
+    counts.put(n)
+    table.close(unlink=True)
+
+@scenario('shard_scaling')
+def _shard_scaling(seconds=2):
+    result = {}
+    counts = multiprocessing.Queue()
+    for workers in range(1, (os.cpu_count() or 1) + 1):
+        start = time.monotonic() + 0.5        # all of them start together, after the imports
+        processes = [multiprocessing.Process(target=shard_seat, args=(start, seconds, counts)) for n in range(workers)]
+        for process in processes:
+            process.start()
+        total = sum(counts.get() for process in processes)
+        for process in processes:
+            process.join()
+        result[f'workers_{workers}_per_sec'] = total / seconds
+    result['speedup'] = result[f'workers_{workers}_per_sec'] / result['workers_1_per_sec']
+    return result
+
+
+# Serial AHRS and GPS through a pty pair at each baud rate, attitude asked for at SERIAL_HIGH_HZ
+# so the slower lines can't carry it all. A pty doesn't hold writes to the baud rate, the
+# BaudBudget is what paces them, the reader checks every frame arrives whole.
+SERIAL_HIGH_HZ = 100
+
+@scenario('serial_pty')
+def _serial_pty(seconds=3):
+    seat = session.Session('bench')
+    for index in range(len(seat.store)):
+        seat.store.stamp[index] = time.monotonic() + 3600      # fresh for the whole run
+    result = {}
+    for baud in (9600, 38400, 115200):
+        master, slave = os.openpty()
+        port = serial.Serial(os.ttyname(slave), baud, write_timeout=0)
+        sink = link.SerialSink(port, baud, session=seat, high_hz=SERIAL_HIGH_HZ)
+        received = bytearray()
+        stop = threading.Event()
+
+        def read():
+            # until the slave side closes and the master reads EIO
+            try:
+                while True:
+                    received.extend(os.read(master, 65536))
+            except OSError:
+                pass
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        threading.Timer(seconds, stop.set).start()
+        sink.scheduler().run(stop)
+        port.close()
+        os.close(slave)
+        reader.join()
+        os.close(master)
+
+        high = received.count(codec.AHRS_HIGH_HEADER)
+        rmc = received.count(b'$GPRMC')
+        result[f'b{baud}_high_hz'] = high / seconds
+        result[f'b{baud}_low_hz'] = received.count(codec.AHRS_LOW_PAYLOAD) / seconds
+        result[f'b{baud}_gps_hz'] = rmc / seconds
+        result[f'b{baud}_line_pct'] = len(received) / seconds / (baud / link.SERIAL_BITS) * 100
+        result[f'b{baud}_backlog_max_ms'] = sink.stats()['backlog_max_ms']
+        result[f'b{baud}_lost'] = sum(sink.sent.values()) - high - rmc - received.count(b'$GPGGA') - received.count(codec.AHRS_LOW_PAYLOAD)
+    return result
+
+
+# End to end, the threaded bridge between emulators.FakeXPlane and a FakeEfis on loopback.
+# The bridge threads can't be stopped, so this is run last and only once per process.
+@scenario('end_to_end')
+def _end_to_end(seconds=3):
+    sim = emulators.FakeXPlane(rate=50).start()
+    display = emulators.FakeEfis('127.0.0.2').start()
+    threading.Thread(target=xplane.xplane, daemon=True).start()
+    threading.Thread(target=efis.efis, daemon=True).start()
+    threading.Thread(target=link.link, args=((), 0), daemon=True).start()
+
+    deadline = time.monotonic() + 10
+    while display.types.get(0x09) is None and time.monotonic() < deadline:      # first GPS frame through
+        time.sleep(0.05)
+    cpu = time.process_time()
+    start = time.perf_counter()
+    values, frames = sim.sent_values, display.frames
+    time.sleep(seconds)
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu     # emulators included, they run in this process too
+    return {'xplane_values_per_sec': (sim.sent_values - values) / wall,
+            'efis_frames_per_sec': (display.frames - frames) / wall,
+            'bad_frames': display.bad_frames, 'cpu_pct': cpu / wall * 100}
+
+
+# AHRS pacing, 2 seconds of frames that each take ~2 ms to encode and send
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+@scenario('ahrs_scheduler')
+def _ahrs_scheduler():
+    stop = threading.Event()
+    schedule = link.ahrs_scheduler(lambda task: busy(0.002))
+    threading.Timer(2, stop.set).start()
+    schedule.run(stop)
+    return schedule.stats()['high']
+
+@scenario('ahrs_sleep_loop')
+def _ahrs_sleep_loop():
+    # send then sleep(0.05), how link.ahrs paced frames before the scheduler
+    sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < 2:
+        busy(0.002)
+        sent += 1
+        time.sleep(0.05)
+    return {'hz': sent / (time.perf_counter() - start), 'sent': sent}
+
+
+# keys of a result that regress when they go down or up, the rest are informational
+HIGHER = ('per_sec', 'hz')
+LOWER = ('usec', '_ms', 'msec', 'cpu_pct', 'wrong', 'bad_frames', 'missed', 'errors', 'lost')
+
+
+def compare(results, baseline, tolerance):
+    # regressions as (name, key, baseline value, new value)
+    regressions = []
+    for name, result in results.items():
+        for key, value in result.items():
+            old = baseline.get(name, {}).get(key)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            if key.endswith(HIGHER) and value < old * (1 - tolerance):
+                regressions.append((name, key, old, value))
+            elif key.endswith(LOWER) and value > old * (1 + tolerance) and value - old > 1e-9:
+                regressions.append((name, key, old, value))
+    return regressions
+
+
+def select(names):
+    # exact names or prefixes, scenarios after the benchmarks, end_to_end last
+    everything = list(BENCHMARKS) + sorted(SCENARIOS, key=lambda name: name == 'end_to_end')
+    if not names:
+        return everything
+    return [name for name in everything if any(name == n or name.startswith(n) for n in names)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bridge benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmarks or scenarios to run, or prefixes of their names, default all')
+    parser.add_argument('--json', metavar='PATH', help='write the results as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='JSON from an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed change before it counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in select(args.names):
+        if name in SCENARIOS:
+            result = SCENARIOS[name]()
+            print(f"{name:<28} " + ' '.join(f'{key}={value:,.1f}' for key, value in result.items()))
+        else:
+            result = run(name)
+            print(f"{result['name']:<28} {result['per_sec']:>14,.{2 if result['unit'] == 'MB' else 0}f} {result['unit']}/sec {result['usec']:>10.3f} usec")
+        results[name] = result
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'crc': crc.BACKEND,
+                       'time': datetime.datetime.now().isoformat(timespec='seconds'), 'results': results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, key, old, new in regressions:
+            print(f'REGRESSION {name} {key}: {old:,.3f} -> {new:,.3f}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.compare}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+'''Record and replay the raw X-Plane and EFIS streams
+
+Recording appends every X-Plane datagram and EFIS TCP chunk, received or sent, and the UDP
+hellos sent to the displays, to a binary log. Every send goes through xplane.send_to,
+efis.send_data or the frame writes of an EFIS connection, and each of those records it.
+Each record is a RECORD header followed by the raw bytes:
+    t           time.monotonic() when it was received or sent, seconds
+    source      XPLANE, EFIS or RUN
+    direction   RX or TX
+    peer        IPv4 address of the other end, 4 bytes
+    length      byte count of the data that follows
+
+Every Recorder writes a RUN record, no data, before anything else. The log is appended to, so
+one file can hold several runs, each on its own monotonic clock; a RUN record starts a new one.
+
+Replaying maps the log with mmap and feeds the received records back through
+xplane.process_datagram and efis.Deframer/process_packet, at the recorded pace, N times
+faster or as fast as possible, every run from its own first record. A record or packet that
+fails to decode is counted in errors and skipped. Nothing needs to be connected.
+
+Record: python main.py --record flight.xlog
+Replay: python capture.py flight.xlog [speed]        speed 0 = as fast as possible
+'''
+
+import atexit
+import mmap
+import socket
+import struct
+import sys
+import threading
+import time
+
+
+MAGIC = b'XLOG\x01\x00\x00\x00'
+RECORD = struct.Struct('<dBB4sI')      # t, source, direction, peer, length
+
+XPLANE = 0
+EFIS = 1
+RUN = 2                 # a recording run starts here, the times that follow are on its clock
+RX = 0
+TX = 1
+
+recorder = None         # the Recorder while recording, the I/O paths check it before writing
+
+
+class Recorder:
+    '''Append only log writer, shared by every socket thread'''
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        self.lock = threading.Lock()
+        self.records = 0
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.write(RUN, RX, b'')
+
+    def write(self, source, direction, data, peer='0.0.0.0'):
+        header = RECORD.pack(time.monotonic(), source, direction, socket.inet_aton(peer), len(data))
+        with self.lock:
+            self.file.write(header)
+            self.file.write(data)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def record(path):
+    # start recording, the I/O paths pick it up straight away
+    global recorder
+    recorder = Recorder(path)
+    atexit.register(stop)       # flush what is buffered when the bridge exits
+    return recorder
+
+
+def stop():
+    global recorder
+    if recorder is not None:
+        rec, recorder = recorder, None
+        rec.close()
+
+
+def read(mm):
+    # yields (t, source, direction, peer, data) for every whole record, data is a memoryview into mm
+    if mm[0:len(MAGIC)] != MAGIC:
+        raise ValueError('Capture: not a capture log')
+    view = memoryview(mm)
+    pos = len(MAGIC)
+    size = len(mm)
+    try:
+        while pos + RECORD.size <= size:
+            t, source, direction, peer, length = RECORD.unpack_from(mm, pos)
+            pos += RECORD.size
+            if pos + length > size:
+                break                   # cut short while it was being written
+            data = view[pos:pos + length]
+            yield t, source, direction, socket.inet_ntoa(peer), data
+            data.release()
+            pos += length
+    finally:
+        view.release()
+
+
+def replay(path, speed=1.0):
+    '''Feed a log's received records back into the decode paths, speed 0 = as fast as possible'''
+    import efis
+    import xplane
+
+    deframers = {}              # peer -> efis.Deframer, the TCP stream is deframed per EFIS like it was live
+    counts = {'runs': 0, 'xplane': 0, 'efis': 0, 'efis_packets': 0, 'bytes': 0, 'errors': 0}
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        first = last = None
+        recorded = 0.0          # seconds of the runs before this one
+        start = began = time.perf_counter()
+        records = read(mm)
+        try:
+            for t, source, direction, peer, data in records:
+                if source == RUN:
+                    # another bridge run, its clock has nothing to do with the last one's
+                    counts['runs'] += 1
+                    if first is not None:
+                        recorded += last - first
+                    first = None
+                    start = time.perf_counter()
+                    deframers.clear()           # the TCP connections were new too
+                    continue
+                if direction != RX:
+                    continue
+                if first is None:
+                    first = t
+                last = t
+                if speed:
+                    wait = (t - first) / speed - (time.perf_counter() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+
+                counts['bytes'] += len(data)
+                if source == XPLANE:
+                    counts['xplane'] += 1
+                    try:
+                        xplane.process_datagram(data)
+                    except Exception as e:
+                        # a record this tree can't decode, an index from another dataref list say
+                        counts['errors'] += 1
+                        print(f'Capture: xplane record at {t:.3f}: {type(e).__name__} = {e}')
+                else:
+                    counts['efis'] += 1
+                    deframer = deframers.get(peer)
+                    if deframer is None:
+                        deframer = deframers[peer] = efis.Deframer(peer)
+                    for packet in deframer.feed(bytes(data)):
+                        counts['efis_packets'] += 1
+                        try:
+                            efis.process_packet(packet)
+                        except Exception as e:
+                            counts['errors'] += 1
+                            print(f'Capture: efis packet at {t:.3f}: {type(e).__name__} = {e}')
+        finally:
+            records.close()     # let go of the mmap before it closes
+
+        counts['seconds'] = time.perf_counter() - began
+        counts['recorded_seconds'] = recorded + (last - first if first is not None else 0.0)
+    return counts
+
+
+if __name__ == '__main__':
+    result = replay(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
+    print(' '.join(f'{key}={value:,.3f}' if isinstance(value, float) else f'{key}={value:,}' for key, value in result.items()))
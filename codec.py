@@ -0,0 +1,171 @@
+'''Precompiled frame encoders for the AHRS stream and the EFIS interlink payloads, and NMEA GPS sentences
+
+Every frame layout is compiled once into struct.Struct objects and packed with pack_into
+straight into a buffer owned by the encoder, so nothing is parsed or allocated per frame.
+The buffers are reused on every call: send them right away, or take a bytes() copy if the
+frame has to sit in a queue.
+'''
+
+import struct
+
+
+# AHRS
+AHRS_HIGH_HEADER = b'\x7f\xff\xfe\x00'          # header + high rate identifier
+AHRS_LOW_PAYLOAD = b'\x7f\xff\xfd\x00\x05\xa1\x05\xa2\x05\xa3\x00\x00\x00\x64\x00\x2b\x00\x00\x00\x00'
+AHRS_SCALE = 32767 / 180                         # scale factor for pitch, roll, yaw
+
+_ahrs_high = struct.Struct('>hhHHhhhhh')        # roll, pitch, yaw, alt, vspeed, vind, airspeed rate, accel roll rate, accel normal rate
+AHRS_HIGH_SIZE = len(AHRS_HIGH_HEADER) + _ahrs_high.size + 1
+AHRS_LOW_SIZE = len(AHRS_LOW_PAYLOAD) + 1
+
+
+def ahrs_checksum(payload):
+    # sum of everything past the 0x7fff header, inverted
+    return (sum(payload[2:]) & 0xFF) ^ 0xFF
+
+
+# Interlink GPS and EIS
+_gps_time = struct.Struct('<I')                  # packed date/time bits, LSB first
+_gps_position = struct.Struct('<ff')             # latitude, longitude
+_gps_track = struct.Struct('>HhHb')              # track, mag var, ground speed, bit field
+_gps_altitude = struct.Struct('<ff')             # gps altitude, geoidal difference
+
+_eis_engine = struct.Struct('>H6H9HH')           # rpm, cht[6], egt[9], airspeed
+_eis_volts = struct.Struct('<fff')               # altimeter, volts, fuel flow
+_eis_temps = struct.Struct('>bbfhHB')            # internal temp, manifold temp, vertical speed, oat, oil temp, oil pressure
+_eis_aux = struct.Struct('>hhhhhhH')             # aux[6], coolant temp
+_eis_hobbs = struct.Struct('<ff')                # hobbs, fuel qty
+_eis_timers = struct.Struct('>BBBH')             # flight hrs, min, sec, fuel flow time
+_eis_baro = struct.Struct('<f')                  # baro pressure
+_eis_trailer = struct.Struct('>BHH')             # save bits, rpm2, eis version
+
+GPS0_SIZE = 3 + _gps_time.size + _gps_position.size + _gps_track.size
+GPS3_SIZE = 4 + _gps_time.size
+GPS4_SIZE = 5 + _gps_altitude.size
+
+# offsets into the EIS frame, one byte of packet type first
+_EIS_ENGINE = 1
+_EIS_VOLTS = _EIS_ENGINE + _eis_engine.size
+_EIS_TEMPS = _EIS_VOLTS + _eis_volts.size
+_EIS_AUX = _EIS_TEMPS + _eis_temps.size
+_EIS_HOBBS = _EIS_AUX + _eis_aux.size
+_EIS_TIMERS = _EIS_HOBBS + _eis_hobbs.size
+_EIS_BARO = _EIS_TIMERS + _eis_timers.size
+_EIS_TRAILER = _EIS_BARO + _eis_baro.size
+EIS_SIZE = _EIS_TRAILER + _eis_trailer.size
+
+
+def gps_datetime(now):
+    '''Packs a datetime into the GPS uint32:
+    month (4 bits) | day (5 bits) | hour (5 bits) | min (6 bits) | sec (6 bits) | status (1 bit), LSB first
+    '''
+    return (now.month | now.day << 4 | now.hour << 9 | now.minute << 14 | now.second << 20 | 1 << 26)
+
+
+class AhrsEncoder:
+    '''Reusable AHRS frame buffers, keep one per output stream'''
+    __slots__ = ('high', 'low', '_body')
+
+    def __init__(self):
+        self.high = bytearray(AHRS_HIGH_SIZE)
+        self.high[0:4] = AHRS_HIGH_HEADER
+        self._body = memoryview(self.high)[2:AHRS_HIGH_SIZE - 1]
+
+        # low rate frame never changes, so the checksum is only worked out once
+        self.low = AHRS_LOW_PAYLOAD + bytes((ahrs_checksum(AHRS_LOW_PAYLOAD),))
+
+    def encode_high(self, roll, pitch, yaw, alt, vspeed, vind, airspeed_rate=0, accel_roll_rate=0, accel_normal_rate=0):
+        # values are already scaled to the wire units
+        buf = self.high
+        _ahrs_high.pack_into(buf, 4, roll, pitch, yaw, alt, vspeed, vind, airspeed_rate, accel_roll_rate, accel_normal_rate)
+        buf[-1] = (sum(self._body) & 0xFF) ^ 0xFF
+        return buf
+
+    def encode_low(self):
+        return self.low
+
+
+class InterlinkEncoder:
+    '''Reusable buffers for the GPS (0x09) and EIS (0x0F) interlink payloads'''
+    __slots__ = ('gps0_buf', 'gps3_buf', 'gps4_buf', 'eis_buf')
+
+    def __init__(self):
+        self.gps0_buf = bytearray(GPS0_SIZE)
+        self.gps0_buf[0:2] = b'\x09\x00'         # Packet Type, 00 = GPS position packet
+
+        self.gps3_buf = bytearray(GPS3_SIZE)
+        self.gps3_buf[0:3] = b'\x09\x03\x00'     # Packet Type, 03 = time/date, GPS source
+
+        self.gps4_buf = bytearray(GPS4_SIZE)
+        self.gps4_buf[0:5] = b'\x09\x04\x03\x00\x05'     # Packet Type, 04 = altitude, Auto Fix 3D, GPS source, SatInCalculation
+
+        self.eis_buf = bytearray(EIS_SIZE)
+        self.eis_buf[0] = 0x0F                   # Packet Type = EIS1 0x0F    EIS2 0x27
+
+    def gps0(self, year, timebits, latitude, longitude, track, magvar, gndspeed, bits=0):
+        buf = self.gps0_buf
+        buf[2] = year
+        _gps_time.pack_into(buf, 3, timebits)
+        _gps_position.pack_into(buf, 7, latitude, longitude)
+        _gps_track.pack_into(buf, 15, track, magvar, gndspeed, bits)
+        return buf
+
+    def gps3(self, year, timebits):
+        buf = self.gps3_buf
+        buf[3] = year
+        _gps_time.pack_into(buf, 4, timebits)
+        return buf
+
+    def gps4(self, altitude, geoidal=0):
+        buf = self.gps4_buf
+        _gps_altitude.pack_into(buf, 5, altitude, geoidal)
+        return buf
+
+    def eis(self, rpm, cht, egt, airspeed, altimeter, volts, fuelflow, internaltemp, manifoldtemp, verticalspeed,
+            oat, oiltemp, oilpressure, aux, coolanttemp, hobbs, fuelqty, flight_hrs, flight_min, flight_sec,
+            fuelflowtime, baropressure, savebit, rpm2, eisver):
+        # cht is 6 values, egt is 9 values and aux is 6 values
+        buf = self.eis_buf
+        _eis_engine.pack_into(buf, _EIS_ENGINE, rpm, *cht, *egt, airspeed)
+        _eis_volts.pack_into(buf, _EIS_VOLTS, altimeter, volts, fuelflow)
+        _eis_temps.pack_into(buf, _EIS_TEMPS, internaltemp, manifoldtemp, verticalspeed, oat, oiltemp, oilpressure)
+        _eis_aux.pack_into(buf, _EIS_AUX, *aux, coolanttemp)
+        _eis_hobbs.pack_into(buf, _EIS_HOBBS, hobbs, fuelqty)
+        _eis_timers.pack_into(buf, _EIS_TIMERS, flight_hrs, flight_min, flight_sec, fuelflowtime)
+        _eis_baro.pack_into(buf, _EIS_BARO, baropressure)
+        _eis_trailer.pack_into(buf, _EIS_TRAILER, savebit, rpm2, eisver)
+        return buf
+
+
+# NMEA 0183 GPS sentences, for a serial GPS input. Text, so they are formatted, not packed
+NMEA_MAX_SIZE = 82                               # longest sentence the standard allows, with $ and CRLF
+
+
+def nmea(body):
+    # $ + body + * + checksum + CRLF, the checksum is the XOR of the body bytes
+    check = 0
+    for c in body:
+        check ^= c
+    return b'$%s*%02X\r\n' % (body, check)
+
+
+def _nmea_angle(value, degrees, positive, negative):
+    # decimal degrees to ddmm.mmmm,H (dddmm.mmmm for longitude)
+    hemisphere = positive if value >= 0 else negative
+    value = abs(value)
+    whole = int(value)
+    return b'%0*d%07.4f,%s' % (degrees, whole, (value - whole) * 60, hemisphere)
+
+
+def gprmc(now, latitude, longitude, knots, track, magvar):
+    # position, speed and track, magvar positive west like the interlink gps0
+    return nmea(b'GPRMC,%s,A,%s,%s,%.1f,%.1f,%s,%.1f,%s' % (
+        now.strftime('%H%M%S.00').encode(), _nmea_angle(latitude, 2, b'N', b'S'), _nmea_angle(longitude, 3, b'E', b'W'),
+        knots, track % 360, now.strftime('%d%m%y').encode(), abs(magvar), b'W' if magvar >= 0 else b'E'))
+
+
+def gpgga(now, latitude, longitude, altitude, satellites=8):
+    # fix, GPS quality 1, altitude in meters
+    return nmea(b'GPGGA,%s,%s,%s,1,%02d,1.0,%.1f,M,0.0,M,,' % (
+        now.strftime('%H%M%S.00').encode(), _nmea_angle(latitude, 2, b'N', b'S'), _nmea_angle(longitude, 3, b'E', b'W'),
+        satellites, altitude))
@@ -0,0 +1,76 @@
+'''CRC-16/X.25 for the EFIS interlink, shared by the transmit and receive paths
+
+Picks the fastest backend available once at import:
+    crcmod      crcmod's precompiled x-25 function, backed by its C extension
+    table       pure python, 256 entry table worked out once at import
+
+crc16(data) gives the checksum of a bytes-like object, check_frames() verifies a batch.
+crc16(frame) == RESIDUE checks a frame with its checksum still on, without slicing it off.
+'''
+
+try:
+    import crcmod.predefined        # CRC16.X25
+except ImportError:
+    crcmod = None
+
+try:
+    from crcmod import _crcfunext   # only there when crcmod's C extension is built
+except ImportError:
+    _crcfunext = None
+
+
+X25_POLY = 0x8408               # 0x1021 reflected
+X25_INIT = 0xFFFF
+X25_XOROUT = 0xFFFF
+
+
+def _make_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ X25_POLY if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+TABLE = _make_table()
+
+
+def crc16_table(data, crc=X25_INIT ^ X25_XOROUT):
+    # crc can be a previous result, to carry on over more data
+    crc ^= X25_XOROUT
+    table = TABLE
+    for byte in bytes(data):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc ^ X25_XOROUT
+
+
+BACKENDS = {'table': crc16_table}
+if crcmod is not None:
+    # one function, built once, instead of a predefined lookup and a Crc object for every packet
+    BACKENDS['crcmod'] = crcmod.predefined.mkPredefinedCrcFun('x-25')
+
+BACKEND = 'crcmod' if 'crcmod' in BACKENDS and _crcfunext is not None else 'table'
+crc16 = BACKENDS[BACKEND]
+
+
+def append_crc(packet):
+    # checksum goes on the end, LSB first
+    packet.extend(crc16(packet).to_bytes(2, 'little'))
+    return packet
+
+
+# CRC taken over a frame and its own checksum, the same for every good frame
+RESIDUE = crc16(append_crc(bytearray(1)))
+
+
+def check(frame):
+    # last two bytes are checksum
+    return crc16(frame[:-2]) == int.from_bytes(frame[-2:], 'little')
+
+
+def check_frames(frames):
+    '''Verify many unescaped frames (header + payload + checksum) in one call, returns a list of bools'''
+    func = crc16
+    from_bytes = int.from_bytes
+    return [len(frame) > 2 and func(frame[:-2]) == from_bytes(frame[-2:], 'little') for frame in frames]
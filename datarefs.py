@@ -0,0 +1,283 @@
+'''Dataref store shared by the X-Plane link and the payload encoders
+
+Static metadata for each dataref lives in a slotted Dataref descriptor. The live data
+lives in typed arrays laid out by RREF index, so the receive thread can go from the index
+in a packet straight to the value without any name or dict lookups.
+
+A store can move its values and stamps into a SharedTable, a multiprocessing shared memory
+block with the same layout, so other processes can read them live, see shard.py.
+'''
+
+import math
+import struct
+import threading
+import time
+from array import array
+from multiprocessing import shared_memory
+
+
+RECYCLE_DELAY = 2.0     # seconds a removed dataref's RREF index rests before it is handed out again
+FRESH_AGE = 1.0         # seconds since X-Plane last sent a value for it to still count as fresh
+SHARED_SLOTS = 256      # RREF indexes a SharedTable has room for
+SHARED_NAMES = 16384    # bytes of a SharedTable's name directory
+
+
+def statevar_key(number):
+    # EFIS state variables are ints, except the 25.x autopilot modes, so 25 + 1/10 finds 25.1
+    return round(number, 1)
+
+
+class Dataref:
+    '''Static description of one dataref, index is its RREF index in the store'''
+    __slots__ = ('store', 'index', 'name', 'efis', 'ref', 'freq', 'cmd')
+
+    def __init__(self, store, index, name, efis, ref, freq, cmd):
+        self.store = store
+        self.index = index      # RREF index, position in the store arrays
+        self.name = name        # variable name
+        self.efis = efis        # index of EFIS state variables
+        self.ref = ref          # string of Xplane data reference
+        self.freq = freq        # how many times a second to get data from xplane
+        self.cmd = cmd          # variable could be a command for EFIS to run on xplane
+
+    @property
+    def value(self):
+        return self.store.get(self.index)
+
+    @property
+    def perc(self):
+        return self.store.perc[self.index]
+
+    def __repr__(self):
+        return f'Dataref({self.index}, {self.name!r}, {self.ref!r})'
+
+
+class DatarefStore:
+    '''Datarefs addressed by RREF index
+
+        values = holds the value of variable
+        perc = precision of the decimal place, -1 = don't round, 0 = int
+        lock = time.monotonic() until which xplane is blocked from re-updating the value after efis has just updated it
+        stamp = time.monotonic() the value was last received or set, 0 = never
+        changes = how many times the value has been updated
+
+    Datarefs can be grouped by what needs them. A group's ready event is set once every dataref
+    in it has been received, producers wait on it instead of polling for data.
+
+    Removing a dataref leaves its slot locked forever, so anything X-Plane still sends for
+    it is ignored, and the index is only reused after RECYCLE_DELAY.
+    '''
+
+    def __init__(self):
+        self.refs = []              # Dataref descriptors in RREF index order, None for a removed one
+        self.names = {}             # name -> RREF index
+        self.statevars = {}         # EFIS state variable number -> RREF index, first registered wins
+        self.values = array('d')
+        self.perc = array('b')
+        self.lock = array('d')
+        self.stamp = array('d')
+        self.changes = array('L')
+        self.free = []              # (time.monotonic() it can be reused, index) of removed datarefs
+        self.groups = {}            # group name -> tuple of RREF indexes
+        self.ready = {}             # group name -> threading.Event, set once the whole group has been received
+        self.waiting = False        # any ready event still unset, checked by check_ready()
+        self.table = None           # SharedTable holding values and stamp, once share() has run
+
+    def add(self, name, efis=0, ref='', freq=0, perc=-1, cmd=''):
+        if name in self.names:
+            raise IndexError(f'DatarefStore: {name} is already in the store')
+
+        if self.free and self.free[0][0] <= time.monotonic():
+            reuse, index = self.free.pop(0)
+            self.refs[index] = Dataref(self, index, name, efis, ref, freq, cmd)
+            self.values[index] = 0
+            self.perc[index] = perc
+            self.lock[index] = 0
+            self.stamp[index] = 0
+            self.changes[index] = 0
+        else:
+            index = len(self.refs)
+            if self.table is not None and index >= self.table.slots:
+                raise IndexError(f'DatarefStore: no room for {name} in the shared table')
+            self.refs.append(Dataref(self, index, name, efis, ref, freq, cmd))
+            if self.table is None:
+                self.values.append(0)
+                self.stamp.append(0)
+            else:
+                self.values[index] = 0
+                self.stamp[index] = 0
+            self.perc.append(perc)
+            self.lock.append(0)
+            self.changes.append(0)
+
+        self.names[name] = index
+        if efis:
+            self.statevars.setdefault(statevar_key(efis), index)
+        if self.table is not None:
+            self.table.write_names(self.refs)
+        return index
+
+    def remove(self, name):
+        index = self.index(name)
+        data = self.refs[index]
+        del self.names[data.name]
+        if data.efis and self.statevars.get(statevar_key(data.efis)) == index:
+            del self.statevars[statevar_key(data.efis)]
+
+        self.refs[index] = None
+        self.lock[index] = math.inf
+        self.free.append((time.monotonic() + RECYCLE_DELAY, index))
+        if self.table is not None:
+            self.table.write_names(self.refs)
+        return data
+
+    def share(self, table):
+        # move values and stamp into a SharedTable, the arrays are swapped for views of it
+        if len(self.refs) > table.slots:
+            raise IndexError(f'DatarefStore: {len(self.refs)} datarefs, the shared table has room for {table.slots}')
+        table.values[:len(self.values)] = self.values
+        table.stamp[:len(self.stamp)] = self.stamp
+        self.values = table.values
+        self.stamp = table.stamp
+        self.table = table
+        table.write_names(self.refs)
+
+    def index(self, key):
+        # RREF index from a name, ints pass straight through
+        if isinstance(key, int):
+            return key
+        index = self.names.get(key)
+        if index is None:
+            raise IndexError(f'DatarefStore: {key} not found in the store')
+        return index
+
+    def statevar(self, number):
+        # Dataref linked to an EFIS state variable (25.x autopilot sub-keys included), None if not linked
+        index = self.statevars.get(statevar_key(number))
+        if index is None:
+            return None
+        return self.refs[index]
+
+    def handle(self, name):
+        # resolve the name once, keep the Dataref for fast access by index
+        return self.refs[self.index(name)]
+
+    def group(self, name, names):
+        # readiness event for a group of datarefs
+        self.groups[name] = tuple(self.index(key) for key in names)
+        event = self.ready.setdefault(name, threading.Event())
+        self.waiting = True
+        return event
+
+    def check_ready(self):
+        # set the events of groups that have now been fully received
+        stamp = self.stamp
+        waiting = False
+        for name, indexes in self.groups.items():
+            event = self.ready[name]
+            if event.is_set():
+                continue
+            if all(stamp[index] for index in indexes):
+                event.set()
+            else:
+                waiting = True
+        self.waiting = waiting
+
+    def age_ms(self, name, now=None):
+        # milliseconds since the value was last received, inf if it never was
+        stamp = self.stamp[self.index(name)]
+        if not stamp:
+            return math.inf
+        return ((time.monotonic() if now is None else now) - stamp) * 1000
+
+    def all_fresh(self, group, max_age=FRESH_AGE, now=None):
+        # every dataref in the group received within max_age seconds
+        stamp = self.stamp
+        oldest = (time.monotonic() if now is None else now) - max_age
+        for index in self.groups[group]:
+            if stamp[index] < oldest:
+                return False
+        return True
+
+    def get(self, index):
+        value = self.values[index]
+        if self.perc[index] == 0:
+            return int(value)
+        return value
+
+    def set(self, index, value, now=0):
+        self.values[index] = value
+        self.stamp[index] = now
+        self.changes[index] += 1
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return (data for data in self.refs if data is not None)
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+class SharedTable:
+    '''Dataref values and stamps in a multiprocessing shared memory block, laid out by RREF index
+
+    The store of one process writes it, see DatarefStore.share, any process can attach() by
+    name and read live values straight out of the block, nothing is copied or sent.
+        header      slots, 4 bytes
+        values      slots doubles
+        stamp       slots doubles, time.monotonic() last received, the clock is the same in every process
+        names       length, 4 bytes, then the names in RREF index order, null separated, empty for a free index
+    Values are read without a lock, a reader can see one packet half applied.
+    '''
+    _header = struct.Struct('<I')
+
+    def __init__(self, shm):
+        self.shm = shm
+        (self.slots,) = self._header.unpack_from(shm.buf, 0)
+        values = self._header.size
+        stamp = values + self.slots * 8
+        self.names_at = stamp + self.slots * 8
+        self.values = shm.buf[values:stamp].cast('d')
+        self.stamp = shm.buf[stamp:self.names_at].cast('d')
+
+    @classmethod
+    def create(cls, name=None, slots=SHARED_SLOTS):
+        shm = shared_memory.SharedMemory(name, create=True, size=cls._header.size + slots * 16 + SHARED_NAMES)
+        cls._header.pack_into(shm.buf, 0, slots)
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write_names(self, refs):
+        directory = b'\x00'.join(b'' if data is None else data.name.encode() for data in refs)
+        if self._header.size + len(directory) > SHARED_NAMES:
+            raise IndexError('SharedTable: the names do not fit in the directory')
+        self.shm.buf[self.names_at + self._header.size:self.names_at + self._header.size + len(directory)] = directory
+        self._header.pack_into(self.shm.buf, self.names_at, len(directory))
+
+    def names(self):
+        # name -> RREF index, read from the directory
+        (size,) = self._header.unpack_from(self.shm.buf, self.names_at)
+        start = self.names_at + self._header.size
+        names = bytes(self.shm.buf[start:start + size]).split(b'\x00')
+        return {name.decode(): index for index, name in enumerate(names) if name}
+
+    def get(self, name, names=None):
+        # value by name, pass names() in when reading many
+        return self.values[(self.names() if names is None else names)[name]]
+
+    def close(self, unlink=False):
+        # the views have to go before the block can be closed
+        self.values.release()
+        self.stamp.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
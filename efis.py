@@ -10,16 +10,18 @@ import struct
 import socket
 import threading
 import binascii
-import crcmod.predefined        # CRC16.X25
+import crc                      # CRC16.X25
+import capture
+import latency
+import instrument
 import ctypes
 import time
 import xplane
 import queue
 import math
 
-import logging
-logging.basicConfig(level=logging.DEBUG,
-                    format='(%(threadName)-9s) %(message)s',)
+import log
+_log = log.get('efis')
 
 
 
@@ -27,8 +29,112 @@ EFIS_PORT = 10001                   # Do not change
 MY_LINK_IPADDRESS = 0x10            # We are interlink ID 16 (dec)
 #EFIS_IPADDRESS = "192.168.0.1"      # EFIS IPAddress (hardcode, only for debugging to save time)
 EFIS_UDP_TIMEOUT = 15               # How long to wait for EFIS to check in
+EFIS_QUEUE_SIZE = 64                # Outbound frames held per EFIS before the oldest is dropped
+STATEVAR_WINDOW = 0.02              # Seconds state variable changes are gathered into one packet
 
-q = queue.Queue()
+HELLO = bytes((
+    0x00,                           # packet type 00 = Hello
+    0x01,                           # link version 
+    0x00, 0x00))                    # display serial number
+
+
+class Bus:
+    '''Publish/subscribe for outbound EFIS traffic
+
+    Every EFIS connection subscribes its own bounded queue. A payload put on the bus is framed
+    once and the same frame is delivered to every subscriber, so each display gets every packet.
+    A subscriber that falls behind loses its oldest frames rather than holding up the others.
+    '''
+
+    def __init__(self, maxsize=EFIS_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.subscribers = ()
+        self.connected = threading.Event()      # set while at least one EFIS is subscribed
+
+    def subscribe(self, outbox=None):
+        # any object with put_nowait/get_nowait that raises queue.Full/queue.Empty can subscribe
+        if outbox is None:
+            outbox = latency.TimedQueue('efis.q', self.maxsize) if latency.enabled else queue.Queue(self.maxsize)
+        with self.lock:
+            self.subscribers = self.subscribers + (outbox,)
+            self.connected.set()
+        return outbox
+
+    def unsubscribe(self, outbox):
+        with self.lock:
+            self.subscribers = tuple(s for s in self.subscribers if s is not outbox)
+            if not self.subscribers:
+                self.connected.clear()
+
+    def put(self, item, name=None, stamp=0):
+        # same (task, data) items as a Queue, so callers can keep using efis.q.put(('send', payload))
+        # name and stamp tag the frame for latency measurement, see latency.py
+        task, data = item
+        if task == 'send':
+            frame = encode_frame(data)
+            if name is not None and latency.enabled:
+                frame = latency.frame(frame, name, stamp)
+            item = ('frame', frame)
+
+        for outbox in self.subscribers:
+            deliver(outbox, item)
+
+
+def deliver(outbox, item):
+    # drop the oldest frame when a subscriber is full, stale data is no use to the EFIS
+    while True:
+        try:
+            outbox.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                getattr(outbox, 'drop_oldest', outbox.get_nowait)()     # a TimedQueue counts it as a drop, not a wait
+            except queue.Empty:
+                pass
+
+
+class Coalescer:
+    '''Gathers state variable updates for a short window and sends them as one 0x02 packet
+
+    The first update opens the window, anything arriving before it closes rides in the same
+    packet and only the latest value for each index is kept. process_packet already splits
+    a packet into its records on the nulls. A window of 0 sends every update straight away.
+    '''
+
+    def __init__(self, bus, window=STATEVAR_WINDOW):
+        self.bus = bus
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}           # index -> value, in the order they first changed
+        self.timer = None
+        self.updates = 0
+        self.packets = 0
+
+    def put(self, index, value):
+        with self.lock:
+            self.pending[index] = value
+            self.updates += 1
+            if self.timer is None and self.window > 0:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if self.window <= 0:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.timer = None
+        if pending:
+            self.packets += 1
+            self.bus.put(('send', statevar_packet(pending)))
+
+
+q = Bus()
+statevars = Coalescer(q)
+clients = {}
 
 # Setup class to break out GPS bits from uint32_T
 c_uint32 = ctypes.c_uint32   
@@ -48,53 +154,79 @@ class GPSDateTimes(ctypes.Union):
         ("asByte", c_uint32)
     ]
 
-# main
-def efis():
+# main, sessions = the Sessions to find displays for, default the module's own bus
+def efis(sessions=None):
     #listen to UDP first, to find all the EFIS out there
-    udp_listen()
+    udp_listen(sessions)
+
+
+# Bus of a Session, or the module's own for None
+def get_bus(session):
+    return q if session is None else session.efis_q
 
 
 # Listen on the multicast UDP for EFIS pings (Hello)
-def udp_listen():
+def udp_listen(sessions=None):
     '''The UDP hello is a broadcast for units to find each other and establish a TCP connection between each unit. 
     When the UDP broadcasts are exchanged, the unit with the lower IP address of the pair initiates the TCP connection. 
     The EFIS will accept a connection in any order, though. 
     You can skip sending UDP broadcasts and initiate a TCP connection as soon as you see a UDP hello if you do not want to manage 
     accepting TCP connections and sending UDP broadcasts.
+
+    With sessions, one listener serves them all and every EFIS belongs to the Session whose
+    subnet it pings from. Pings from any other address are ignored.
     '''
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)       # socket.IPPROTO_UDP
- #   sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if sessions is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)     # shard.py workers all listen, each hears the broadcasts
     sock.bind(('', EFIS_PORT))        
-    clients = {}
     print(f'Listening on UDP {EFIS_PORT} for Efis pings')
+    own = set()                     # (address, port) our hellos leave from
  
     while True:
         # Cheating by setting the ipaddress so we don't have to wait for udp packet
-        if not clients and 'EFIS_IPADDRESS' in globals():
+        if sessions is None and not clients and 'EFIS_IPADDRESS' in globals():
             ip = EFIS_IPADDRESS
         else:
             data, addr = sock.recvfrom(1024)
             ip = addr[0]
+            if addr in own:
+                continue            # our own hello, heard back when the EFIS shares our host
+
+        session = None
+        if sessions is not None:
+            session = next((s for s in sessions if s.owns(ip)), None)
+            if session is None:
+                _log.debug('Hello from %s, not on any session subnet', ip)
+                continue
+        table = clients if session is None else session.clients
             
-        if ip not in clients:             # Start TCP with new IP address
+        if ip not in table:             # Start TCP with new IP address
+            own.add(hello_source(ip))
             send_hello(sock, ip)
-            t = threading.Thread(target=tcp_listen(ip))
-            t.start() 
-            clients[ip] = {}
-            clients[ip]['tcp'] = t
-            clients_check(ip, 'init')
+            outbox = get_bus(session).subscribe()
+            t = threading.Thread(target=tcp_listen, args=(ip, outbox, session))
+            table[ip] = {}
+            table[ip]['tcp'] = t
+            table[ip]['q'] = outbox
+            clients_check(ip, 'init', session)
+            t.start()       # after the entry is in, so a failed connect finds it to remove
         else:
-            clients_check(addr[0], 'rst')
+            clients_check(ip, 'rst', session)
 
     sock.shutdown(1)
     sock.close()
 
 
 # TODO Checks if EFIS clients are still alive, remove if not
-def clients_check(ip, task):
+def clients_check(ip, task, session=None):
+    table = clients if session is None else session.clients
+    entry = table.get(ip)
+    if entry is None:
+        return          # tcp_listen has given up on it, the next hello reconnects
     if task == 'rst':
-        t = clients[ip]['tmr']
+        t = entry['tmr']
         if t.is_alive():
             #print(f'{ip}: Canceling timer')
             t.cancel()
@@ -102,79 +234,200 @@ def clients_check(ip, task):
         task = 'init'   #restart timer
             
     elif task == 'err':
-        t = clients[ip]['tcp']
-        # TODO - Don't know how to gracefully stop thread
-        clients.pop(ip)
+        # tcp_listen stops on its close task
+        deliver(entry['q'], ('close', ''))
+        table.pop(ip, None)
         print(f'Removed EFIS: {ip}')
 
     if task == 'init':
         #print(f'{ip}: Starting timer')
-        t = threading.Timer(EFIS_UDP_TIMEOUT, clients_check, args=(ip, 'err'))
+        t = threading.Timer(EFIS_UDP_TIMEOUT, clients_check, args=(ip, 'err', session))
         t.setName(ip)
         t.start()
-        clients[ip]['tmr'] = t
-
+        entry['tmr'] = t
 
 
+# Drop the EFIS from the table when its connection ends, so the next hello connects again
+def forget(ip, outbox, session=None):
+    table = clients if session is None else session.clients
+    entry = table.get(ip)
+    if entry is None or entry['q'] is not outbox:
+        return          # already removed, or a newer connection owns it
+    t = entry.get('tmr')
+    if t is not None:
+        t.cancel()
+    table.pop(ip, None)
 
 
 # Setup main connection to EFIS via TCP
-def tcp_listen(ip):
+def tcp_listen(ip, outbox, session=None):
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     #sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
     #sock.setblocking(0)
-    sock.connect((ip, EFIS_PORT))
+    try:
+        sock.connect((ip, EFIS_PORT))
+    except OSError as e:
+        print(f'Efis: Can not connect to EFIS @ {ip}: {e}')
+        get_bus(session).unsubscribe(outbox)
+        forget(ip, outbox, session)
+        sock.close()
+        return
 
-    logging.debug('Found EFIS @ {}'.format(ip))
+    _log.info('Found EFIS @ %s', ip)
   
     
     # start a receiving thread
-    t = threading.Thread(target=rx_thread,args=(sock,))    
+    t = threading.Thread(target=rx_thread,args=(sock, outbox, session))    
     t.start()
 
-    #look at the Q for a task
+    #wait on this EFIS's own queue for a task
+    counts = instrument.counters()
     while True:
         try:   
-            task, data = q.get_nowait()
+            task, data = outbox.get()
+            instrument.high_water('efis.q', outbox.qsize() + 1)
             if task=='send':
-                send_data(sock, data)         # Send over TCP
+                task, data = 'frame', encode_frame(data)     # For this EFIS only, framed here
             elif task=='hello':
-                send_hello(sock)  
+                task, data = 'frame', HELLO_FRAME
+            if task=='frame':
+                sock.sendall(data)            # Already framed by the bus
+                counts[f'efis_tx_{data[5]:02x}'] += 1      # packet type, after the flag and the header
+                if latency.enabled and isinstance(data, latency.Frame):
+                    latency.since(data.name, data.stamp)
+                if capture.recorder:
+                    capture.recorder.write(capture.EFIS, capture.TX, data, ip)
+            elif task=='close':
+                break
             else:
-                print(f'Efis: Except task SEND, but got {task}')
-            q.task_done()
+                _log.warning('Except task SEND, but got %s', task)
 
-        except queue.Empty:
-            pass
+        except OSError as e:
+            counts['efis_tx_errors'] += 1
+            _log.error('tx loop %s: %s = %s', ip, type(e), e)
+            break
         except Exception as e: 
-            print(f'Efis tx loop: {type(e)} = {e}')
+            counts['efis_tx_errors'] += 1
+            _log.error('tx loop: %s = %s', type(e), e)
             pass
             
+    get_bus(session).unsubscribe(outbox)
+    forget(ip, outbox, session)
     print(f'Efis: Closing down TCP {ip}')
-    sock.shutdown(1)
+    try:
+        sock.shutdown(1)
+    except OSError:
+        pass            # reset by the EFIS, nothing left to shut down
     sock.close()
 
 
-# Receive payloads
-def rx_thread(sock):
-    buffer = bytearray()
+# Receive payloads, replies for this EFIS go to its outbox
+def rx_thread(sock, outbox=None, session=None):
+    deframer = Deframer(sock.getpeername()[0])
+    counts = instrument.counters()
 
     while True:
         try:
-            buffer.extend(sock.recv(1024))
-            for packet in read_buffer(buffer):
-                process_packet(packet)
+            data = sock.recv(1024)
+            if not data:            # EFIS closed the connection
+                break
+            counts['efis_chunks'] += 1
+            counts['efis_bytes'] += len(data)
+            if capture.recorder:
+                capture.recorder.write(capture.EFIS, capture.RX, data, deframer.ip)
+            for packet in deframer.feed(data):
+                counts['efis_packets'] += 1
+                process_packet(packet, outbox, session)
 
         except BlockingIOError:
             pass
+        except OSError as e:
+            counts['efis_rx_errors'] += 1
+            _log.error('rx loop: %s = %s', type(e), e)
+            break
         except Exception as e: 
-            print(f'Efis rx loop: {type(e)} = {e}')
+            counts['efis_rx_errors'] += 1
+            _log.error('rx loop: %s = %s', type(e), e)
 
 
 
-# Listen on TCP and decode/verify the packets
-def read_buffer(buffer):
+class Deframer:
+    '''Streaming HDLC deframer, keep one per TCP connection
+
+    feed() splits whatever recv returned on the frame flags in one call. The pieces between
+    two flags are whole frames, the piece after the last flag is kept for the next recv to carry
+    on from, so a frame, or a 0x7D escape, can be split across any number of recv calls. Nothing
+    is trimmed off the front of a buffer. Only frames that hold a 0x7D get unescaped
+    (0x7D xx -> xx ^ 0x20), and the CRC is taken over the checksum bytes as well, see crc.RESIDUE.
+    Good frames come back as their payload, header and checksum already stripped. The payload is
+    sliced off as bytes, for frames this small that is cheaper than making a memoryview of it.
+    A closing flag also opens the next frame, so shared flags (7E..7E..7E) work as well as
+    back to back ones (7E..7E7E..7E). A 0x7D right before a flag aborts the frame.
+    '''
+
+    def __init__(self, ip=''):
+        self.ip = ip
+        self.frame = None           # stuffed bytes after the last flag seen, None = waiting for a flag
+        self.bad_checksums = 0
+
+    def feed(self, data):
+        # returns the payloads of the good frames completed by data
+        pieces = data.split(b'\x7E')
+        tail = pieces.pop()
+        frame = self.frame
+        if not pieces:                      # no flag, all of it goes on the frame being built
+            if frame is not None:
+                self.frame = frame + tail
+            return []
+        if frame is None:
+            pieces[0] = b''                 # noise before the first flag
+        elif frame:
+            pieces[0] = frame + pieces[0]
+        self.frame = bytes(tail)
+
+        packets = []
+        append = packets.append
+        crc16 = crc.crc16
+        residue = crc.RESIDUE
+        for raw in pieces:
+            if len(raw) < 6:
+                continue                    # empty between flags, or too short for a header and checksum
+            if b'\x7D' in raw:
+                raw = unescape(raw)
+                if raw is None:
+                    continue                # aborted
+            if crc16(raw) == residue:
+                append(raw[4:-2])           # remove headers and checksum
+            else:
+                self.bad_checksums += 1
+                instrument.counters()['bad_checksums'] += 1
+                _log.debug('%s Bad checksum', self.ip)
+        return packets
+
+
+# 0x7D xx -> xx ^ 0x20, None if the frame ends on a 0x7D
+def unescape(raw):
+    frame = raw.replace(b'\x7D\x5E',b'\x7E').replace(b'\x7D\x5D',b'\x7D')     # Stuff Byte (Do this one first)
+    if len(frame) == len(raw) - raw.count(b'\x7D'):
+        return frame                # every 0x7D was one of those two, the usual case
+
+    frame = bytearray()
+    pos = 0
+    esc = raw.find(b'\x7D')
+    while esc >= 0:
+        if esc + 1 == len(raw):
+            return None
+        frame += raw[pos:esc]
+        frame.append(raw[esc + 1] ^ 0x20)
+        pos = esc + 2
+        esc = raw.find(b'\x7D', pos)
+    frame += raw[pos:]
+    return frame
+
+
+# Listen on TCP and decode/verify the packets, superseded by Deframer
+def read_buffer(buffer, ip=''):
 
     header = -1
 
@@ -197,13 +450,12 @@ def read_buffer(buffer):
                 packet = packet.replace(b'\x7D\x5D',b'\x7D')        
                 msglen = len(packet)
                 check_sum = int.from_bytes(packet[msglen-2:msglen], "little")  # last two bytes are checksum, grab the range
-                crc16 = crcmod.predefined.Crc('x-25')
-                crc16.update(packet[0:msglen-2])
                     
-                if check_sum == crc16.crcValue:
+                if check_sum == crc.crc16(packet[0:msglen-2]):
                     yield packet[4:msglen-2]        # remove headers and checksum
                 else:
-                    logging.debug('{} Bad checksum'.format(ip))
+                    instrument.counters()['bad_checksums'] += 1
+                    _log.debug('%s Bad checksum', ip)
 
             else:
                 #print("End Frame flag not found yet")
@@ -214,7 +466,7 @@ def read_buffer(buffer):
 
 
 # Process the packet
-def process_packet(packet):
+def process_packet(packet, outbox=None, session=None):
     """The header has been stripped out of the payload already
     vendorcode = msg[0];       0x5B    vendor protocol code
     scr = msg[1];              0x0A    source ID
@@ -229,15 +481,16 @@ def process_packet(packet):
     if type == 0x00:           
         #print(f'{self.ip}: Hello ({self.counters["HelloRx"]})')
         # Send Hello back, use their packet as a timer
-        q.put(('hello',''))
+        if outbox is not None:
+            deliver(outbox, ('hello',''))
         
     # State variables
     elif type == 0x02:          
         # print(f'{self.ip}: State variable')
-        for var in payload.split(b'\x00'):
+        for var in bytes(payload).split(b'\x00'):
             if var:
                 var = var.split(b'=')
-                state_varibles(int(var[0].decode()), var[1].decode())
+                state_varibles(int(var[0].decode()), var[1].decode(), session)
 
     #elif type == 0x07
         #07005C00       #When I cleared the 'Check altitude' message box
@@ -267,7 +520,7 @@ def process_packet(packet):
             datetime = GPSDateTimes()
             datetime.asByte = var
             if datetime.status == 0:
-                print("GPS datetime is invalid")  
+                _log.debug('GPS datetime is invalid')
                 
             (latitude,) = struct.unpack('f', payload[6:10])    
             (longitude,) = struct.unpack('f', payload[10:14])
@@ -295,15 +548,13 @@ def process_packet(packet):
                     V            Arrival alarm  A = arrived, V = not arrived
                     *0B          mandatory checksum
             """
-            print(binascii.hexlify(payload)) 
-            print(binascii.hexlify(payload[1:3]),end='')
+            _log.debug('GPS navigation %s', log.Hex(payload))
             (dest_latitude,) = struct.unpack('f', payload[3:7])    
             (dest_longitude,) = struct.unpack('f', payload[7:11])
             (orig_latitude,) = struct.unpack('f', payload[11:15])    
             (orig_longitude,) = struct.unpack('f', payload[15:19])
             (true_bearing,) = struct.unpack('>H', payload[19:21])    # 3 degree higher then on efis
             (destination_range,) = struct.unpack('>H', payload[21:23])   # in nM    why2
-            print(binascii.hexlify(payload[23:29]))
             #payload[24]
             #payload[25]
             #payload[26]
@@ -314,7 +565,7 @@ def process_packet(packet):
             destination_range /= 10
 
         elif subtype == 0x02:          # waypoints in active flight plan from current GPS source
-            print(binascii.hexlify(payload))  
+            _log.debug('GPS waypoints %s', log.Hex(payload))
 
         elif subtype == 0x03:          # time and date from GPS1 and/or GPS2 independent of current GPS source
             """Byte 0: 03 = time/date
@@ -330,7 +581,7 @@ def process_packet(packet):
                 msg = "Gps: valid:{} = {}-{}-{} {}:{}:{}".format(datetime.status, year, datetime.month, datetime.day, datetime.hour, datetime.min, datetime.sec)
     #               print(msg)
             else:
-                print("GPS datetime is invalid")
+                _log.debug('GPS datetime is invalid')
 
         elif subtype == 0x04:           # GPS altitude and geoidal difference, fix quality, number of satellites used, from current GPS source, like data in GPGGA   */        //Gps position packet
             gps_mode = payload[1]            # Gps Mode      3 = Auto Fix 3D
@@ -348,43 +599,38 @@ def process_packet(packet):
     elif type == 0x1A:      # 0x1A  Nav/Com state packet. volume levels, audiopanel modes, transponder modes, drive boxes upper right hand corner
         return                       
     else:
-        print('Packet {} not setup for processing yet'.format(type))
-        print(binascii.hexlify(packet))  
+        _log.debug('Packet %s not setup for processing yet %s', type, log.Hex(packet))
+
+
+# (address, port) a UDP hello to ip goes out from, the kernel picks the address by route
+def hello_source(ip, port=EFIS_PORT):
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect((ip, EFIS_PORT))      # nothing is sent, it only picks the route
+        return (probe.getsockname()[0], port)
+    except OSError:
+        return None
+    finally:
+        probe.close()
 
 
 # EFIS expects a ping (Hello) every 10 seconds
 def send_hello(sock, ip = False):
-    payload = bytearray()
-    payload.append(0x00)                # packet type 00 = Hello
-    payload.append(0x01)                # link version 
-    payload.extend((0x00, 0x00))        # display serial number
-
-    send_data(sock, payload, ip)         # Send over TCP
+    send_data(sock, HELLO, ip)         # Send over TCP
 
    
 # Pack payload with header and checksum, send to EFIS
 def send_data(sock, payload, ip = False):
-    packet = bytearray()
-    packet.append(0x5B)                 # vendor protocol code
-    packet.append(MY_LINK_IPADDRESS)    # source ID
-    packet.append(0xFF)                 # broadcast to all IPs
-    packet.append(0x0A)                 # Time To Live 
-    packet.extend(payload)
-    
-    # Add Checksum crc16.x25
-    crc16 = crcmod.predefined.Crc('x-25')
-    crc16.update(packet)
-    packet.extend(crc16.crcValue.to_bytes(2, 'little'))         
-
-    packet = packet.replace(b'\x7D',b'\x7D\x5D')        # Stuff Byte (Do this first)
-    packet = packet.replace(b'\x7E',b'\x7D\x5E')        
+    packet = encode_packet(payload)
 
     if ip:
         try:
             #for ip in obj.clients.keys():
             sock.sendto(packet, (ip, EFIS_PORT))
+            if capture.recorder:
+                capture.recorder.write(capture.EFIS, capture.TX, packet, ip)
         except:
-            print('Error sending UDP data to EFIS')
+            _log.error('Error sending UDP data to EFIS')
 
     else:
         # TCP needs FrameFlags where UDP does not
@@ -392,12 +638,38 @@ def send_data(sock, payload, ip = False):
         packet.append(0x7E)
         try: 
             sock.sendall(packet)
+            if capture.recorder:
+                capture.recorder.write(capture.EFIS, capture.TX, packet, sock.getpeername()[0])
         except:
-            print(f'{ip}: Error sending TCP data to EFIS')
+            _log.error('Error sending TCP data to EFIS')
+
+
+# Header, checksum and byte stuffing around a payload
+def encode_packet(payload):
+    packet = bytearray()
+    packet.append(0x5B)                 # vendor protocol code
+    packet.append(MY_LINK_IPADDRESS)    # source ID
+    packet.append(0xFF)                 # broadcast to all IPs
+    packet.append(0x0A)                 # Time To Live 
+    packet.extend(payload)
+    
+    # Add Checksum crc16.x25
+    crc.append_crc(packet)
+
+    packet = packet.replace(b'\x7D',b'\x7D\x5D')        # Stuff Byte (Do this first)
+    packet = packet.replace(b'\x7E',b'\x7D\x5E')        
+    return packet
+
+
+# Complete TCP frame, with FrameFlags, ready for sendall
+def encode_frame(payload):
+    return b'\x7E' + encode_packet(payload) + b'\x7E'
+
+HELLO_FRAME = encode_frame(HELLO)
 
 
 #Saving the EFIS state varibles, relaying over to X-plane
-def state_varibles(index, value):
+def state_varibles(index, value, session=None):
     """
     3 = Select Heading bug            NOT SURE  divide by 0.0174532924791086 to get degree
     4 = Selected Altitude
@@ -428,7 +700,7 @@ def state_varibles(index, value):
             value = ""
         return
 
-    xplane.efis_updating(index, value)
+    xplane.efis_updating(index, value, session)
 
 
 def string_to_number(str):
@@ -445,7 +717,7 @@ def string_to_number(str):
 
 
 # Sync Xplane data with Efis state variables
-def update_statevariable(index, value):
+def update_statevariable(index, value, session=None):
 
     if index == 3:      # Select Heading bug
         value = value * 0.0174532924791086    #convert to efis degrees
@@ -461,13 +733,17 @@ def update_statevariable(index, value):
         else:
             return
 
+    (statevars if session is None else session.statevars).put(index, value)
+
+
+# One 0x02 packet holding index=value records for every state variable given
+def statevar_packet(values):
     payload = bytearray()
     payload.append(0x02)        # packet type
-    payload.extend(str(index).encode())  
-    payload.append(0x3D)        #  = 
-    payload.extend(str(value).encode())  
-    payload.append(0x00)        #  null 
-    
-    q.put(('send', payload))
-
+    for index, value in values.items():
+        payload.extend(str(index).encode())  
+        payload.append(0x3D)        #  = 
+        payload.extend(str(value).encode())  
+        payload.append(0x00)        #  null 
+    return payload
 
@@ -0,0 +1,280 @@
+'''Stand-ins for X-Plane and the GRT displays, to run the bridge on one machine
+
+FakeXPlane multicasts a BECN beacon, so xplane.find_beacon() finds it, and serves the UDP
+protocol the bridge speaks: RREF subscriptions are streamed back with synthetic values, RPOS
+at the rate asked for, DREF writes are kept and become the value streamed for that ref, CMND
+commands are counted. For load testing, rate streams every subscription at one rate, and with
+count every round carries that many values, rate (or COUNT_HZ) rounds a second, whatever the
+bridge subscribed.
+
+FakeEfis is one display. It pings the bridge over UDP the way a display does, accepts the
+bridge's interlink TCP connection, checks the framing and CRC of every frame, keeps count of
+what it received by packet type and, with echo on, sends state variables back like the real
+displays do. Echo is off by default: the bridge turns echoed autopilot state variables into
+CMNDs, so an echoing fake would fill FakeXPlane.commands with buttons nobody pressed.
+Every display needs its own loopback address (127.0.0.2, 127.0.0.3, ...) since they all
+listen on EFIS_PORT.
+
+Start the fakes, then the bridge in another terminal (python main.py):
+    python emulators.py [displays] [rate] [count]
+Counts are printed every second.
+'''
+
+import itertools
+import math
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import crc
+from efis import EFIS_PORT, HELLO, statevar_packet
+from xplane import BEACON_IP, BEACON_PORT, XPLANE_MAJOR_VER, XPLANE_MINOR_VER
+
+
+RREF_PER_PACKET = 100           # values per RREF datagram, the bridge reads 1024 bytes at most
+BEACON_PERIOD = 1.0             # seconds between BECN beacons
+COUNT_HZ = 20                   # rounds a second with a count and no rate
+PING_PERIOD = 1.0               # seconds between display UDP pings, well inside EFIS_UDP_TIMEOUT
+
+_rref_request = struct.Struct('<5sii400s')
+_rref_value = struct.Struct('<if')
+_rpos = struct.Struct('<5sdddffffffffff')
+
+
+def synthetic(ref, t):
+    # a slow sine wave between 0 and 20 per ref, different refs get different phases
+    return 10 + 10 * math.sin(t / 4 + (zlib.crc32(ref.encode()) % 628) / 100)     # same phases every run
+
+
+class FakeXPlane:
+    '''X-Plane's UDP side: beacon, RREF/RPOS streams, DREF and CMND'''
+
+    def __init__(self, host='', port=0, rate=None, count=None):
+        self.rate = rate                # Hz for every RREF subscription, None = the rate the bridge asked for
+        self.count = count              # values in every round of RREF datagrams, the subscribed refs
+                                        # repeated or cut to make up that many, None = each ref at its rate
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.stop = threading.Event()
+        self.client = None              # address RREF and RPOS are streamed to
+        self.lock = threading.Lock()
+        self.subscriptions = {}         # RREF index -> [ref, freq, next time due]
+        self.rpos = 0                   # RPOS packets a second, 0 = off
+        self.drefs = {}                 # ref -> value written with DREF
+        self.commands = []              # CMND commands received
+        self.sent_packets = 0
+        self.sent_values = 0
+
+    def start(self):
+        for target in (self.beacon, self.receive, self.stream):
+            threading.Thread(target=target, daemon=True).start()
+        return self
+
+    def close(self):
+        self.stop.set()
+        self.sock.close()
+
+    def beacon(self):
+        # multicast on the local host only, X-Plane 11.50b14, master, our port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 0)
+        message = (b'BECN\x00' + struct.pack('<BBiiIH', XPLANE_MAJOR_VER, XPLANE_MINOR_VER, 1, 115014, 1, self.port)
+                   + socket.gethostname().encode() + b'\x00\x00\x00')
+        while not self.stop.is_set():
+            try:
+                sock.sendto(message, (BEACON_IP, BEACON_PORT))
+            except OSError as e:
+                print(f'FakeXPlane beacon: {type(e)} = {e}')
+            self.stop.wait(BEACON_PERIOD)
+        sock.close()
+
+    def receive(self):
+        while not self.stop.is_set():
+            try:
+                message, addr = self.sock.recvfrom(1024)
+            except OSError:
+                return
+            self.client = addr
+            cmd = message[0:4]
+            if cmd == b'RREF':
+                header, freq, index, ref = _rref_request.unpack(message)
+                ref = ref.rstrip(b'\x00').decode()
+                with self.lock:
+                    if freq:
+                        self.subscriptions[index] = [ref, self.rate or freq, 0.0]
+                    else:
+                        self.subscriptions.pop(index, None)
+            elif cmd == b'RPOS':
+                self.rpos = int(message[5:].rstrip(b'\x00') or 0)
+            elif cmd == b'DREF':
+                value, ref = struct.unpack('<f500s', message[5:509])
+                self.drefs[ref.rstrip(b'\x00').decode()] = value
+            elif cmd == b'CMND':
+                self.commands.append(message[5:].decode())
+            else:
+                print(f'FakeXPlane: Unknown packet {message[0:5]}')
+
+    def stream(self):
+        next_rpos = 0.0
+        next_round = 0.0                # count mode, every subscription goes out together
+        while not self.stop.is_set():
+            now = time.monotonic()
+            client = self.client
+            if client is not None:
+                values = []
+                with self.lock:
+                    if self.count is None:
+                        for index, sub in self.subscriptions.items():
+                            ref, freq, due = sub
+                            if now >= due:
+                                sub[2] = max(due + 1 / freq, now)
+                                values.append((index, self.drefs.get(ref, synthetic(ref, now))))
+                    elif self.subscriptions and now >= next_round:
+                        next_round = max(next_round + 1 / (self.rate or COUNT_HZ), now)
+                        values = [(index, self.drefs.get(ref, synthetic(ref, now))) for index, (ref, freq, due) in self.subscriptions.items()]
+                        values = list(itertools.islice(itertools.cycle(values), self.count))
+                for i in range(0, len(values), RREF_PER_PACKET):
+                    self.send(b'RREF,' + b''.join(_rref_value.pack(*v) for v in values[i:i + RREF_PER_PACKET]))
+                    self.sent_values += len(values[i:i + RREF_PER_PACKET])
+
+                if self.rpos and now >= next_rpos:
+                    next_rpos = max(next_rpos + 1 / self.rpos, now)
+                    self.send(_rpos.pack(b'RPOS4', -122.3, 47.5, 1000 + synthetic('asl', now), 300.0,
+                                         synthetic('pitch', now) - 10, 170 + synthetic('psi', now), 3 * synthetic('roll', now) - 30,
+                                         10.0, 0.5, -40.0, 0.01, 0.02, 0.03))
+            self.stop.wait(0.001)
+
+    def send(self, packet):
+        try:
+            self.sock.sendto(packet, self.client)
+            self.sent_packets += 1
+        except OSError as e:
+            print(f'FakeXPlane: {type(e)} = {e}')
+
+    def stats(self):
+        return {'packets': self.sent_packets, 'values': self.sent_values, 'subscriptions': len(self.subscriptions),
+                'rpos_hz': self.rpos, 'drefs': len(self.drefs), 'commands': len(self.commands)}
+
+
+class FakeEfis:
+    '''One GRT display on its own loopback address'''
+
+    def __init__(self, ip='127.0.0.2', bridge='127.0.0.1', serial=1, echo=False):
+        self.ip = ip
+        self.bridge = bridge
+        self.serial = serial            # our interlink source ID
+        self.echo = echo                # send state variables back, like the displays do, see above
+        self.stop = threading.Event()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((ip, EFIS_PORT))
+        self.listener.listen(1)
+        self.conn = None
+        self.frames = 0
+        self.bad_frames = 0             # wrong checksum or too short
+        self.types = {}                 # packet type -> count
+        self.received = []              # (time.monotonic(), payload) of every good frame, when record is on
+        self.record = False
+
+    def start(self):
+        for target in (self.ping, self.accept):
+            threading.Thread(target=target, daemon=True).start()
+        return self
+
+    def close(self):
+        self.stop.set()
+        self.listener.close()
+        if self.conn is not None:
+            self.conn.close()
+
+    def ping(self):
+        # UDP hello to the bridge from our address, it connects back over TCP
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)      # bridge can be 127.255.255.255, like the displays broadcast
+        sock.bind((self.ip, 0))
+        message = crc.append_crc(bytearray((0x5B, self.serial, 0xFF, 0x0A)) + HELLO)
+        while not self.stop.is_set():
+            try:
+                sock.sendto(message, (self.bridge, EFIS_PORT))
+            except OSError as e:
+                print(f'FakeEfis {self.ip} ping: {type(e)} = {e}')
+            self.stop.wait(PING_PERIOD)
+        sock.close()
+
+    def accept(self):
+        while not self.stop.is_set():
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            self.conn = conn
+            self.receive(conn)
+
+    def receive(self, conn):
+        # split on the flags, unstuff and check every frame independently of efis.Deframer
+        buffer = b''
+        while not self.stop.is_set():
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            *frames, buffer = buffer.split(b'\x7E')
+            for frame in frames:
+                if frame:
+                    self.frame(frame.replace(b'\x7D\x5E', b'\x7E').replace(b'\x7D\x5D', b'\x7D'))
+        conn.close()
+        self.conn = None
+
+    def frame(self, frame):
+        if len(frame) < 7 or not crc.check(frame):
+            self.bad_frames += 1
+            return
+        self.frames += 1
+        payload = frame[4:-2]
+        kind = payload[0]
+        self.types[kind] = self.types.get(kind, 0) + 1
+        if self.record:
+            self.received.append((time.monotonic(), payload))
+        if kind == 0x02 and self.echo:
+            self.send(payload)
+
+    def send(self, payload):
+        conn = self.conn
+        if conn is not None:
+            packet = crc.append_crc(bytearray((0x5B, self.serial, 0xFF, 0x0A)) + payload)    # from us, to all
+            frame = b'\x7E' + packet.replace(b'\x7D', b'\x7D\x5D').replace(b'\x7E', b'\x7D\x5E') + b'\x7E'
+            try:
+                conn.sendall(frame)
+            except OSError as e:
+                print(f'FakeEfis {self.ip}: {type(e)} = {e}')
+
+    def set_statevar(self, index, value):
+        # the pilot turned a knob
+        self.send(statevar_packet({index: value}))
+
+    def stats(self):
+        return {'connected': self.conn is not None, 'frames': self.frames, 'bad_frames': self.bad_frames,
+                'types': dict(self.types)}
+
+
+if __name__ == '__main__':
+    displays = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    sim = FakeXPlane(rate=rate, count=count).start()
+    efises = [FakeEfis(f'127.0.0.{2 + n}', serial=1 + n).start() for n in range(displays)]
+    print(f'FakeXPlane on UDP {sim.port}, {displays} FakeEfis on {efises[0].ip}..{efises[-1].ip}')
+    try:
+        while True:
+            time.sleep(1)
+            print(f'xplane {sim.stats()} ' + ' '.join(f'{efis.ip} {efis.stats()}' for efis in efises))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,130 @@
+'''Hot path counters and an on demand sampling profiler for the running bridge
+
+Counters are kept per thread, so the receive and transmit loops count without locks: a loop
+fetches its own Counter once with counters() and does counts['name'] += 1. snapshot() adds
+them up over all threads. High water marks keep the deepest xplane.q and EFIS outbox seen.
+The asyncio engine counts the same names, on its loop thread.
+
+    xplane_datagrams, xplane_bytes      datagrams and bytes from X-Plane
+    rref_values                         values decoded from RREF datagrams
+    rpos_packets, unknown_packets       RPOS4 datagrams, datagrams nobody decodes
+    efis_chunks, efis_bytes             TCP reads from the EFIS
+    efis_packets, bad_checksums         good frames from the EFIS, frames dropped on their CRC
+    efis_tx_<type>                      frames sent to the EFIS by packet type (hex)
+    ahrs_frames                         AHRS frames encoded, each goes to every VM
+    ahrs_dropped                        AHRS frames a VM missed, down or not keeping up
+    *_errors                            exceptions caught by a loop
+
+On Unix, once install() has run (main.py does it):
+    kill -USR1 <pid>    samples every thread's stack for PROFILE_SECONDS and prints the hot spots
+    kill -USR2 <pid>    prints the counters and high water marks
+'''
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+
+PROFILE_SECONDS = 5.0       # how long one profile samples
+PROFILE_INTERVAL = 0.001    # seconds between stack samples
+PROFILE_TOP = 25            # functions listed in a profile
+
+_local = threading.local()
+_counters = []              # (thread name, Counter) for every thread that has counted
+_marks = {}                 # queue name -> deepest seen
+_lock = threading.Lock()
+
+
+def counters():
+    '''Counter of the calling thread, fetch it once outside the loop'''
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        counts = _local.counts = collections.Counter()
+        with _lock:
+            _counters.append((threading.current_thread().name, counts))
+    return counts
+
+
+def high_water(name, depth):
+    if depth > _marks.get(name, 0):
+        _marks[name] = depth
+
+
+def snapshot():
+    # the owning threads keep counting meanwhile, dict() copies each Counter in one go and
+    # a copy that still catches one growing is taken again
+    with _lock:
+        counters = [counts for name, counts in _counters]
+    total = collections.Counter()
+    for counts in counters:
+        while True:
+            try:
+                copy = dict(counts)
+                break
+            except RuntimeError:
+                pass
+        total.update(copy)
+    return dict(total)
+
+
+def report():
+    lines = [f'{key:<24} {value:>12,}' for key, value in sorted(snapshot().items())]
+    lines += [f'{"high_water " + key:<24} {value:>12,}' for key, value in sorted(_marks.items())]
+    return '\n'.join(lines) + '\n'
+
+
+def profile(seconds=PROFILE_SECONDS, interval=PROFILE_INTERVAL):
+    '''Sample the stacks of every other thread, returns samples and (own, total) Counters of 'file:line function'
+
+    own counts the function at the top of the stack, where the time is spent, total counts
+    every function on the stack once, the time spent in it and below.
+    '''
+    me = threading.get_ident()
+    own = collections.Counter()
+    total = collections.Counter()
+    samples = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            own[f'{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}'] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                key = f'{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}'
+                if key not in seen:
+                    seen.add(key)
+                    total[key] += 1
+                frame = frame.f_back
+        samples += 1
+        time.sleep(interval)
+    return samples, own, total
+
+
+def print_profile(seconds=PROFILE_SECONDS):
+    samples, own, total = profile(seconds)
+    print(f'Profile: {samples} samples over {seconds} s, own = on top of the stack, total = anywhere on it')
+    print(f'{"own":>8} {"total":>8}  function')
+    for key, count in own.most_common(PROFILE_TOP):
+        print(f'{count:>8} {total[key]:>8}  {key}')
+
+
+def _on_profile(signum, frame):
+    # sample from a thread of its own, the signal handler returns straight away
+    threading.Thread(target=print_profile, name='profiler', daemon=True).start()
+
+
+def _on_report(signum, frame):
+    print(report(), end='')
+
+
+def install():
+    '''Hook up the signals, call from the main thread'''
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, _on_profile)
+        signal.signal(signal.SIGUSR2, _on_report)
@@ -0,0 +1,173 @@
+'''End to end latency, from an X-Plane packet arriving to the bytes going out to the EFIS or AHRS
+
+Off unless enable() is called (main.py --latency). When off, the send paths only check
+latency.enabled, nothing is stamped or timed.
+
+Every dataref value is already stamped with its arrival time in the store (DatarefStore.stamp).
+When a frame has been sent, its latency is the time since the oldest input it was built from
+arrived, so it tells how stale the attitude or position on the display is:
+    ahrs            link.ahrs, after sock.send returns, the asyncio engine once drain() has
+                    emptied the transport into the socket
+    serial          link.SerialSink, after the AHRS frame is written to the port
+    gps0, eis, ...  efis.tcp_listen, after sock.sendall of that interlink payload's frame, the
+                    asyncio engine once drain() has emptied the transport into the socket
+Queue dwell, how long an item sat in xplane.q or an EFIS outbox, is timed by TimedQueue:
+    xplane.q        DREF/CMND datagrams waiting for the X-Plane tx loop
+    efis.q          frames waiting in an EFIS outbox, frames dropped from a full one are counted
+
+Histograms have power of two buckets in microseconds. The summary is printed every
+SUMMARY_PERIOD seconds and served as text on 127.0.0.1:port (nc 127.0.0.1 <port>).
+'''
+
+import collections
+import queue
+import socket
+import threading
+import time
+
+
+SUMMARY_PERIOD = 10.0       # seconds between printed summaries, 0 = don't print
+BUCKETS = 32                # bucket n holds latencies below 2**n microseconds
+
+enabled = False
+histograms = {}             # stream name -> Histogram
+drops = collections.Counter()   # queue name -> items dropped from a full TimedQueue
+_lock = threading.Lock()
+
+
+class Histogram:
+    '''Latencies of one stream, power of two buckets in microseconds'''
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        usec = int(seconds * 1e6)
+        self.buckets[min(usec.bit_length(), BUCKETS - 1) if usec > 0 else 0] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # upper edge of the bucket the p-th percentile falls in, or the max if that is lower, seconds
+        wanted = self.count * p / 100
+        seen = 0
+        for n, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min((1 << n) / 1e6, self.max)
+        return 0.0
+
+    def stats(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1e3 if self.count else 0.0,
+                'p50_ms': self.percentile(50) * 1e3,
+                'p99_ms': self.percentile(99) * 1e3,
+                'max_ms': self.max * 1e3}
+
+
+def record(name, seconds):
+    histogram = histograms.get(name)
+    if histogram is None:
+        with _lock:
+            histogram = histograms.setdefault(name, Histogram())
+    histogram.add(seconds)
+
+
+def since(name, stamp, now=None):
+    # latency from a monotonic stamp to now, stamp 0 = never received, nothing to measure
+    if stamp:
+        record(name, (time.monotonic() if now is None else now) - stamp)
+
+
+def oldest(stamps, indexes):
+    # arrival time of the stalest input of a frame, 0 if any of them never arrived
+    return min(stamps[index] for index in indexes)
+
+
+class Frame(bytes):
+    '''An EFIS frame carrying the stamp of its oldest input and its payload name through the bus'''
+
+
+def frame(data, name, stamp):
+    data = Frame(data)
+    data.name = name
+    data.stamp = stamp
+    return data
+
+
+class TimedQueue(queue.Queue):
+    '''queue.Queue that records how long every item waited in it
+
+    An item dropped with drop_oldest() never reached its consumer, it is counted in drops
+    rather than timed.
+    '''
+
+    def __init__(self, name, maxsize=0):
+        super().__init__(maxsize)
+        self.name = name
+
+    def drop_oldest(self):
+        with self.not_full:
+            if not self.queue:
+                raise queue.Empty
+            self.queue.popleft()
+            drops[self.name] += 1
+            self.not_full.notify()
+
+    def _put(self, item):
+        self.queue.append((time.monotonic(), item))
+
+    def _get(self):
+        queued, item = self.queue.popleft()
+        record(self.name, time.monotonic() - queued)
+        return item
+
+
+def report():
+    lines = [f'{"stream":<12} {"count":>9} {"mean_ms":>9} {"p50_ms":>9} {"p99_ms":>9} {"max_ms":>9}']
+    for name, histogram in sorted(histograms.items()):
+        s = histogram.stats()
+        lines.append(f'{name:<12} {s["count"]:>9} {s["mean_ms"]:>9.3f} {s["p50_ms"]:>9.3f} {s["p99_ms"]:>9.3f} {s["max_ms"]:>9.3f}')
+    for name, count in sorted(drops.items()):
+        lines.append(f'{name:<12} {count:>9} dropped')
+    return '\n'.join(lines) + '\n'
+
+
+def summary(period=SUMMARY_PERIOD):
+    while True:
+        time.sleep(period)
+        print(report(), end='')
+
+
+def serve(port):
+    # text endpoint, every connection gets the current report
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(4)
+    while True:
+        conn, addr = sock.accept()
+        try:
+            conn.sendall(report().encode())
+        except OSError as e:
+            print(f'Latency: {type(e)} = {e}')
+        conn.close()
+
+
+def enable(port=None, period=SUMMARY_PERIOD):
+    '''Start measuring, call before the engines start so the queues are created timed'''
+    global enabled
+    import xplane
+
+    enabled = True
+    xplane.q = TimedQueue('xplane.q')
+    if period:
+        threading.Thread(target=summary, args=(period,), daemon=True).start()
+    if port:
+        threading.Thread(target=serve, args=(port,), daemon=True).start()
@@ -2,243 +2,543 @@ import struct
 import serial
 import xplane
 import efis
-from time import sleep
+import codec
+import scheduler
+import latency
+import instrument
+import log
+from time import monotonic
 import socket
+import select
+import errno
+import os
+import functools
 import threading
 import datetime
-import ctypes
 import binascii
 
-#Setup class to break out GPS bits from uint32_T
-c_uint32 = ctypes.c_uint32   
-class DateTime_bits( ctypes.LittleEndianStructure ):
-    _fields_ = [
-        ("month", c_uint32, 4 ), 
-        ("day",   c_uint32, 5 ),
-        ("hour",  c_uint32, 5 ),
-        ("min",   c_uint32, 6 ),
-        ("sec",   c_uint32, 6 ),
-        ("status", c_uint32, 1 )
-    ] 
-class GPSDateTimes( ctypes.Union ):
-    _anonymous_ = ("bit",)
-    _fields_ = [
-        ("bit",    DateTime_bits ),
-        ("asByte", c_uint32    )
-    ]
-
-
-# main
-def link(ipaddresses, port):
-
-    #TODO conitnue only when xplane and efis are connected
-
-    for ip in ipaddresses:
-        t = threading.Thread(target=ahrs, args=[ip, port])
+AHRS_HIGH_HZ = 20                   # attitude frames a second
+AHRS_LOW_HZ = 1.25                  # low rate frames a second
+AHRS_POLICY = scheduler.SKIP        # late attitude is no use, drop missed frames rather than bunch them up
+AHRS_CONNECT_TIMEOUT = 3.0          # seconds a VM gets to accept the connection
+AHRS_RECONNECT_MIN = 0.5            # seconds before reconnecting to a VM, doubled after every failure
+AHRS_RECONNECT_MAX = 10.0           # up to this
+
+SERIAL_BAUD = 115200                # default baud rate of a serial AHRS output
+SERIAL_BITS = 10                    # bits on the line per byte, 8N1 is start + 8 data + stop
+SERIAL_MAX_DELAY = 0.05             # seconds of frames a serial port may be behind the line
+SERIAL_GPS_HZ = 1                   # NMEA RMC and GGA sentences a second on a serial output, 0 = none
+
+INTERLINK_RATES = {                 # interlink payloads a second
+    'gps0': 5,                      # position, track and ground speed
+    'gps3': 1,                      # time and date
+    'gps4': 1,                      # GPS altitude and fix
+    'eis': 4,                       # engine
+}
+INTERLINK_INPUTS = {                # datarefs each payload is built from, their age is its latency
+    'gps0': ('latitude', 'longitude', 'heading_actual', 'mag_var', 'gnd_speed'),
+    'gps4': ('asl',),
+    'eis': ('rpm', 'cht', 'egt', 'fuelflow', 'oilpressure', 'oiltemp'),
+}
+INTERLINK_SUPPRESS = False          # skip payloads that haven't changed since they were last sent
+INTERLINK_KEEPALIVE = 1.0           # seconds, unchanged payloads still go out at least this often
+
+_log = log.get('link')
+
+schedulers = {}                     # 'ahrs' and 'interlink' schedulers, for their stats()
+broadcaster = None                  # the AhrsBroadcaster, for ahrs_health()
+sinks = {}                          # SerialSink by port, for their stats()
+payloads = {}                       # interlink Payload by name, for their sent/suppressed counts
+
+# interlink payloads are only built by the link() loop, so one set of buffers is enough, a Session has its own
+_interlink = codec.InterlinkEncoder()
+
+
+# AHRS frames go out at 20 Hz per VM, resolve their datarefs once
+AHRS_INPUTS = ('roll', 'pitch', 'heading_mag', 'asl', 'v_speed', 'ias')
+_attitude = tuple(xplane.handle(name) for name in AHRS_INPUTS)
+
+
+# main, session = the Session to produce for, default the module's own store and bus
+def link(ipaddresses, port, session=None):
+
+    if ipaddresses:
+        t = threading.Thread(target=ahrs, args=[tuple(ipaddresses), port, session])
         t.start()
 
-    payloads = ['gps0', 'gps3', 'gps4', 'eis']
-    while True:
-        for p in payloads:
-            efis.q.put(('send', globals()[p]()))  
-            sleep(0.1)
+    # continue only when xplane and efis are connected
+    xplane.ready('interlink', session).wait()
+    efis.get_bus(session).connected.wait()
+
+    schedule = interlink_scheduler(session=session)
+    (schedulers if session is None else session.schedulers)['interlink'] = schedule
+    schedule.run()
+
+
+class Payload:
+    '''One interlink payload on the bus, optionally only sent when it changes
+
+    With suppress on, a payload that encodes to the same bytes as the last one sent is
+    skipped, but still goes out every keepalive seconds so the EFIS doesn't time it out.
+    '''
+
+    def __init__(self, name, encode, suppress=False, keepalive=None, session=None):
+        self.name = name
+        self.encode = encode
+        self.suppress = suppress
+        self.keepalive = INTERLINK_KEEPALIVE if keepalive is None else keepalive
+        self.last = None
+        self.last_sent = 0.0
+        self.sent = 0
+        self.suppressed = 0
+        self.store = xplane.get_store(session)
+        self.bus = efis.get_bus(session)
+        self.inputs = tuple(self.store.index(ref) for ref in INTERLINK_INPUTS.get(name, ()))
+
+    def __call__(self):
+        payload = self.encode()
+        now = monotonic()
+        if self.suppress and payload == self.last and now - self.last_sent < self.keepalive:
+            self.suppressed += 1
+            return
+
+        if latency.enabled and self.inputs:
+            self.bus.put(('send', payload), self.name, latency.oldest(self.store.stamp, self.inputs))
+        else:
+            self.bus.put(('send', payload))
+        self.last = payload
+        self.last_sent = now
+        self.sent += 1
+
+
+# Each interlink payload on its own rate
+def interlink_scheduler(rates=None, suppress=None, session=None):
+    rates = INTERLINK_RATES if rates is None else rates
+    suppress = INTERLINK_SUPPRESS if suppress is None else suppress
+
+    schedule = scheduler.Scheduler()
+    for i, (name, hz) in enumerate(rates.items()):
+        encode = INTERLINK_ENCODERS[name] if session is None else functools.partial(INTERLINK_ENCODERS[name], session)
+        payload = Payload(name, encode, suppress, session=session)
+        (payloads if session is None else session.payloads)[name] = payload
+        schedule.add(scheduler.Stream(name, hz, payload, offset=i * 0.01))     # spread them out a little
+    return schedule
+
+
+# Sent and suppressed counts for every interlink payload
+def interlink_stats(session=None):
+    return {name: {'sent': p.sent, 'suppressed': p.suppressed}
+            for name, p in (payloads if session is None else session.payloads).items()}
 
 
 #Load payload of AHRS data
-def ahrs_data(task):       
+def ahrs_data(task, encoder=None, attitude=None):
+    # encoder owns the frame buffer, pass one in per stream to reuse it
+    # attitude = handles of AHRS_INPUTS, a Session's, default the module's
+    if encoder is None:
+        encoder = codec.AhrsEncoder()
+
     if task == 'high':
-        header = b'\x7f\xff'
-        identifier = b'\xfe\x00' 
-      
-        scalefactor = 32767 / 180  #scale factor for pitch, roll, yaw
-        scaled_roll = int (xplane.get_value('roll') * scalefactor)
-        scaled_yaw = int (xplane.get_value('heading_mag') * scalefactor)
-        #print(yaw)
-        #print(scaled_yaw)
-        scaled_pitch = int (xplane.get_value('pitch') * scalefactor)
-        scaled_alt = int (xplane.get_value('asl') * 3.28084 + 5000)    # Unsigned value with 5000’ offset (meters to ft)
-        #print(altitude)
-        #print(scaled_alt)
-        scaled_vspeed = int (xplane.get_value('v_speed') * 196.85)      # m/s to ft/min
-        scaled_vind = int (xplane.get_value('ias') * 1.68781 * 10)      # kt to 0.1 ft/sc
-
-        airspeed_rate = 0
-        accel_roll_rate = 0
-        accel_normal_rate = 0
-    
+        roll, pitch, heading_mag, asl, v_speed, ias = _attitude if attitude is None else attitude
+        scalefactor = codec.AHRS_SCALE  #scale factor for pitch, roll, yaw
+        scaled_roll = int (roll.value * scalefactor)
+        scaled_yaw = int (heading_mag.value * scalefactor)
+        scaled_pitch = int (pitch.value * scalefactor)
+        scaled_alt = int (asl.value * 3.28084 + 5000)    # Unsigned value with 5000’ offset (meters to ft)
+        scaled_vspeed = int (v_speed.value * 196.85)      # m/s to ft/min
+        scaled_vind = int (ias.value * 1.68781 * 10)      # kt to 0.1 ft/sc
 
-        payload = struct.pack('>2s2shhHHhhhhh', header, identifier, scaled_roll, scaled_pitch, scaled_yaw, scaled_alt, scaled_vspeed, scaled_vind, airspeed_rate, accel_roll_rate, accel_normal_rate)
-    
+        return encoder.encode_high(scaled_roll, scaled_pitch, scaled_yaw, scaled_alt, scaled_vspeed, scaled_vind)
 
     else:       # lowrate
-        payload = b'\x7f\xff\xfd\x00\x05\xa1\x05\xa2\x05\xa3\x00\x00\x00\x64\x00\x2b\x00\x00\x00\x00'
-        
-    checksum = ((sum(payload[2:])) & 0xFF) ^ 0XFF
-    checksum = struct.pack('B', checksum)
+        return encoder.encode_low()
+
+
+class AhrsTarget:
+    '''One VM the AHRS frames are written to, over a non-blocking socket that heals itself
+
+    Connecting never blocks: connect() starts it and poll() finishes it, a failure closes the
+    socket and tries again after a backoff that doubles up to AHRS_RECONNECT_MAX. A frame the
+    socket can't take straight away is dropped rather than queued, all but the unsent tail of
+    a frame cut short, which goes out ahead of the next frame to keep the stream in step.
+    '''
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.sock = None
+        self.state = 'down'         # down, connecting or up
+        self.since = 0.0            # monotonic() the state was entered
+        self.retry_at = 0.0         # next connect attempt while down
+        self.backoff = AHRS_RECONNECT_MIN
+        self.pending = b''          # unsent tail of the last frame
+        self.frames = 0
+        self.dropped = 0
+        self.connects = 0
+        self.failures = 0
+        self.last_error = ''
+
+    def poll(self, now):
+        # start or finish connecting, call before every write
+        if self.state == 'down':
+            if now >= self.retry_at:
+                self.connect(now)
+        elif self.state == 'connecting':
+            writable = select.select((), (self.sock,), (), 0)[1]
+            if writable:
+                error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    self.fail(now, os.strerror(error))
+                else:
+                    self.up(now)
+            elif now - self.since > AHRS_CONNECT_TIMEOUT:
+                self.fail(now, 'connect timed out')
+
+    def connect(self, now):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     # a frame is small, send it now
+        self.sock = sock
+        self.state = 'connecting'
+        self.since = now
+        error = sock.connect_ex((self.ip, self.port))
+        if error == 0:
+            self.up(now)
+        elif error not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.fail(now, os.strerror(error))
+
+    def up(self, now):
+        self.state = 'up'
+        self.since = now
+        self.backoff = AHRS_RECONNECT_MIN
+        self.pending = b''
+        self.connects += 1
+        _log.info('AHRS connected to VM @ %s', self.ip)
+
+    def fail(self, now, error):
+        if self.state == 'up':
+            _log.warning('AHRS lost VM @ %s: %s', self.ip, error)
+        elif self.failures == 0 or self.last_error != str(error):
+            _log.warning('Can not connect to VM @ %s: %s, retrying every %.0f s at most', self.ip, error, AHRS_RECONNECT_MAX)
+        self.sock.close()
+        self.sock = None
+        self.state = 'down'
+        self.since = now
+        self.retry_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, AHRS_RECONNECT_MAX)
+        self.failures += 1
+        self.last_error = str(error)
+
+    def write(self, frame, now):
+        # True if the frame went out, whole or with a tail left for next time
+        if self.state != 'up':
+            return False
+        try:
+            if self.pending:
+                self.pending = self.pending[self.sock.send(self.pending):]
+                if self.pending:
+                    self.dropped += 1
+                    return False
+            sent = self.sock.send(frame)
+            if sent < len(frame):
+                self.pending = bytes(frame[sent:])
+            self.frames += 1
+            return True
+        except BlockingIOError:
+            self.dropped += 1
+        except OSError as e:
+            self.fail(now, e)
+        return False
+
+    def stats(self, now=None):
+        now = monotonic() if now is None else now
+        return {'state': self.state, 'for_s': round(now - self.since, 1), 'frames': self.frames, 'dropped': self.dropped,
+                'connects': self.connects, 'failures': self.failures, 'last_error': self.last_error}
+
+
+class AhrsBroadcaster:
+    '''Encodes every AHRS frame once and writes it to every VM, a slow or missing VM only loses its own frames'''
+
+    def __init__(self, ipaddresses, port, session=None):
+        self.targets = [AhrsTarget(ip, port) for ip in ipaddresses]
+        self.store = xplane.get_store(session)
+        self.attitude = _attitude if session is None else session.attitude
+        self.encoder = codec.AhrsEncoder()
+        self.counts = None          # the scheduler thread's counters, fetched in send()
+
+    def send(self, task):
+        counts = self.counts
+        if counts is None:
+            counts = self.counts = instrument.counters()
+        now = monotonic()
+        for target in self.targets:
+            target.poll(now)
+
+        # skip frames while xplane isn't sending, paused or gone
+        if not self.store.all_fresh('ahrs'):
+            return
+        try:
+            frame = ahrs_data(task, self.encoder, self.attitude)
+        except Exception as e:
+            counts['ahrs_errors'] += 1
+            _log.error('ahrs: %s = %s', type(e), e)
+            return
+        counts['ahrs_frames'] += 1
+        for target in self.targets:
+            if not target.write(frame, now):
+                counts['ahrs_dropped'] += 1
+        if latency.enabled and task == 'high':
+            latency.since('ahrs', latency.oldest(self.store.stamp, self.store.groups['ahrs']))
+
+    def stats(self):
+        now = monotonic()
+        return {target.ip: target.stats(now) for target in self.targets}
+
+
+# AHRS data to the VMs' serial ports, one thread for all of them
+def ahrs(ipaddresses, port, session=None):
+    global broadcaster
+    xplane.ready('ahrs', session).wait()     # nothing to send until xplane has sent the attitude
+    sender = AhrsBroadcaster(ipaddresses, port, session)
+    if session is None:
+        broadcaster = sender
+    else:
+        session.broadcaster = sender
+
+    schedule = ahrs_scheduler(sender.send)
+    (schedulers if session is None else session.schedulers)['ahrs'] = schedule
+    schedule.run()
+
+
+# Per VM state, frames and drops of the AHRS output
+def ahrs_health(session=None):
+    sender = broadcaster if session is None else session.broadcaster
+    return sender.stats() if sender is not None else {}
+
+
+# High rate attitude and low rate frames on their own deadlines, send(task) puts one frame out
+def ahrs_scheduler(send, high_hz=None):
+    high_hz = AHRS_HIGH_HZ if high_hz is None else high_hz
+    return scheduler.Scheduler([
+        scheduler.Stream('high', high_hz, lambda: send('high'), AHRS_POLICY),
+        scheduler.Stream('low', AHRS_LOW_HZ, lambda: send('low'), AHRS_POLICY, offset=0.5 / high_hz),
+    ])
+
+
+class BaudBudget:
+    '''Bytes a serial line can take, refilled at its baud rate
+
+    A frame is only written once the budget has paid for it. The budget starts empty and holds
+    no more than burst bytes, so in any stretch of time no more is written than the line carries
+    plus burst, and never more than burst bytes wait in the port, at most burst / rate seconds.
+    '''
+
+    def __init__(self, baud, burst, bits=SERIAL_BITS):
+        self.rate = baud / bits     # bytes a second
+        self.burst = burst
+        self.credit = 0.0
+        self.last = monotonic()
+        self.backlog = 0.0          # bytes written that the line hasn't carried yet
+        self.backlog_max = 0.0
+
+    def spend(self, size, reserve=0, now=None):
+        # pay for size bytes if that leaves reserve bytes of credit, False if it doesn't
+        now = monotonic() if now is None else now
+        carried = (now - self.last) * self.rate
+        self.last = now
+        self.credit = min(self.burst, self.credit + carried)
+        self.backlog = max(0.0, self.backlog - carried)
+        if self.credit - size < reserve:
+            return False
+        self.credit -= size
+        self.backlog += size
+        if self.backlog > self.backlog_max:
+            self.backlog_max = self.backlog
+        return True
+
+
+class SerialSink:
+    '''AHRS frames, and NMEA GPS sentences if gps_hz, out of a real or virtual serial port
+
+    Frames are scheduled like the VM output, high rate attitude first. Every frame is paid for
+    from a BaudBudget before it is written. Low rate and GPS frames leave room for an attitude
+    frame, and a frame the budget can't pay for is skipped rather than queued, so attitude always
+    goes first and what is written is never more than SERIAL_MAX_DELAY behind the line.
+    A frame has to fit in that delay next to an attitude frame: NMEA is left out at baud rates
+    too slow for it (below ~21000 baud), and a port too slow even for the AHRS frames is refused.
+    port is a device name (a pty slave works) or an open serial.Serial.
+    '''
+
+    def __init__(self, port, baud=SERIAL_BAUD, gps_hz=SERIAL_GPS_HZ, session=None, high_hz=None):
+        if isinstance(port, str):
+            port = serial.Serial(port, baud, write_timeout=0)      # non-blocking writes
+        self.port = port
+        self.baud = baud
+        self.gps_hz = gps_hz
+        self.high_hz = AHRS_HIGH_HZ if high_hz is None else high_hz
+        self.store = xplane.get_store(session)
+        self.attitude = _attitude if session is None else session.attitude
+        self.get = _getter(session)
+        self.encoder = codec.AhrsEncoder()
+        self.budget = BaudBudget(baud, baud / SERIAL_BITS * SERIAL_MAX_DELAY)
+        name = getattr(port, 'port', port)
+        if codec.AHRS_LOW_SIZE + codec.AHRS_HIGH_SIZE > self.budget.burst:
+            raise ValueError(f'Serial {name}: {baud} baud is too slow to carry AHRS frames within {SERIAL_MAX_DELAY * 1e3:.0f} ms')
+        if gps_hz and codec.NMEA_MAX_SIZE + codec.AHRS_HIGH_SIZE > self.budget.burst:
+            _log.warning('Serial %s: no NMEA GPS at %d baud, a sentence would hold attitude up for more than %.0f ms',
+                         name, baud, SERIAL_MAX_DELAY * 1e3)
+            self.gps_hz = gps_hz = 0
+        self.pending = b''          # unsent tail of a frame the port only took part of
+        self.sent = dict.fromkeys(('high', 'low', 'rmc', 'gga'), 0)
+        self.skipped = dict.fromkeys(self.sent, 0)
+        self.bytes = 0
+
+        demand = (self.high_hz * codec.AHRS_HIGH_SIZE + AHRS_LOW_HZ * codec.AHRS_LOW_SIZE
+                  + 2 * gps_hz * codec.NMEA_MAX_SIZE)
+        if demand > self.budget.rate:
+            _log.warning('Serial %s: frames need up to %.0f bytes/s, %d baud carries %.0f, low rate and GPS frames are dropped first',
+                         name, demand, baud, self.budget.rate)
+
+    def frame(self, kind):
+        if kind == 'high' or kind == 'low':
+            return ahrs_data(kind, self.encoder, self.attitude)
+        get = self.get
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if kind == 'rmc':
+            return codec.gprmc(now, get('latitude'), get('longitude'), get('gnd_speed') * 1.94384,
+                               get('heading_actual'), get('mag_var'))
+        return codec.gpgga(now, get('latitude'), get('longitude'), get('asl'))
+
+    def send(self, kind):
+        if not self.store.all_fresh('ahrs' if kind in ('high', 'low') else 'interlink'):
+            return
+        port = self.port
+        if self.pending:
+            self.pending = self.pending[port.write(self.pending) or 0:]       # already paid for
+            if self.pending:
+                self.skipped[kind] += 1     # the port is still full, only happens if the line is slower than baud
+                return
+
+        frame = self.frame(kind)
+        if not self.budget.spend(len(frame), 0 if kind == 'high' else codec.AHRS_HIGH_SIZE):
+            self.skipped[kind] += 1
+            return
+        written = port.write(frame) or 0
+        if written < len(frame):
+            self.pending = bytes(frame[written:])
+        self.sent[kind] += 1
+        self.bytes += len(frame)
+        if latency.enabled and kind == 'high':
+            latency.since('serial', latency.oldest(self.store.stamp, self.store.groups['ahrs']))
+
+    def scheduler(self):
+        schedule = ahrs_scheduler(self.send, self.high_hz)
+        if self.gps_hz:
+            schedule.add(scheduler.Stream('rmc', self.gps_hz, lambda: self.send('rmc'), AHRS_POLICY, offset=0.3 / self.high_hz))
+            schedule.add(scheduler.Stream('gga', self.gps_hz, lambda: self.send('gga'), AHRS_POLICY, offset=0.7 / self.high_hz))
+        return schedule
+
+    def stats(self):
+        return {'baud': self.baud, 'sent': dict(self.sent), 'skipped': dict(self.skipped), 'bytes': self.bytes,
+                'backlog_max_ms': self.budget.backlog_max / self.budget.rate * 1e3}
+
+
+# AHRS, and GPS, out of a serial port
+def serial_out(port, baud=SERIAL_BAUD, gps_hz=SERIAL_GPS_HZ, session=None):
+    xplane.ready('ahrs', session).wait()     # nothing to send until xplane has sent the attitude
+    try:
+        sink = SerialSink(port, baud, gps_hz, session)
+    except (ValueError, serial.SerialException) as e:
+        _log.error('%s', e)
+        return
+    sinks[port] = sink
+    schedule = sink.scheduler()
+    (schedulers if session is None else session.schedulers)[f'serial {port}'] = schedule
+    schedule.run()
 
-    return (payload + checksum)
 
 
-# AHRS data to serial port
-def ahrs(ip, port):
-    sleep(2)
-    index = 0
-    connect = False
-    sock =  socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-    sock.getsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR) 
-    
-    try:
-        sock.connect((ip, port))
-        connect = True
-    except:
-        print(f'Can not connect to VM @ {ip}')
-
-    while connect:
-        #TODO only do this is xplane has data
-        if (xplane.get_value('roll')):
-            if index < 15:
-                packet = ahrs_data('high')
-        
-            if index == 15:
-                packet = ahrs_data('low')
-                index = -1   
-
-            try:
-                sock.send(packet)
-                index += 1
-                sleep(0.05)
-            except Exception as e: 
-                print(f'Link ahrs: {type(e)} = {e}')
-                pass
-
-    print(f'Closing hxr_Serial {ip}')
-    sock.close()
+# the interlink encoders read a Session's store and fill its buffers, or the module's
+def _getter(session):
+    return xplane.get_value if session is None else functools.partial(xplane.get_value, session=session)
+
 
+def _encoder(session):
+    return _interlink if session is None else session.interlink
 
 
 # GPS GPRMC
-def gps0(): 
+def gps0(session=None): 
     # time, date, position, speed, mag var, from current GPS source, like data in GPRMC
-    payload = bytearray()
-    payload.append(0x09)        #Packet Type
-    
+    get = _getter(session)
     timeNow = datetime.datetime.now()
-    year = str(timeNow.year)
-    year = int(year[2:])
-    timeBits = GPSDateTimes()
-    timeBits.bit.month = timeNow.month
-    timeBits.bit.day = timeNow.day
-    timeBits.bit.hour = timeNow.hour
-    timeBits.bit.min = timeNow.minute
-    timeBits.bit.sec = timeNow.second
-    timeBits.bit.status = 1
-
-    track = int(xplane.get_value('heading_actual')*10)
-    magvar = int(xplane.get_value('mag_var')*100) 
-    gndspeed = int(xplane.get_value('gnd_speed')*10*1.94384)
-    bits = 0
-
-    payload.append(0x00)                     #Byte 0: 00 = GPS position packet
-    payload.append(year)                     #Byte 1: Last two digits of year (year mod 100), zero if unknown
-    payload.extend(struct.pack('I', timeBits.asByte))          #Byte 2-5: packed LSB first: month (4 bits) | day (5 bits) | hour (5 bits) | min (6 bits) | sec (6 bits) | status (1 bit)
-                                                #The date and time fields are all zeroes if unknown.
-                                                #The status bit is 1 when the GPS has indicated its data is valid.
-                                                #The EFIS may try to use this data as a time source if the day is non-zero and status is 1.
-    payload.extend(struct.pack('ff', xplane.get_value('latitude'), xplane.get_value('longitude')))   #Byte 6-9: latitude (32-bit float)
-                                                                    #Byte 10-13: longitude (32-bit float)
-    payload.extend(struct.pack(">HhHb", track, magvar, gndspeed, bits))  #Byte 14-15: Ground track in tenths of a degree, MSB first
-                                                                    #Byte 16-17: Magnetic variation in hundredths of a degree, MSB first, positive west
-                                                                    #Byte 18-19: Ground speed in tenths of a knot, MSB first
-                                                                    #Byte 20: bit field
-                                                                        #Bit 0 = GPS2 input is configured on this unit
-                                                                        #Bit 1 = This data is from GPS2
-    return payload
+    year = timeNow.year % 100                #Last two digits of year (year mod 100), zero if unknown
+    timeBits = codec.gps_datetime(timeNow)   #The status bit is 1 when the GPS has indicated its data is valid.
+                                             #The EFIS may try to use this data as a time source if the day is non-zero and status is 1.
+
+    track = int(get('heading_actual')*10)          #Ground track in tenths of a degree
+    magvar = int(get('mag_var')*100)               #Magnetic variation in hundredths of a degree, positive west
+    gndspeed = int(get('gnd_speed')*10*1.94384)    #Ground speed in tenths of a knot
+    bits = 0                                                    #Bit 0 = GPS2 input is configured on this unit
+                                                                #Bit 1 = This data is from GPS2
+
+    # copy out of the encoder buffer, the payload waits in efis.q
+    return bytes(_encoder(session).gps0(year, timeBits, get('latitude'), get('longitude'), track, magvar, gndspeed, bits))
 
 
 # GPS Time
-def gps3():
+def gps3(session=None):
     # time and date from GPS1 and/or GPS2 independent of current GPS source
-    payload = bytearray()
-    payload.append(0x09)        #Packet Type
-    
     timeNow = datetime.datetime.now()
-    year = str(timeNow.year)
-    year = int(year[2:])
-    timeBits = GPSDateTimes()
-    timeBits.bit.month = timeNow.month
-    timeBits.bit.day = timeNow.day
-    timeBits.bit.hour = timeNow.hour
-    timeBits.bit.min = timeNow.minute
-    timeBits.bit.sec = timeNow.second
-    timeBits.bit.status = 1
-
-    payload.append(0x03)                #Byte 0: 03 = time/date
-    payload.append(0x00)                #Byte 1: GPS Source (pretty sure)
-    payload.append(year)                #Byte 2: Last two digits of year (year mod 100), zero if unknown
-    payload.extend(struct.pack('I', timeBits.asByte))          #Byte 3-6: packed LSB first: month (4 bits) | day (5 bits) | hour (5 bits) | min (6 bits) | sec (6 bits) | status (1 bit)
-                                                #The date and time fields are all zeroes if unknown.
-                                                #The status bit is 1 when the GPS has indicated its data is valid.
-                                                #The EFIS may try to use this data as a time source if the day is non-zero and status is 1.
-    return payload
+    year = timeNow.year % 100
+    timeBits = codec.gps_datetime(timeNow)
+
+    return bytes(_encoder(session).gps3(year, timeBits))
 
 
 # GPS GPGGA
-def gps4():
+def gps4(session=None):
     # GPS altitude and geoidal difference, fix quality, number of satellites used, from current GPS source, like data in GPGGA   */        //Gps position packet
-    payload = bytearray()
-    payload.append(0x09)        #Packet Type
-
-    gpsAltitude = int(xplane.get_value('asl'))   #in meters
+    get = _getter(session)
+    gpsAltitude = int(get('asl'))   #in meters
     geoidal = 0
 
-    payload.append(0x04)    
-    payload.append(0x03)        #Gps Mode      3 = Auto Fix 3D
-    payload.append(0x00)        #Gps source
-    payload.append(0x05)        #SatInCalculation 
-    payload.extend(struct.pack('ff', gpsAltitude, geoidal))    
-
-    return payload
+    return bytes(_encoder(session).gps4(gpsAltitude, geoidal))
 
 
 # Engine data to EFIS interlink
-def eis():
-    payload = bytearray()
-    payload.append(0x0F)            #Packet Type = EIS1 0x0F    EIS2 0x27
-    
+def eis(session=None):
     #convert and scale variables
+    get = _getter(session)
     cht = [0] * 6
     egt = [0] * 9
     aux = [0] * 6
 
-    rpm = int(xplane.get_value('rpm'))
+    rpm = int(get('rpm'))
     if rpm < 0:
         rpm = 0
-    cht[0:4] = (int(xplane.get_value('cht')),) * 4    #wrap scalar in an iterable
-    egt[0:4] = (int(xplane.get_value('egt')),) * 4
+    cht[0:4] = (int(get('cht')),) * 4    #wrap scalar in an iterable
+    egt[0:4] = (int(get('egt')),) * 4
     airspeed = 0        #not displayed in EFIS
     altimeter = 0       #not displayed in EFIS
-    volts = float(xplane.get_value('volts'))
-    fuelflow = float(xplane.get_value('fuelflow') * 1286.33)      #convert kg_sec to gal_hour xx.x
+    volts = float(get('volts'))
+    fuelflow = float(get('fuelflow') * 1286.33)      #convert kg_sec to gal_hour xx.x
     internaltemp = 0        #Don't think is used in EFIS
     manifoldtemp = -100        #aka carb temperature
     verticalspeed = 0       #Not sure if used in EFIS
-    oat = int(xplane.get_value('oat'))
-    oiltemp = int(xplane.get_value('oiltemp'))
-    oilpressure = int(xplane.get_value('oilpressure'))
-    aux[0] = int(xplane.get_value('manifoldpressure') * 10)
-    aux[1] = int(xplane.get_value('fuelpressure') * 10)
-    aux[2] = 0
-    aux[3] = 0
-    aux[4] = 0
-    aux[5] = 0
+    oat = int(get('oat'))
+    oiltemp = int(get('oiltemp'))
+    oilpressure = int(get('oilpressure'))
+    aux[0] = int(get('manifoldpressure') * 10)
+    aux[1] = int(get('fuelpressure') * 10)
     coolanttemp = 0
-    hobbs = float(xplane.get_value('hobbs') / 3600)
-    fuelqty = float((xplane.get_value('fuel_qty_left') + xplane.get_value('fuel_qty_right')) / 2.72155)         #gallon is 2.72155kg (6lbs)
-    flight_hrs = (int(xplane.get_value('flighttime') / 3600))         #HH:MM:SS
-    flight_min = (int((xplane.get_value('flighttime') % 3600) / 60))
-    flight_sec = (int((xplane.get_value('flighttime') % 3600) % 60))
+    hobbs = float(get('hobbs') / 3600)
+    fuelqty = float((get('fuel_qty_left') + get('fuel_qty_right')) / 2.72155)         #gallon is 2.72155kg (6lbs)
+    flight_hrs = (int(get('flighttime') / 3600))         #HH:MM:SS
+    flight_min = (int((get('flighttime') % 3600) / 60))
+    flight_sec = (int((get('flighttime') % 3600) % 60))
     fuelflowtime = 0                        #Fuel Flow Time until empty HH:MM
-    baropressure = float(xplane.get_value('baropressure'))       #Not sure if being used
+    baropressure = float(get('baropressure'))       #Not sure if being used
     savebit = 0                 #The bits are set when we see 10 zero values in a row
                                 #Bit0 = tachometer has stopped (steady at zero)   
                                 #Bit1 = fuel flow has stopped (steady at zero)
@@ -246,18 +546,13 @@ def eis():
     rpm2 = 0
     eisver = 59             #0x00 0x3B
 
-    payload.extend(struct.pack(">H6H9HH", rpm, cht[0], cht[1], cht[2], cht[3], cht[4], cht[5], egt[0], egt[1], egt[2], egt[3], egt[4], egt[5], egt[6], egt[7], egt[8], airspeed))
-    payload.extend(struct.pack("<fff", altimeter, volts, fuelflow))
-    payload.extend(struct.pack(">bbfhHB", internaltemp, manifoldtemp, verticalspeed, oat, oiltemp, oilpressure))
-    payload.extend(struct.pack(">hhhhhhH", aux[0], aux[1], aux[2], aux[3], aux[4], aux[5], coolanttemp))
-    payload.extend(struct.pack("<ff", hobbs, fuelqty))
-    payload.extend(struct.pack(">BBBH", flight_hrs, flight_min, flight_sec, fuelflowtime))
-    payload.extend(struct.pack("<f", baropressure))
-    payload.extend(struct.pack(">BHH", savebit, rpm2, eisver))
+    payload = _encoder(session).eis(rpm, cht, egt, airspeed, altimeter, volts, fuelflow, internaltemp, manifoldtemp, verticalspeed,
+                             oat, oiltemp, oilpressure, aux, coolanttemp, hobbs, fuelqty, flight_hrs, flight_min, flight_sec,
+                             fuelflowtime, baropressure, savebit, rpm2, eisver)
 
  #   print(binascii.hexlify(payload))
 
-    return payload
+    return bytes(payload)
 
 
 
@@ -266,6 +561,9 @@ def eis():
  
 
 
+INTERLINK_ENCODERS = {'gps0': gps0, 'gps3': gps3, 'gps4': gps4, 'eis': eis}
+
+
 if __name__ == "__main__":
     link()
     
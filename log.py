@@ -0,0 +1,152 @@
+'''Logging for the bridge that never holds up a receive or transmit loop
+
+Every subsystem logs to its own logger under 'xlink' (xlink.xplane, xlink.efis, xlink.link, ...)
+so verbosity can be set per subsystem. setup() puts a QueueHandler on the 'xlink' logger and a
+QueueListener thread formats the records and does the console I/O, a loop only pays for
+putting the record on a queue.
+
+RateLimit lets the first BURST records of a message through every PERIOD seconds and counts the
+rest, then logs one summary like "Unknown packet %s (x350 in 10 s)". Records of the same message
+with different arguments count as the same message.
+
+Hex(data) formats bytes as hex only when the record is actually going to be written.
+
+main.py --log debug                 everything at DEBUG
+main.py --log efis=debug            one subsystem, can be repeated
+'''
+
+import binascii
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+BURST = 5               # records of one message let through per period
+PERIOD = 10.0           # seconds
+FORMAT = '(%(threadName)-9s) %(name)s: %(message)s'
+
+listener = None         # the QueueListener once setup() has run
+
+
+def get(subsystem):
+    return logging.getLogger(f'xlink.{subsystem}')
+
+
+class Hex:
+    '''bytes shown as hex, formatted only if the record is written'''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.hexlify(bytes(self.data)).decode()
+
+
+class RateLimit(logging.Filter):
+    '''At most BURST records per message per PERIOD, the rest are counted and summarised'''
+
+    def __init__(self, burst=BURST, period=PERIOD):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.lock = threading.Lock()
+        self.windows = {}       # (logger, msg) -> [window start, records in window, a record to summarise with]
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        closed = None
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                closed = window
+                self.windows[key] = [now, 1, record]
+                allow = True
+            else:
+                window[1] += 1
+                window[2] = record
+                allow = window[1] <= self.burst
+
+        if closed is not None and closed[1] > self.burst:
+            self.summarise(closed, now)
+        return allow
+
+    def summarise(self, window, now):
+        start, count, record = window
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = f'{record.msg} (x{count - self.burst} more in {now - start:.0f} s)'
+        summary.exc_info = None
+        logging.getLogger(record.name).handle(summary)      # comes back through filter() as a new message
+
+    def flush(self):
+        # summarise the windows that have closed but haven't seen another record since
+        now = time.monotonic()
+        with self.lock:
+            closed = [key for key, window in self.windows.items() if now - window[0] >= self.period]
+            windows = [self.windows.pop(key) for key in closed]
+        for window in windows:
+            if window[1] > self.burst:
+                self.summarise(window, now)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''Puts records on the queue unformatted, the listener thread formats them
+
+    The stock prepare() merges msg and args on the calling thread, this one leaves that to the
+    console handler. Hex arguments are copied to bytes first, as their buffer may be reused
+    before the listener gets to them. Only records that pass the level and RateLimit get here.
+    '''
+
+    def prepare(self, record):
+        if isinstance(record.args, tuple):
+            for arg in record.args:
+                if isinstance(arg, Hex):
+                    arg.data = bytes(arg.data)
+        return record
+
+
+def setup(level='INFO', levels=None):
+    '''Send the 'xlink' loggers through a queue to a background console writer
+
+    level is the default, levels maps a subsystem to its own level, like {'efis': 'DEBUG'}
+    '''
+    global listener
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    limit = RateLimit()
+    handler.addFilter(limit)
+
+    root = logging.getLogger('xlink')
+    root.handlers[:] = [handler]
+    root.propagate = False
+    root.setLevel(level.upper())
+    for subsystem, sub_level in (levels or {}).items():
+        get(subsystem).setLevel(sub_level.upper())
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(records, console)
+    listener.start()
+
+    def flush():
+        while True:
+            time.sleep(limit.period)
+            limit.flush()
+    threading.Thread(target=flush, name='log', daemon=True).start()
+    return listener
+
+
+def parse(specs):
+    # ['debug', 'efis=info'] -> ('DEBUG', {'efis': 'INFO'})
+    level = 'INFO'
+    levels = {}
+    for spec in specs or ():
+        if '=' in spec:
+            subsystem, sub_level = spec.split('=', 1)
+            levels[subsystem] = sub_level
+        else:
+            level = spec
+    return level, levels
@@ -1,25 +1,87 @@
+import argparse
 from threading import Thread
-from xplane import xplane, efis_updating
+from xplane import xplane, efis_updating, set_rpos_hz
 from efis import efis
-from link import link
+from link import link, serial_out
 
 
 VM_IP = {'127.0.0.1', '192.168.0.1'}    #hardcoded IP address of VM boxes to send AHRS over TCP
 VM_PORT = 12345
 
-#Listen for beacon and start UDP link to XPlane
-t = Thread(target=xplane)
-t.start()
+parser = argparse.ArgumentParser(description='GRT HXr EFIS to Xplane link')
+parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                    help='thread per socket (default) or everything on one asyncio event loop')
+parser.add_argument('--record', metavar='PATH',
+                    help='append every X-Plane and EFIS packet to a capture log, replay it with capture.py')
+parser.add_argument('--latency', nargs='?', const=0, type=int, metavar='PORT',
+                    help='measure X-Plane to EFIS/AHRS latency, print a summary and serve it on 127.0.0.1:PORT')
+parser.add_argument('--sessions', metavar='PATH',
+                    help='JSON list of sessions, one X-Plane and EFIS subnet each, run side by side, see session.py')
+parser.add_argument('--workers', type=int, metavar='N',
+                    help='with --sessions, spread the sessions over N processes with their values in shared memory, see shard.py')
+parser.add_argument('--serial', action='append', metavar='PORT',
+                    help='also send AHRS frames and NMEA GPS out of a serial port, can be repeated, see link.SerialSink')
+parser.add_argument('--baud', type=int, default=115200, help='baud rate of the --serial ports')
+parser.add_argument('--rpos-hz', type=int, metavar='HZ',
+                    help='RPOS packets a second from X-Plane, 0 = get the position over RREF, with --sessions set rpos_hz per session')
+parser.add_argument('--log', action='append', metavar='[SUBSYSTEM=]LEVEL',
+                    help='log level, for everything or one of xplane, efis, link, scheduler, can be repeated')
+args = parser.parse_args()
+if args.sessions and args.engine == 'asyncio':
+    parser.error('--sessions runs on the thread engine only')
+if args.serial and (args.sessions or args.engine == 'asyncio'):
+    parser.error('--serial runs on the thread engine without --sessions only')
+if args.rpos_hz is not None and args.sessions:
+    parser.error('--rpos-hz is set per session in the --sessions file')
 
-#Listens for EFIS's over UDP then setups up direct connection via TCP
-t = Thread(target=efis)
-t.start() 
+import log
+log.setup(*log.parse(args.log))
 
-#TCP data to EFIS's virtual serial ports, (packets that aren't in the interlink) 
-t = Thread(target=link(VM_IP, VM_PORT))
-t.start()
+if args.rpos_hz is not None:
+    set_rpos_hz(args.rpos_hz)
+
+import instrument
+instrument.install()        # kill -USR1 profiles, kill -USR2 prints the counters
+
+if args.latency is not None:
+    import latency
+    latency.enable(args.latency)
+
+if args.record:
+    import capture
+    capture.record(args.record)
+
+if args.engine == 'asyncio':
+    import aio
+    aio.run(VM_IP, VM_PORT)
+
+elif args.sessions and args.workers:
+    import shard
+    shard.run(args.sessions, args.workers, args.log)
+
+elif args.sessions:
+    import session
+    session.run(session.load(args.sessions))
+
+else:
+    #Listen for beacon and start UDP link to XPlane
+    t = Thread(target=xplane)
+    t.start()
+
+    #Listens for EFIS's over UDP then setups up direct connection via TCP
+    t = Thread(target=efis)
+    t.start() 
+
+    #TCP data to EFIS's virtual serial ports, (packets that aren't in the interlink) 
+    t = Thread(target=link, args=(VM_IP, VM_PORT))
+    t.start()
+
+    #AHRS straight out of serial ports, within their baud rate
+    for port in args.serial or ():
+        t = Thread(target=serial_out, args=(port, args.baud))
+        t.start()
 
 
 #g = input("Enter your name : ") 
 #if g == '1':
-#    efis_updating('com1_freq', 12344)
\ No newline at end of file
+#    efis_updating('com1_freq', 12344)
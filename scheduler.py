@@ -0,0 +1,127 @@
+'''Deadline scheduler for periodic streams, like the AHRS high and low rate frames
+
+Every stream has its own rate. Deadlines come from time.monotonic_ns and step forward a whole
+period from the previous deadline, never from when the last frame went out, so encode and send
+time don't pull the rate down. When a stream falls a period or more behind, its policy decides:
+    SKIP        drop the missed deadlines and carry on from the next one
+    CATCHUP     run the missed deadlines back to back, at most max_catchup of them, skip the rest
+
+poll() runs whatever is due and says how long to sleep, so the same scheduler works from a
+thread (run) or from an event loop (await asyncio.sleep(scheduler.poll())).
+'''
+
+import time
+
+import log
+
+
+SKIP = 'skip'
+CATCHUP = 'catchup'
+
+IDLE = 0.1          # seconds to sleep when there is nothing to schedule
+
+_log = log.get('scheduler')
+
+
+class Stream:
+    '''One periodic job and its timing statistics'''
+    __slots__ = ('name', 'period', 'func', 'policy', 'max_catchup', 'offset', 'deadline',
+                 'sent', 'missed', 'errors', 'late_total', 'late_max', 'first', 'last')
+
+    def __init__(self, name, hz, func, policy=SKIP, max_catchup=5, offset=0.0):
+        self.name = name
+        self.period = int(1e9 / hz)         # ns
+        self.func = func
+        self.policy = policy
+        self.max_catchup = max_catchup
+        self.offset = int(offset * 1e9)     # ns after the scheduler starts, spreads streams apart
+        self.deadline = None
+        self.sent = 0
+        self.missed = 0
+        self.errors = 0
+        self.late_total = 0                 # ns, how far past its deadline each run started
+        self.late_max = 0
+        self.first = None
+        self.last = None
+
+    def run(self, now):
+        late = now - self.deadline
+        try:
+            self.func()
+        except Exception as e:
+            self.errors += 1
+            _log.error('%s: %s = %s', self.name, type(e), e)
+
+        self.sent += 1
+        self.late_total += late
+        if late > self.late_max:
+            self.late_max = late
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.deadline += self.period
+
+    def stats(self):
+        elapsed = self.last - self.first if self.sent else 0
+        return {
+            'hz': (self.sent - 1) * 1e9 / elapsed if elapsed else 0.0,
+            'sent': self.sent,
+            'missed': self.missed,
+            'errors': self.errors,
+            'jitter_mean_ms': self.late_total / self.sent / 1e6 if self.sent else 0.0,
+            'jitter_max_ms': self.late_max / 1e6,
+        }
+
+
+class Scheduler:
+    '''Runs a set of Streams on their deadlines'''
+
+    def __init__(self, streams=(), clock=time.monotonic_ns):
+        self.clock = clock
+        self.streams = []
+        self.start = None
+        for stream in streams:
+            self.add(stream)
+
+    def add(self, stream):
+        if self.start is not None:
+            stream.deadline = self.clock() + stream.offset
+        self.streams.append(stream)
+        return stream
+
+    def poll(self):
+        # run everything that is due, returns seconds until the next deadline
+        now = self.clock()
+        if self.start is None:
+            self.start = now
+            for stream in self.streams:
+                stream.deadline = now + stream.offset
+
+        for stream in self.streams:
+            if now < stream.deadline:
+                continue
+
+            behind = (now - stream.deadline) // stream.period      # whole periods missed
+            if behind:
+                runs = min(behind, stream.max_catchup) if stream.policy == CATCHUP else 0
+                stream.missed += behind - runs
+                stream.deadline += (behind - runs) * stream.period
+                for _ in range(runs):
+                    stream.run(now)
+            stream.run(now)
+            now = self.clock()
+
+        if not self.streams:
+            return IDLE
+        wait = min(stream.deadline for stream in self.streams) - now
+        return wait / 1e9 if wait > 0 else 0.0
+
+    def run(self, stop=None):
+        # until stop (a threading.Event) is set
+        while stop is None or not stop.is_set():
+            delay = self.poll()
+            if delay:
+                time.sleep(delay)
+
+    def stats(self):
+        return {stream.name: stream.stats() for stream in self.streams}
@@ -0,0 +1,95 @@
+'''Sessions, one simulator bridged to one set of displays, several of them in one process
+
+A Session owns what used to be module state for a single cockpit: its DatarefStore and RREF
+Subscriptions, the X-Plane send queue, the EFIS Bus with its state variable Coalescer and
+clients, the interlink encoder buffers and the AHRS handles. The X-Plane, EFIS and link loops
+take a session argument and work on its state, without one they use the module state as before.
+The encoders, framing and CRC code is shared, only the buffers are per session.
+
+Every session talks to its own X-Plane and owns the EFIS on its own subnet. One EFIS UDP
+listener serves all the sessions, as every display pings EFIS_PORT.
+    xplane_addr     'host:port' of X-Plane, 'host' to take the beacon from that host only,
+                    None for the first beacon heard
+    efis_subnet     displays pinging from this subnet belong to the session, None = any
+    vm_ips          AHRS VMs, sent to on vm_port
+    rpos_hz         RPOS packets a second from its X-Plane, 0 = the RPOS fields over RREF, default xplane.RPOS_HZ
+
+sessions.json, a list of Session arguments:
+    [{"name": "seat1", "xplane_addr": "10.0.1.11:49000", "efis_subnet": "192.168.1.0/24", "vm_ips": ["192.168.1.50"]},
+     {"name": "seat2", "xplane_addr": "10.0.1.12", "efis_subnet": "192.168.2.0/24"}]
+Run: python main.py --sessions sessions.json
+'''
+
+import ipaddress
+import json
+import queue
+import threading
+
+import codec
+import efis
+import latency
+import link
+import xplane
+
+
+VM_PORT = 12345             # AHRS port on the VMs, as in main.py
+
+
+class Session:
+    '''One X-Plane, the EFIS on one subnet and the AHRS VMs that go with them'''
+
+    def __init__(self, name, xplane_addr=None, efis_subnet=None, vm_ips=(), vm_port=VM_PORT, rpos_hz=xplane.RPOS_HZ):
+        self.name = name
+        self.xplane_addr = xplane_addr
+        self.subnet = ipaddress.ip_network(efis_subnet) if efis_subnet else None
+        self.vm_ips = tuple(vm_ips)
+        self.vm_port = vm_port
+        self.rpos_hz = rpos_hz
+
+        self.store, self.subscriptions = xplane.new_store(rpos_hz)
+        self.rpos_index = xplane.rpos_index(self.store)
+        self.attitude = tuple(self.store.handle(ref) for ref in link.AHRS_INPUTS)
+        self.xplane_q = latency.TimedQueue(f'{name}.xplane.q') if latency.enabled else queue.Queue()
+        self.efis_q = efis.Bus()
+        self.statevars = efis.Coalescer(self.efis_q)
+        self.clients = {}           # EFIS ip -> its tcp thread, outbox and timeout timer
+        self.interlink = codec.InterlinkEncoder()
+        self.schedulers = {}        # 'ahrs' and 'interlink' schedulers
+        self.broadcaster = None     # link.AhrsBroadcaster once the AHRS output runs
+        self.payloads = {}          # interlink Payload by name
+
+    def owns(self, ip):
+        # an EFIS pinging from ip is one of ours
+        return self.subnet is None or ipaddress.ip_address(ip) in self.subnet
+
+    def find_xplane(self):
+        # {'ip', 'port'} like xplane.find_beacon()
+        if self.xplane_addr is None:
+            return xplane.find_beacon()
+        host, _, port = self.xplane_addr.partition(':')
+        if port:
+            return {'ip': host, 'port': int(port)}
+        return xplane.find_beacon(host)
+
+    def start(self):
+        # the X-Plane link and the producers, the EFIS listener is shared, see run()
+        threading.Thread(target=xplane.xplane, args=(self,), name=f'{self.name}.xplane').start()
+        threading.Thread(target=link.link, args=(self.vm_ips, self.vm_port, self), name=f'{self.name}.link').start()
+        return self
+
+    def stats(self):
+        return {'name': self.name, 'efis': sorted(self.clients), 'xplane_q': self.xplane_q.qsize(),
+                'statevar_packets': self.statevars.packets, 'interlink': link.interlink_stats(self),
+                'ahrs': link.ahrs_health(self)}
+
+
+def load(path):
+    # Sessions from a JSON list of Session arguments
+    with open(path) as f:
+        return [Session(**spec) for spec in json.load(f)]
+
+
+def run(sessions):
+    for session in sessions:
+        session.start()
+    threading.Thread(target=efis.efis, args=(sessions,), name='efis').start()
@@ -0,0 +1,96 @@
+'''Seats spread over worker processes, with every seat's dataref values in shared memory
+
+One process tops out at one core, the decode, encode and CRC work of every seat is pure
+Python under one GIL. start() splits the sessions (see session.py) round robin over worker
+processes, each runs its seats as threads like main.py --sessions does.
+
+The supervisor creates a datarefs.SharedTable per seat, named xlink_<seat>, before the
+workers start. A worker moves its seat's values and stamps into that table, so the supervisor,
+or any monitoring process with SharedTable.attach('xlink_<seat>'), reads them live and
+without copies. The supervisor removes the tables when it exits.
+
+Every worker listens for the EFIS UDP hellos on EFIS_PORT with SO_REUSEADDR, the displays
+broadcast them so every worker hears every display and takes the ones on its seats' subnets.
+
+Run: python main.py --sessions sessions.json --workers N
+     python shard.py sessions.json [workers]
+'''
+
+import atexit
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import datarefs
+
+
+TABLE_PREFIX = 'xlink_'     # shared memory name of a seat's table is the prefix and the seat name
+MONITOR_PERIOD = 5.0        # seconds between the supervisor's printouts
+MONITOR_NAMES = ('roll', 'pitch', 'ias', 'rpm')
+
+
+def table_name(seat):
+    return f'{TABLE_PREFIX}{seat}'
+
+
+def worker(specs, log_specs=None):
+    # one worker process, runs its seats on their own threads until it is killed
+    import log
+    import session
+
+    log.setup(*log.parse(log_specs))
+    sessions = [session.Session(**spec) for spec in specs]
+    for seat in sessions:
+        seat.store.share(datarefs.SharedTable.attach(table_name(seat.name)))
+    session.run(sessions)
+
+
+def start(specs, workers=None, log_specs=None):
+    '''Workers for the session specs, returns the processes and the SharedTable of every seat'''
+    workers = min(workers or os.cpu_count() or 1, len(specs))
+    tables = {spec['name']: datarefs.SharedTable.create(table_name(spec['name'])) for spec in specs}
+
+    def remove():
+        for table in tables.values():
+            table.close(unlink=True)
+    atexit.register(remove)
+
+    processes = []
+    for n in range(workers):
+        process = multiprocessing.Process(target=worker, args=(specs[n::workers], log_specs), name=f'shard{n}', daemon=True)
+        process.start()
+        processes.append(process)
+    print(f'Shard: {len(specs)} seats on {workers} worker processes')
+    return processes, tables
+
+
+def monitor(processes, tables, period=MONITOR_PERIOD):
+    # print a few live values of every seat straight from shared memory, until a worker dies
+    while all(process.is_alive() for process in processes):
+        time.sleep(period)
+        now = time.monotonic()
+        for seat, table in tables.items():
+            names = table.names()
+            values = ' '.join(f'{name}={table.values[names[name]]:.1f}' for name in MONITOR_NAMES if name in names)
+            newest = max(table.stamp[index] for index in names.values()) if names else 0
+            age = f'{(now - newest) * 1000:.0f} ms' if newest else 'never'
+            print(f'{seat:<12} {values}  last value {age} ago')
+    print('Shard: a worker stopped, ' + ' '.join(f'{p.name}={p.exitcode}' for p in processes))
+
+
+def run(path, workers=None, log_specs=None):
+    with open(path) as f:
+        specs = json.load(f)
+    processes, tables = start(specs, workers, log_specs)
+    try:
+        monitor(processes, tables)
+    except KeyboardInterrupt:
+        pass
+    for process in processes:
+        process.terminate()
+
+
+if __name__ == '__main__':
+    run(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
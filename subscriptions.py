@@ -0,0 +1,193 @@
+'''RREF subscription manager, keeps X-Plane's subscriptions in step with the dataref store
+
+Datarefs can be subscribed, re-rated and unsubscribed while running. A dataref's RREF index
+is its slot in the store, and the store recycles the slots of unsubscribed datarefs.
+Requests are queued and paced out SUBSCRIBE_BURST at a time, so (re)subscribing everything
+doesn't land on X-Plane as one burst of 413 byte datagrams. Datarefs subscribed as adaptive
+have their rate lowered while they change slowly, and raised again when they pick up.
+
+read(ref) gets a dataref's value once, without adding it to the store. It subscribes the
+ref on an index from a reserved pool (READ_BASE and up, well clear of the store), resolves
+a concurrent.futures.Future with the first value back and unsubscribes again. Reads of the
+same ref share one index, so any number of them can be in flight.
+'''
+
+import math
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+import datarefs
+
+import scheduler
+
+
+SUBSCRIBE_BURST = 10        # RREF requests sent per pacing tick
+PACE_HZ = 50                # pacing ticks a second
+ADAPT_PERIOD = 10.0         # seconds between looking at how often adaptive datarefs change
+ADAPT_MIN_HZ = 1            # adaptive datarefs never go below this rate
+
+READ_BASE = 10000           # first RREF index of the one-shot read pool
+READ_POOL = 64              # one-shot reads of different refs in flight at once
+READ_HZ = 20                # rate asked for while a one-shot read waits for its value
+READ_TIMEOUT = 2.0          # seconds before a one-shot read gives up
+
+
+def rref_message(freq, index, ref):
+    # Give them an index number and a frequency in Hz.
+    # To disable sending you send frequency 0.
+    message = struct.pack('<5sii400s', b'RREF\x00', freq, index, ref.encode())
+    assert(len(message)==413)
+    return message
+
+
+class Subscriptions:
+
+    def __init__(self, store):
+        self.store = store
+        self.send = None            # send(message) puts a datagram out to X-Plane, None until connected
+        self.lock = threading.Lock()
+        self.pending = {}           # index -> (freq, ref) waiting to go out, a newer request for an index replaces the older
+        self.rates = {}             # index -> freq X-Plane was last asked for
+        self.adaptive = set()       # indexes whose rate follows how often they change
+        self.seen = {}              # index -> store.changes at the last adapt
+        self.adapted = None         # time.monotonic() of the last adapt
+        self.sent = 0
+        self.reads = {}             # index -> [ref, deadline, futures] of one-shot reads in flight
+        self.read_refs = {}         # ref -> index of the one-shot read in flight for it
+        self.read_free = [(0, index) for index in range(READ_BASE, READ_BASE + READ_POOL)]
+        self.schedule = scheduler.Scheduler([
+            scheduler.Stream('pace', PACE_HZ, self.pump),
+            scheduler.Stream('adapt', 1 / ADAPT_PERIOD, self.adapt),
+        ])
+
+    def connect(self, send):
+        # X-Plane found (again), queue every dataref we have, the ones at 0 Hz come from elsewhere (RPOS)
+        self.send = send
+        for data in self.store:
+            if data.freq:
+                self.request(data.index, data.freq, data.ref)
+
+    def subscribe(self, ref, hz, name=None, efis=0, perc=-1, cmd='', adaptive=False):
+        index = self.store.add(ref if name is None else name, efis, ref, hz, perc, cmd)
+        if adaptive:
+            self.adaptive.add(index)
+        if hz:
+            self.request(index, hz, ref)
+        return index
+
+    def unsubscribe(self, name):
+        data = self.store.remove(name)
+        self.adaptive.discard(data.index)
+        self.seen.pop(data.index, None)
+        self.request(data.index, 0, data.ref)
+
+    def set_rate(self, name, hz):
+        data = self.store.handle(name)
+        data.freq = hz
+        self.request(data.index, hz, data.ref)
+
+    def request(self, index, freq, ref):
+        with self.lock:
+            self.pending.pop(index, None)
+            self.pending[index] = (freq, ref)
+
+    def read(self, ref, timeout=READ_TIMEOUT):
+        '''Future for the next value X-Plane sends for ref, fails with TimeoutError after timeout seconds'''
+        future = Future()
+        with self.lock:
+            index = self.read_refs.get(ref)
+            if index is None:
+                if not self.read_free or self.read_free[0][0] > time.monotonic():
+                    future.set_exception(RuntimeError(f'Subscriptions: no free index to read {ref}'))
+                    return future
+                reuse, index = self.read_free.pop(0)
+                self.read_refs[ref] = index
+                self.reads[index] = [ref, 0, []]
+                self.pending[index] = (READ_HZ, ref)
+
+            read = self.reads[index]
+            read[1] = max(read[1], time.monotonic() + timeout)
+            read[2].append(future)
+        return future
+
+    def resolve(self, index, value):
+        # value from X-Plane for a one-shot read index
+        self.finish(index, value)
+
+    def finish(self, index, value=None, error=None):
+        with self.lock:
+            read = self.reads.pop(index, None)
+            if read is None:        # already answered, X-Plane sent another before it stopped
+                return
+            ref, deadline, futures = read
+            del self.read_refs[ref]
+            self.pending.pop(index, None)
+            self.pending[index] = (0, ref)
+            # hold the index back until X-Plane has surely stopped sending it
+            self.read_free.append((time.monotonic() + datarefs.RECYCLE_DELAY, index))
+
+        for future in futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(value)
+            else:
+                future.set_exception(error)
+
+    def expire(self):
+        now = time.monotonic()
+        for index, (ref, deadline, futures) in list(self.reads.items()):
+            if now >= deadline:
+                self.finish(index, error=TimeoutError(f'Subscriptions: no value for {ref}'))
+
+    def pump(self):
+        # send the next few queued requests
+        if self.reads:
+            self.expire()
+        if self.send is None:
+            return
+        with self.lock:
+            batch = []
+            for index in list(self.pending)[:SUBSCRIBE_BURST]:
+                batch.append((index,) + self.pending.pop(index))
+
+        for index, freq, ref in batch:
+            self.send(rref_message(freq, index, ref))
+            self.sent += 1
+            if index >= READ_BASE:
+                continue
+            if freq:
+                self.rates[index] = freq
+            else:
+                self.rates.pop(index, None)
+
+    def adapt(self):
+        now = time.monotonic()
+        elapsed = now - self.adapted if self.adapted else 0
+        self.adapted = now
+
+        for index in list(self.adaptive):
+            changes = self.store.changes[index]
+            last = self.seen.get(index)
+            self.seen[index] = changes
+            if last is None or not elapsed:
+                continue
+
+            # twice the rate it changes at is enough not to miss a change
+            data = self.store.refs[index]
+            per_sec = (changes - last) / elapsed
+            target = min(data.freq, max(ADAPT_MIN_HZ, math.ceil(per_sec * 2)))
+            if target != self.rates.get(index, data.freq):
+                self.request(index, target, data.ref)
+
+    def poll(self):
+        return self.schedule.poll()
+
+    def run(self, stop=None):
+        self.schedule.run(stop)
+
+    def stats(self):
+        return {'sent': self.sent, 'pending': len(self.pending), 'reads': len(self.reads),
+                'rates': {self.store.refs[index].name: freq for index, freq in self.rates.items() if self.store.refs[index]}}
@@ -0,0 +1,76 @@
+'''efis.Deframer against frames built by efis.encode_frame'''
+
+import efis
+
+
+# a state variable packet, one full of bytes that need escaping, a GPS packet
+PAYLOADS = [b'\x0212=29.92\x003=3.14\x00', bytes(range(0x70, 0x80)) * 2, b'\x09\x00' + bytes(20)]
+STREAM = b''.join(efis.encode_frame(payload) for payload in PAYLOADS)
+
+
+def feed(deframer, *pieces):
+    return [bytes(packet) for piece in pieces for packet in deframer.feed(piece)]
+
+
+def test_whole_stream():
+    assert feed(efis.Deframer(), STREAM) == PAYLOADS
+
+
+def test_split_at_every_offset():
+    for n in range(len(STREAM) + 1):
+        assert feed(efis.Deframer(), STREAM[:n], STREAM[n:]) == PAYLOADS, n
+
+
+def test_every_chunk_size():
+    for size in range(1, len(STREAM) + 1):
+        pieces = [STREAM[i:i + size] for i in range(0, len(STREAM), size)]
+        assert feed(efis.Deframer(), *pieces) == PAYLOADS, size
+
+
+def test_escape_straddles_chunks():
+    frame = efis.encode_frame(PAYLOADS[1])
+    escapes = [n for n, byte in enumerate(frame) if byte == 0x7D]
+    assert escapes
+    for n in escapes:
+        assert feed(efis.Deframer(), frame[:n + 1], frame[n + 1:]) == [PAYLOADS[1]], n
+
+
+def test_shared_and_back_to_back_flags():
+    packets = [efis.encode_packet(payload) for payload in PAYLOADS]
+    shared = b'\x7E' + b'\x7E'.join(packets) + b'\x7E'
+    back_to_back = b'\x7E\x7E\x7E' + b'\x7E\x7E'.join(packets) + b'\x7E\x7E'
+    assert feed(efis.Deframer(), shared) == PAYLOADS
+    assert feed(efis.Deframer(), back_to_back) == PAYLOADS
+
+
+def test_noise_before_first_flag():
+    assert feed(efis.Deframer(), b'\x01\x02\x7D', STREAM) == PAYLOADS
+
+
+def test_other_escapes():
+    # 0x7D xx is xx ^ 0x20 for any xx, not only the two encode_packet makes
+    packet = bytearray(efis.encode_packet(b'\x02A'))
+    n = packet.index(b'A')
+    packet[n:n + 1] = b'\x7D\x61'
+    assert feed(efis.Deframer(), b'\x7E' + packet + b'\x7E') == [b'\x02A']
+
+
+def test_bad_checksum():
+    bad = bytearray(efis.encode_frame(PAYLOADS[0]))
+    bad[6] ^= 0x01
+    deframer = efis.Deframer()
+    assert feed(deframer, bad + STREAM) == PAYLOADS
+    assert deframer.bad_checksums == 1
+
+
+def test_abort_sequence():
+    # a 0x7D right before a flag drops the frame, the next one still comes through
+    aborted = efis.encode_frame(PAYLOADS[0])[:-1] + b'\x7D\x7E'
+    deframer = efis.Deframer()
+    assert feed(deframer, aborted, STREAM) == PAYLOADS
+    assert deframer.bad_checksums == 0
+
+
+def test_matches_read_buffer():
+    buffer = bytearray(STREAM)
+    assert [bytes(packet) for packet in efis.read_buffer(buffer)] == feed(efis.Deframer(), STREAM)
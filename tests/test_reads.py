@@ -0,0 +1,104 @@
+'''One-shot dataref reads, xplane.get_ref/read_ref, against emulators.FakeXPlane on loopback'''
+
+import socket
+import threading
+import time
+
+import pytest
+
+import datarefs
+import emulators
+import session
+import subscriptions
+import xplane
+
+
+class Bridge:
+    '''A Session's X-Plane receive side and subscriptions, talking to a FakeXPlane'''
+
+    def __init__(self, answer=True):
+        self.sim = emulators.FakeXPlane('127.0.0.1')
+        threading.Thread(target=self.sim.receive, daemon=True).start()
+        if answer:
+            threading.Thread(target=self.sim.stream, daemon=True).start()
+        self.seat = session.Session('test')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.1)
+        self.stop = threading.Event()
+        threading.Thread(target=xplane.rx_thread, args=(self.sock, self.seat), daemon=True).start()
+        threading.Thread(target=self.seat.subscriptions.run, args=(self.stop,), daemon=True).start()
+        xplane.load_refs(self.sock, {'ip': '127.0.0.1', 'port': self.sim.port}, self.seat)
+
+    def close(self):
+        self.stop.set()
+        self.sock.close()
+        self.sim.close()
+
+
+@pytest.fixture
+def bridge():
+    bridge = Bridge()
+    yield bridge
+    bridge.close()
+
+
+def test_get_ref(bridge):
+    bridge.sim.drefs['sim/test/value'] = 2.5
+    assert xplane.get_ref('sim/test/value', session=bridge.seat) == 2.5
+
+
+def test_concurrent_reads_of_different_refs(bridge):
+    refs = [f'sim/test/ref_{n}' for n in range(20)]
+    for n, ref in enumerate(refs):
+        bridge.sim.drefs[ref] = n + 0.5
+    futures = [xplane.read_ref(ref, session=bridge.seat) for ref in refs]
+    assert [future.result(5) for future in futures] == [n + 0.5 for n in range(len(refs))]
+
+
+def test_concurrent_reads_of_the_same_ref(bridge):
+    bridge.sim.drefs['sim/test/same'] = 7.0
+    reads = bridge.seat.subscriptions
+    futures = [xplane.read_ref('sim/test/same', session=bridge.seat) for n in range(10)]
+    assert len(reads.reads) == 1            # one index, one subscription for all of them
+    assert [future.result(5) for future in futures] == [7.0] * 10
+
+
+def test_timeout():
+    bridge = Bridge(answer=False)
+    try:
+        with pytest.raises(TimeoutError):
+            xplane.get_ref('sim/test/silent', timeout=0.3, session=bridge.seat)
+        assert not bridge.seat.subscriptions.reads
+    finally:
+        bridge.close()
+
+
+def test_unsubscribes_after_first_value(bridge):
+    bridge.sim.drefs['sim/test/once'] = 1.0
+    assert xplane.get_ref('sim/test/once', session=bridge.seat) == 1.0
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline and any(ref == 'sim/test/once' for ref, freq, due in list(bridge.sim.subscriptions.values())):
+        time.sleep(0.01)
+    assert all(ref != 'sim/test/once' for ref, freq, due in bridge.sim.subscriptions.values())
+
+
+def test_index_pool_reuse(monkeypatch):
+    # one index in the pool, it rests RECYCLE_DELAY after a read before the next read gets it
+    monkeypatch.setattr(subscriptions, 'READ_POOL', 1)
+    monkeypatch.setattr(datarefs, 'RECYCLE_DELAY', 0.3)
+    bridge = Bridge()
+    try:
+        reads = bridge.seat.subscriptions
+        bridge.sim.drefs['sim/test/first'] = 1.0
+        bridge.sim.drefs['sim/test/second'] = 2.0
+        assert xplane.get_ref('sim/test/first', session=bridge.seat) == 1.0
+
+        with pytest.raises(RuntimeError):
+            xplane.get_ref('sim/test/second', session=bridge.seat)      # still resting
+        time.sleep(0.4)
+        future = xplane.read_ref('sim/test/second', session=bridge.seat)
+        assert reads.read_refs['sim/test/second'] == subscriptions.READ_BASE
+        assert future.result(5) == 2.0
+    finally:
+        bridge.close()
@@ -0,0 +1,98 @@
+'''link.SerialSink through a pty pair, the test reads what a serial device would'''
+
+import os
+import threading
+import time
+
+import pytest
+import serial
+
+import codec
+import link
+import session
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pty')
+
+SECONDS = 1.5
+HIGH_HZ = 100           # more attitude than 9600 baud carries
+
+
+def run(baud, gps_hz=link.SERIAL_GPS_HZ):
+    seat = session.Session('test')
+    for index in range(len(seat.store)):
+        seat.store.stamp[index] = time.monotonic() + 3600      # fresh for the whole run
+    master, slave = os.openpty()
+    port = serial.Serial(os.ttyname(slave), baud, write_timeout=0)
+    received = bytearray()
+
+    def read():
+        # until the slave side closes and the master reads EIO
+        try:
+            while True:
+                received.extend(os.read(master, 65536))
+        except OSError:
+            pass
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    stop = threading.Event()
+    start = time.monotonic()
+    sink = link.SerialSink(port, baud, gps_hz, seat, high_hz=HIGH_HZ)
+    threading.Timer(SECONDS, stop.set).start()
+    sink.scheduler().run(stop)
+    elapsed = time.monotonic() - start
+    port.close()
+    os.close(slave)
+    reader.join()
+    os.close(master)
+    return sink, frames(bytes(received)), len(received), elapsed
+
+
+def frames(data):
+    # split the stream into its frames, every byte has to belong to a whole, good frame
+    found = []
+    pos = 0
+    while pos < len(data):
+        if data.startswith(codec.AHRS_HIGH_HEADER, pos):
+            frame = data[pos:pos + codec.AHRS_HIGH_SIZE]
+            assert len(frame) == codec.AHRS_HIGH_SIZE and frame[-1] == codec.ahrs_checksum(frame[:-1])
+            found.append('high')
+        elif data.startswith(codec.AHRS_LOW_PAYLOAD, pos):
+            frame = data[pos:pos + codec.AHRS_LOW_SIZE]
+            assert len(frame) == codec.AHRS_LOW_SIZE and frame[-1] == codec.ahrs_checksum(frame[:-1])
+            found.append('low')
+        elif data.startswith(b'$GP', pos):
+            frame = data[pos:data.index(b'\r\n', pos) + 2]
+            assert codec.nmea(frame[1:-5]) == frame
+            found.append(frame[3:6].decode().lower())
+        else:
+            pytest.fail(f'no frame at byte {pos}: {data[pos:pos + 8].hex()}')
+        pos += len(frame)
+    return found
+
+
+def test_whole_frames_within_baud():
+    for baud in (9600, 38400):
+        sink, found, size, elapsed = run(baud)
+        assert size <= baud / link.SERIAL_BITS * elapsed, baud
+        assert len(found) == sum(sink.sent.values())
+        assert sink.stats()['backlog_max_ms'] <= link.SERIAL_MAX_DELAY * 1e3
+
+
+def test_attitude_first():
+    # 9600 baud carries ~42 attitude frames a second, they get all of it
+    sink, found, size, elapsed = run(9600)
+    assert sink.gps_hz == 0             # no room for NMEA within SERIAL_MAX_DELAY
+    assert found.count('high') >= 0.9 * 9600 / link.SERIAL_BITS * elapsed / codec.AHRS_HIGH_SIZE
+    assert sink.skipped['low'] > 0      # low rate frames make way, attitude isn't held up for them
+
+
+def test_everything_fits_at_38400():
+    sink, found, size, elapsed = run(38400)
+    assert found.count('high') >= 0.9 * HIGH_HZ * SECONDS
+    assert 'low' in found and 'rmc' in found and 'gga' in found
+
+
+def test_too_slow_for_ahrs():
+    with pytest.raises(ValueError):
+        link.SerialSink(serial.serial_for_url('loop://'), 4800)
@@ -0,0 +1,45 @@
+'''Subscriptions.adapt on the datarefs subscribed as adaptive, fed through xplane.process_datagram'''
+
+import struct
+import time
+
+import session
+import subscriptions
+import xplane
+
+
+def rref(index, value):
+    return b'RREF,' + struct.pack('<if', index, value)
+
+
+def test_adaptive_rates_drop():
+    # 30 s of 20 Hz RREF, hobbs and flight time count up in seconds, fuel burns slowly
+    seat = session.Session('test')
+    store, subs = seat.store, seat.subscriptions
+    names = ('hobbs', 'flighttime', 'fuel_qty_left', 'fuel_qty_right')
+    indexes = [store.index(name) for name in names]
+    subs.adapt()
+    for n in range(30 * 20):
+        t = 1000 + n / 20
+        for index, value in zip(indexes, (t, t, 50 - t / 1000, 50 - t / 1000)):
+            xplane.process_datagram(rref(index, value), seat)
+    subs.adapted = time.monotonic() - 30
+    subs.adapt()
+
+    for name, index in zip(names, indexes):
+        freq, ref = subs.pending[index]
+        assert freq < store.refs[index].freq, name
+        assert freq >= subscriptions.ADAPT_MIN_HZ, name
+
+
+def test_fast_counter_keeps_its_rate():
+    # a value changing at display resolution every frame still needs the full rate
+    seat = session.Session('test')
+    store, subs = seat.store, seat.subscriptions
+    index = store.index('hobbs')
+    subs.adapt()
+    for n in range(30 * 20):
+        xplane.process_datagram(rref(index, 1000 + n), seat)
+    subs.adapted = time.monotonic() - 30
+    subs.adapt()
+    assert subs.pending.get(index, (store.refs[index].freq,))[0] == store.refs[index].freq
@@ -2,10 +2,17 @@ import socket
 import struct 
 import threading
 import queue
+import functools
 import efis
-import datetime
+import time
+import datarefs
+import capture
+import instrument
+import log
+from subscriptions import Subscriptions, READ_BASE, READ_TIMEOUT
 
 q = queue.Queue()
+_log = log.get('xplane')
 
 BEACON_IP = '239.255.1.1'   # Xplane beacon multicast group
 BEACON_PORT = 49707
@@ -13,109 +20,180 @@ BEACON_PORT = 49707
 XPLANE_MAJOR_VER = 1        # This python code is designed for this xplane UDP version
 XPLANE_MINOR_VER = 2
 
-my_data = {}
-def store_refs(name, efis=0, ref='', freq=0, perc=-1, cmd=''):
+_rref_value = struct.Struct('<if')             # RREF idx, value
+_rpos = struct.Struct('<5sdddffffffffff')      # RPOS4 packet
+
+RPOS_HZ = 20                # RPOS packets a second, 0 = get the RPOS datarefs over RREF instead
+RPOS_FIELDS = ('longitude', 'latitude', 'asl', 'agl', 'pitch', 'heading_true', 'roll',
+               'x_speed', 'v_speed', 'z_speed', 'p_rad', 'q_rad', 'r_rad')     # RPOS4 values in packet order
+
+def store_refs(name, efis=0, ref='', freq=0, perc=-1, cmd='', adapt=False, subs=None):
     # name = variable name
     # efis = index of EFIS state variables
     # ref = string of Xplane data reference
     # freq = how many times a second to get data from xplane
-    # value = holds the value of variable
     # perc = precision of the decimal place
-    # lock = holds time to block xplane re-updating value after efis has just updated it
     # cmd = variable could be a command for EFIS to run on xplane
-    
-    if my_data.get(name, None) is None:
-        var = {'efis':efis, 'ref':ref, 'freq':freq, 'value':0, 'perc':perc, 'lock':datetime.datetime.now(), 'cmd':cmd}
-        my_data.update({name : var})
+    # adapt = let the rate drop while the value changes slowly, see subscriptions.py
+    # subs = Subscriptions of the store to add to, a Session's, default the module's
+    # value, lock and update time are kept in the store arrays, see datarefs.DatarefStore
+    subs = subscriptions if subs is None else subs
+    if name not in subs.store:
+        return subs.subscribe(ref, freq, name, efis, perc, cmd, adapt)
     else:
         raise IndexError(f'Xplane store_refs: {name} is already in my_data') 
 
 
-# RPOS data
-store_refs('longitude', 0, 'sim/flightmodel/position/longitude', 20)    
-store_refs('latitude', 0, 'sim/flightmodel/position/latitude', 20)      
-store_refs('asl', 0, 'sim/flightmodel/position/elevation', 20)          #elevation above sea level in meters
-store_refs('agl', 0, 'sim/flightmodel/position/y_agl', 20)              #elevation above terrain in meters
-store_refs('pitch', 0, 'sim/cockpit2/gauges/indicators/pitch_AHARS_deg_pilot', 20)      #pitch in degrees
-store_refs('heading_true', 0, 'sim/flightmodel/position/true_psi', 20)  #heading relative to the earth precisely below the aircraft, true degrees north
-store_refs('roll', 0, 'sim/flightmodel/position/true_phi', 20)          #roll in degrees
-store_refs('x_speed', 0, 'sim/flightmodel/position/local_vx', 20)       #speed in EAST, m/s
-store_refs('v_speed', 0, 'sim/flightmodel/position/local_vy', 20)       #speed in UP, m/s
-store_refs('z_speed', 0, 'sim/flightmodel/position/local_vz', 20)       #speed in SOUTH, m/s
-store_refs('p_rad', 0, 'sim/flightmodel/position/Prad', 20)         #roll rate in radians/s
-store_refs('q_rad', 0, 'sim/flightmodel/position/Qrad', 20)         #pitch rate in radians/s
-store_refs('r_rad', 0, 'sim/flightmodel/position/Rrad', 20)         #yah rate in radians/s
-
-# user data
-store_refs('heading_bug', 3, 'sim/cockpit/autopilot/heading_mag', 2, 0)
-store_refs('baropressure', 12, 'sim/cockpit2/gauges/actuators/barometer_setting_in_hg_pilot', 3, 2)
-store_refs('mag_var', 0, 'sim/flightmodel/position/magnetic_variation', 20)     # The local magnetic variation
-store_refs('heading_mag', 0, 'sim/flightmodel/position/mag_psi', 20)          # "°", "The real magnetic heading of the aircraft
-store_refs('heading_gnd', 0, 'sim/cockpit2/gauges/indicators/ground_track_mag_pilot', 20)      # The ground track of the aircraft in degrees magnetic
-store_refs('heading_actual', 0, 'sim/flightmodel/position/hpath', 20)       # The heading the aircraft actually flies. (hpath+beta=psi)
-store_refs('ias', 0, 'sim/flightmodel/position/indicated_airspeed', 20)     # "kt", "Air speed indicated - this takes into account air density and wind direction
-store_refs('gnd_speed', 0, 'sim/flightmodel/position/groundspeed', 20)            # "m/s", "The ground speed of the aircraft
-store_refs('rpm', 0, 'sim/cockpit2/engine/indicators/engine_speed_rpm[0]', 20)
-store_refs('cht', 0, 'sim/cockpit2/engine/indicators/CHT_deg_C[0]', 20)
-store_refs('egt', 0, 'sim/cockpit2/engine/indicators/EGT_deg_C[0]', 20)
-store_refs('fuelflow', 0, 'sim/cockpit2/engine/indicators/fuel_flow_kg_sec[0]', 20)
-store_refs('fuelpressure', 0, 'sim/cockpit2/engine/indicators/fuel_pressure_psi[0]', 20)
-store_refs('oilpressure', 0, 'sim/cockpit2/engine/indicators/oil_pressure_psi[0]', 20)
-store_refs('oiltemp', 0, 'sim/cockpit2/engine/indicators/oil_temperature_deg_C[0]', 20)
-store_refs('manifoldpressure', 0, 'sim/cockpit2/engine/indicators/MPR_in_hg[0]', 20)
-store_refs('manifoldtemp', 0, 'sim/cockpit2/engine/indicators/carburetor_temperature_C[0]', 20)
-store_refs('oat', 0, 'sim/cockpit2/temperature/outside_air_temp_degf[0]', 20)
-store_refs('hobbs', 0, 'sim/time/hobbs_time', 20)     # seconds
-store_refs('flighttime', 0, 'sim/time/total_flight_time_sec', 20)
-store_refs('volts', 0, 'sim/flightmodel/engine/ENGN_bat_volt[0]', 20)
-store_refs('fuel_qty_left', 0, 'sim/cockpit2/fuel/fuel_level_indicated_left', 20)     # in lbs
-store_refs('fuel_qty_right', 0, 'sim/cockpit2/fuel/fuel_level_indicated_right', 20)    # in lbs
-
-store_refs('ap_enav', 25.0, 'sim/cockpit2/autopilot/nav_status', 2, cmd='sim/autopilot/NAV')
-store_refs('ap_heading', 25.1, 'sim/cockpit2/autopilot/heading_status', 2, cmd='sim/autopilot/heading')   
-store_refs('ap_gnav', 25.2, 'sim/cockpit2/autopilot/gpss_status', 2, cmd='sim/autopilot/NAV')
-store_refs('ap_altitude', 4, 'sim/cockpit/autopilot/current_altitude', 2)
-
-
-store_refs('com1_freq', 0, 'sim/cockpit2/radios/actuators/com1_frequency_hz', 2)
-
-
-
-
-# main loop
-def xplane():
-
-    beacon = find_beacon()
+def unsubscribe(name, session=None):
+    # stop receiving a dataref, X-Plane is told at the next pacing tick
+    get_subscriptions(session).unsubscribe(name)
+
+
+def set_rate(name, freq, session=None):
+    get_subscriptions(session).set_rate(name, freq)
+
+
+# Every dataref the bridge uses, store_refs adds one to a store
+def load_datarefs(store_refs, rpos_hz=RPOS_HZ):
+    # RPOS data, one RPOS4 packet carries them all so they are only subscribed over RREF with RPOS off
+    rpos_freq = rpos_refs_hz(rpos_hz)
+    store_refs('longitude', 0, 'sim/flightmodel/position/longitude', rpos_freq)    
+    store_refs('latitude', 0, 'sim/flightmodel/position/latitude', rpos_freq)      
+    store_refs('asl', 0, 'sim/flightmodel/position/elevation', rpos_freq)          #elevation above sea level in meters
+    store_refs('agl', 0, 'sim/flightmodel/position/y_agl', rpos_freq)              #elevation above terrain in meters
+    store_refs('pitch', 0, 'sim/flightmodel/position/theta', rpos_freq)            #pitch in degrees, what RPOS sends rather than the pilot's AHARS
+    store_refs('heading_true', 0, 'sim/flightmodel/position/true_psi', rpos_freq)  #heading relative to the earth precisely below the aircraft, true degrees north
+    store_refs('roll', 0, 'sim/flightmodel/position/true_phi', rpos_freq)          #roll in degrees
+    store_refs('x_speed', 0, 'sim/flightmodel/position/local_vx', rpos_freq)       #speed in EAST, m/s
+    store_refs('v_speed', 0, 'sim/flightmodel/position/local_vy', rpos_freq)       #speed in UP, m/s
+    store_refs('z_speed', 0, 'sim/flightmodel/position/local_vz', rpos_freq)       #speed in SOUTH, m/s
+    store_refs('p_rad', 0, 'sim/flightmodel/position/Prad', rpos_freq)         #roll rate in radians/s
+    store_refs('q_rad', 0, 'sim/flightmodel/position/Qrad', rpos_freq)         #pitch rate in radians/s
+    store_refs('r_rad', 0, 'sim/flightmodel/position/Rrad', rpos_freq)         #yah rate in radians/s
+
+    # user data
+    store_refs('heading_bug', 3, 'sim/cockpit/autopilot/heading_mag', 2, 0)
+    store_refs('baropressure', 12, 'sim/cockpit2/gauges/actuators/barometer_setting_in_hg_pilot', 3, 2)
+    store_refs('mag_var', 0, 'sim/flightmodel/position/magnetic_variation', 20)     # The local magnetic variation
+    store_refs('heading_mag', 0, 'sim/flightmodel/position/mag_psi', 20)          # "°", "The real magnetic heading of the aircraft
+    store_refs('heading_gnd', 0, 'sim/cockpit2/gauges/indicators/ground_track_mag_pilot', 20)      # The ground track of the aircraft in degrees magnetic
+    store_refs('heading_actual', 0, 'sim/flightmodel/position/hpath', 20)       # The heading the aircraft actually flies. (hpath+beta=psi)
+    store_refs('ias', 0, 'sim/flightmodel/position/indicated_airspeed', 20)     # "kt", "Air speed indicated - this takes into account air density and wind direction
+    store_refs('gnd_speed', 0, 'sim/flightmodel/position/groundspeed', 20)            # "m/s", "The ground speed of the aircraft
+    store_refs('rpm', 0, 'sim/cockpit2/engine/indicators/engine_speed_rpm[0]', 20)
+    store_refs('cht', 0, 'sim/cockpit2/engine/indicators/CHT_deg_C[0]', 20)
+    store_refs('egt', 0, 'sim/cockpit2/engine/indicators/EGT_deg_C[0]', 20)
+    store_refs('fuelflow', 0, 'sim/cockpit2/engine/indicators/fuel_flow_kg_sec[0]', 20)
+    store_refs('fuelpressure', 0, 'sim/cockpit2/engine/indicators/fuel_pressure_psi[0]', 20)
+    store_refs('oilpressure', 0, 'sim/cockpit2/engine/indicators/oil_pressure_psi[0]', 20)
+    store_refs('oiltemp', 0, 'sim/cockpit2/engine/indicators/oil_temperature_deg_C[0]', 20)
+    store_refs('manifoldpressure', 0, 'sim/cockpit2/engine/indicators/MPR_in_hg[0]', 20)
+    store_refs('manifoldtemp', 0, 'sim/cockpit2/engine/indicators/carburetor_temperature_C[0]', 20)
+    store_refs('oat', 0, 'sim/cockpit2/temperature/outside_air_temp_degf[0]', 20)
+    # rounded to what the EIS shows, so adapt counts changes at display resolution
+    store_refs('hobbs', 0, 'sim/time/hobbs_time', 20, 0, adapt=True)     # seconds
+    store_refs('flighttime', 0, 'sim/time/total_flight_time_sec', 20, 0, adapt=True)
+    store_refs('volts', 0, 'sim/flightmodel/engine/ENGN_bat_volt[0]', 20)
+    store_refs('fuel_qty_left', 0, 'sim/cockpit2/fuel/fuel_level_indicated_left', 20, 1, adapt=True)     # in lbs
+    store_refs('fuel_qty_right', 0, 'sim/cockpit2/fuel/fuel_level_indicated_right', 20, 1, adapt=True)    # in lbs
+
+    store_refs('ap_enav', 25.0, 'sim/cockpit2/autopilot/nav_status', 2, cmd='sim/autopilot/NAV')
+    store_refs('ap_heading', 25.1, 'sim/cockpit2/autopilot/heading_status', 2, cmd='sim/autopilot/heading')   
+    store_refs('ap_gnav', 25.2, 'sim/cockpit2/autopilot/gpss_status', 2, cmd='sim/autopilot/NAV')
+    store_refs('ap_altitude', 4, 'sim/cockpit/autopilot/current_altitude', 2)
+
+
+    store_refs('com1_freq', 0, 'sim/cockpit2/radios/actuators/com1_frequency_hz', 2)
+
+
+# What the producers need before they start, see ready()
+def group_datarefs(store):
+    store.group('ahrs', ['roll', 'pitch', 'heading_mag', 'asl', 'v_speed', 'ias'])
+    store.group('interlink', ['latitude', 'longitude', 'heading_actual', 'gnd_speed', 'rpm'])
+
+
+# RREF rate of the RPOS fields, they only come over RREF while RPOS is off
+def rpos_refs_hz(rpos_hz):
+    return 0 if rpos_hz else 20
+
+
+# A store holding every dataref and the Subscriptions keeping X-Plane in step with it, one per Session
+def new_store(rpos_hz=RPOS_HZ):
+    store = datarefs.DatarefStore()
+    subs = Subscriptions(store)
+    load_datarefs(functools.partial(store_refs, subs=subs), rpos_hz)
+    group_datarefs(store)
+    return store, subs
+
+
+# RREF index of each RPOS4 field in a store made by new_store()
+def rpos_index(store):
+    return tuple(store.index(name) for name in RPOS_FIELDS)
+
+
+my_data, subscriptions = new_store()     # the module's own store, used unless a Session is given
+_rpos_index = rpos_index(my_data)
+_rpos_hz = RPOS_HZ          # the module's RPOS rate, see set_rpos_hz
+
+
+# DatarefStore and Subscriptions of a Session, or the module's own for None
+def get_store(session):
+    return my_data if session is None else session.store
+
+
+def get_subscriptions(session):
+    return subscriptions if session is None else session.subscriptions
+
+
+def get_rpos_hz(session):
+    return _rpos_hz if session is None else session.rpos_hz
+
+
+# RPOS packets a second for the module's own store, before xplane() starts, 0 = the RPOS fields over RREF
+def set_rpos_hz(hz):
+    global _rpos_hz
+    _rpos_hz = hz
+    for name in RPOS_FIELDS:
+        subscriptions.set_rate(name, rpos_refs_hz(hz))
+
+
+
+
+# main loop, session = the Session to run, default the module's own store and queue
+def xplane(session=None):
+
+    beacon = find_beacon() if session is None else session.find_xplane()
     port = beacon['port']
     print(f'Xplane: Starting UDP connection with Xplane on port {port}')
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) 
 #    sock.bind(('', port))   
 
-    cmd = b"RPOS\x00"
-    freq=b"20\x00"
-    message = struct.pack("<5s2s", cmd, freq)
-    sock.sendto(message, (beacon['ip'], beacon['port']))
-
-
-    load_refs(sock, beacon)     #load data to receive
+    request_rpos(sock, beacon, get_rpos_hz(session))
+    load_refs(sock, beacon, session)     #load data to receive, paced out by the subscriptions thread
+    threading.Thread(target=get_subscriptions(session).run, daemon=True).start()
 
     # start a receiving thread
-    t = threading.Thread(target=rx_thread,args=(sock,))    
+    t = threading.Thread(target=rx_thread,args=(sock, session))    
     t.start()
 
     # look at the Q for a task
+    tasks = q if session is None else session.xplane_q
+    counts = instrument.counters()
     while True:
         try:
-            task, data = q.get()
+            task, data = tasks.get()
+            instrument.high_water('xplane.q', tasks.qsize() + 1)
             if task=='send':
-                sock.sendto(data, (beacon['ip'], beacon['port']))
+                counts['xplane_tx'] += 1
+                send_to(sock, data, (beacon['ip'], beacon['port']))
             else:
-                print(f'Xplane: Except task SEND, but got {task}')
-            q.task_done()
+                _log.warning('Except task SEND, but got %s', task)
+            tasks.task_done()
         except queue.Empty:
             pass
         except Exception as e: 
-            print(f'Xplane tx loop: {type(e)} = {e}')
+            counts['xplane_tx_errors'] += 1
+            _log.error('tx loop: %s = %s', type(e), e)
             pass
 
  
@@ -124,22 +202,27 @@ def xplane():
     sock.close()
 
                    
-# Mass loading data refs from xplane    
-def load_refs(sock, beacon):
-    for index, (key, value) in enumerate(my_data.items()):
-        # Send one RREF Command for every dataref in the list.
-        # Give them an index number and a frequency in Hz.
-        # To disable sending you send frequency 0. 
-        cmd = b'RREF\x00'
-        freq = value['freq']
-        string = value['ref'].encode()
-        message = struct.pack('<5sii400s', cmd, freq, index, string)
-        assert(len(message)==413)
-        sock.sendto(message, (beacon['ip'], beacon['port']))
+# Ask xplane to stream RPOS, sock can be a socket or an asyncio DatagramTransport
+def request_rpos(sock, beacon, freq=RPOS_HZ):
+    message = b"RPOS\x00" + str(freq).encode() + b"\x00"     # rate as null terminated text, any number of digits
+    send_to(sock, message, (beacon['ip'], beacon['port']))
+
+
+# Mass loading data refs from xplane, sock can be a socket or an asyncio DatagramTransport
+def load_refs(sock, beacon, session=None):
+    addr = (beacon['ip'], beacon['port'])
+    get_subscriptions(session).connect(lambda message: send_to(sock, message, addr))
+
+
+# Every datagram to xplane goes out here, so a recording has all of them
+def send_to(sock, message, addr):
+    sock.sendto(message, addr)
+    if capture.recorder:
+        capture.recorder.write(capture.XPLANE, capture.TX, message, addr[0])
  
         
-# Listen for multicast beacon to find Xplane master
-def find_beacon():
+# Listen for multicast beacon to find Xplane master, the one on host if given
+def find_beacon(host=None):
 
     print(f'Listening for Xplane beacon on UDP {BEACON_IP}:{BEACON_PORT}')
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -176,7 +259,8 @@ def find_beacon():
             if beacon_major_version == XPLANE_MAJOR_VER \
                 and beacon_minor_version == XPLANE_MINOR_VER \
                 and application_host_id == 1 \
-                and role == 1:
+                and role == 1 \
+                and host in (None, sender[0]):
 
                 print(f'Found Xplane {xplane_version_number[0:2]}.{xplane_version_number[2:4]}b{xplane_version_number[4:6]} running on {computer_name} ({sender[0]}:{port})')                            
                 beacon['ip'] = sender[0]
@@ -188,39 +272,91 @@ def find_beacon():
 
 
 # loop for receiving data
-def rx_thread(sock):
-
-    index_keys = list(my_data) 
+def rx_thread(sock, session=None):
+    counts = instrument.counters()
 
     while True:
        # Receive packet
         try:
             packet, addr = sock.recvfrom(1024) # buffer size is 1024 bytes
-            values = decode_packet(packet)     # Decode Packet
-            
-            if packet[0:5]==b'RREF,':
-                for key,value in values.items():
-                    data = my_data[index_keys[key]]
-                    if data['perc'] == 0:
-                        value = int(value)
-                    elif data['perc'] > 0:
-                        value = round(value, data['perc'])
-
-                    if key==999:                # temporary one-off key
-                        q.put(('value', value))
-                    
-                    elif data['value'] != value:     # update if values don't match
-                        
-                        if datetime.datetime.now() >= data['lock']:   # there is no lock from EFIS
-                            xplane_updating(index_keys[key], value)
+            counts['xplane_datagrams'] += 1
+            counts['xplane_bytes'] += len(packet)
+            if capture.recorder:
+                capture.recorder.write(capture.XPLANE, capture.RX, packet, addr[0])
+            process_datagram(packet, session)
 
         except socket.timeout:
             pass        
         except socket.error:
             #If no data is received, you get here, but it's not an error
-            pass
+            if sock.fileno() < 0:       # unless the socket has been closed
+                break
         except Exception as e: 
-            print(f'Xplane rx_thread: {type(e)} = {e}')
+            counts['xplane_rx_errors'] += 1
+            _log.error('rx_thread: %s = %s', type(e), e)
+
+
+# Apply one datagram from xplane to my_data, shared by the threaded and asyncio engines
+def process_datagram(packet, session=None):
+    if packet[0:5]==b'RREF,':
+        store = my_data if session is None else session.store
+        values = store.values
+        percs = store.perc
+        locks = store.lock
+        stamps = store.stamp
+        now = time.monotonic()
+        instrument.counters()['rref_values'] += (len(packet) - 5) // 8
+        for key,value in decode_rref(packet):
+            if key >= READ_BASE:        # one-shot read, see subscriptions.read
+                get_subscriptions(session).resolve(key, value)
+                continue
+
+            stamps[key] = now           # received, changed or not, see age_ms/all_fresh
+
+            perc = percs[key]
+            if perc == 0:
+                value = int(value)
+            elif perc > 0:
+                value = round(value, perc)
+
+            if values[key] != value:     # update if values don't match
+                
+                if now >= locks[key]:   # there is no lock from EFIS
+                    xplane_updating(key, value, now, session)
+
+        if store.waiting:
+            store.check_ready()
+
+    elif packet[0:5]==b'RPOS4':
+        instrument.counters()['rpos_packets'] += 1
+        process_rpos(packet, session)
+
+    else:
+        decode_packet(packet)     # Decode Packet
+
+
+# One RPOS4 packet into my_data, every field stamped with the same time so the attitude is one sample
+def process_rpos(packet, session=None):
+    store = my_data if session is None else session.store
+    values = store.values
+    percs = store.perc
+    locks = store.lock
+    stamps = store.stamp
+    now = time.monotonic()
+    for key, value in zip(_rpos_index if session is None else session.rpos_index, _rpos.unpack_from(packet, 0)[1:]):
+        stamps[key] = now
+
+        perc = percs[key]
+        if perc == 0:
+            value = int(value)
+        elif perc > 0:
+            value = round(value, perc)
+
+        if values[key] != value and now >= locks[key]:
+            xplane_updating(key, value, now, session)
+
+    if store.waiting:
+        store.check_ready()
 
 
 # decode packets received from xplane
@@ -228,140 +364,144 @@ def decode_packet(data):
     retvalues = {}
 
     if data[0:5]==b"RPOS4":
-        retvalues = struct.unpack("<5sdddffffffffff", data)
+        retvalues = decode_rpos(data)
         #print(f'{retvalues[6]}')
 
     elif data[0:5]==b'RREF,':
-        # We get 8 bytes for every dataref sent:
-        #    An integer for idx and the float value. 
-        values = data[5:]
-        lenvalue = 8
-        numvalues = int(len(values)/lenvalue)
-        idx=0
-        value=0
-        for i in range(0,numvalues):
-            singledata = data[(5+lenvalue*i):(5+lenvalue*(i+1))]
-            (idx,value) = struct.unpack('<if', singledata)
-            #retvalues[idx] = (value, datarefs[idx][1], datarefs[idx][0])
-            retvalues[idx] = value
+        #retvalues[idx] = (value, datarefs[idx][1], datarefs[idx][0])
+        retvalues = dict(decode_rref(data))
 
     else:
-        print(f'Xplane decode_packet: Unknown packet {data}')
+        instrument.counters()['unknown_packets'] += 1
+        _log.warning('decode_packet: Unknown packet %s', log.Hex(data))
   
     return retvalues
 
 
-# Gets a ref, only once 
-def get_ref(ref):
-    cmd = b"RREF\x00"      
-    freq = 20
-    index = 999
-    string = ref.encode()
-    message = struct.pack("<5sii400s", cmd, freq, index, string)
-    assert(len(message)==413)
-    q.put(('send', message))
-#        sock.sendto(message, (UDP_IP, UDP_PORT))
-        
-    q.join()
-    # wait here for the result to be available before continuing
-    result = ''
-    task, data = q.get()
-    if task=='value':
-        result = data
-    else:
-        print(f'Xplane get_ref: Except task VALUE, but got {task}')
+# RREF datagram in one pass, yields (idx, value)
+def decode_rref(data):
+    # We get 8 bytes for every dataref sent:
+    #    An integer for idx and the float value. 
+    values = memoryview(data)[5:]
+    return _rref_value.iter_unpack(values[:len(values) - len(values) % _rref_value.size])
+
+
+# RPOS datagram: header, lon, lat, elevation (doubles), agl, pitch, true heading, roll, vx, vy, vz, P, Q, R (floats)
+def decode_rpos(data):
+    return _rpos.unpack_from(data)
+
+
+# Gets a ref, only once. Blocks for the value, raises TimeoutError if X-Plane doesn't answer
+def get_ref(ref, timeout=READ_TIMEOUT, session=None):
+    return read_ref(ref, timeout, session).result(timeout)
 
-    q.done()
-#     result_available.wait()
-#     result_available.clear()
-    
-    freq = 0    # set freq to zero, only need the data once
-    message = struct.pack("<5sii400s", cmd, freq, index, string)
-    assert(len(message)==413)
-    q.put(('send', message))
-#        sock.sendto(message, (UDP_IP, UDP_PORT))
-        
-    return result
 
+# Gets a ref only once, as a concurrent.futures.Future, asyncio.wrap_future() makes it awaitable
+def read_ref(ref, timeout=READ_TIMEOUT, session=None):
+    return get_subscriptions(session).read(ref, timeout)
 
-def send_cmd(value):
+
+def send_cmd(value, session=None):
     cmd = b"CMND\x00"      
     string = value.encode()
     message = struct.pack("<5s", cmd) + string
    # assert(len(message)==413)
-    q.put(('send', message))
+    (q if session is None else session.xplane_q).put(('send', message))
 
 
 # EFIS has new data to sync
-def efis_updating(key, value):
+def efis_updating(key, value, session=None):
     message = ''
+    store = get_store(session)
     
     hit = False
-    if isinstance(key, int):       #state variable numeric key
-        for data in my_data.values():
-            if data['efis'] == key:    # efis has match in my_data
-                hit = True
+    if isinstance(key, (int, float)):       #state variable numeric key
+        data = store.statevar(key)
+        hit = data is not None
     else:
-        if key in my_data:
-            data = my_data.get(key)
+        if key in store:
+            data = store.handle(key)
             hit = True
 
     if hit:        
-        if len(data['cmd']) != 0:     #run command 
+        if len(data.cmd) != 0:     #run command 
             cmd = b"CMND\x00"      
-            string = data['cmd'].encode()
+            string = data.cmd.encode()
             message = struct.pack("<5s", cmd) + string
-            print(message)
+            _log.debug('Command %s', data.cmd)
 
         else:
-            old = data['value']
-            perc = data['perc']
-            if data['perc'] == 0:
+            perc = data.perc
+            if perc == 0:
                 value = int(value)
-            elif data['perc'] > 0:
+            elif perc > 0:
                 value = round(value, perc)
-            data['value'] = value
 
             #delay xplane from re-updating until it can catch up to the changes 
-            data['lock'] = datetime.datetime.now() + datetime.timedelta(seconds=1)               
+            now = time.monotonic()
+            store.set(data.index, value, now)
+            store.lock[data.index] = now + 1
 
             cmd = b'DREF\x00'
-            ref = data['ref'].encode()
+            ref = data.ref.encode()
             message = struct.pack('<5sf500s', cmd, value, ref)
             assert(len(message)==509)           
                 
-        q.put(('send', message))
+        (q if session is None else session.xplane_q).put(('send', message))
 
     else:
-        print("Xplane efis_updating: Efis varible key '{}' has no match to my_data. Value = {}".format(key, value))
+        _log.warning("efis_updating: Efis varible key '%s' has no match to my_data. Value = %s", key, value)
     
 
 
-# Xplane has new data to sync
-def xplane_updating(name, value):
-    old = my_data[name]['value']
-    perc = my_data[name]['perc']
+# Xplane has new data to sync, key is the name or RREF index
+def xplane_updating(key, value, now=None, session=None):
+    store = get_store(session)
+    index = store.index(key)
+    perc = store.perc[index]
     if perc >= 0:
         value = round(value, perc)
 
-    my_data[name]['value'] = value
+    store.set(index, value, time.monotonic() if now is None else now)
     
     #Only update the EFIS is there is a link to a statevariable  
-    if my_data[name]['efis'] > 0: 
-        efis.update_statevariable(my_data[name]['efis'], value)       
-        #print(f'Xplane xplane_updating: updated {name} = {old} to {value}')
+    efis_index = store.refs[index].efis
+    if efis_index > 0: 
+        efis.update_statevariable(efis_index, value, session)       
+        #print(f'Xplane xplane_updating: updated {key} = {value}')
 
     return
   
             
-#return value using the name in the dictionary         
-def get_value(name):
-    val = my_data.get(name)
-    if val is not None:
-        return val['value']
+#return value using the name in the store         
+def get_value(name, session=None):
+    store = get_store(session)
+    index = store.names.get(name)
+    if index is not None:
+        return store.get(index)
     else:
         raise IndexError(f'Xplane: {name} not found in Xplane Refs') 
 
+
+# threading.Event set once every dataref of the group has been received
+def ready(group, session=None):
+    return get_store(session).ready[group]
+
+
+# milliseconds since X-Plane last sent the dataref, inf if it never did
+def age_ms(name, session=None):
+    return get_store(session).age_ms(name)
+
+
+# every dataref of the group received recently, X-Plane is still sending
+def all_fresh(group, max_age=datarefs.FRESH_AGE, session=None):
+    return get_store(session).all_fresh(group, max_age)
+
+
+#resolve a name once, the handle reads its value by RREF index
+def handle(name, session=None):
+    return get_store(session).handle(name)
+
    
 #search dictionary for index, return the key        
 def get_nth_key(dictionary, n=0):